@@ -1,28 +1,84 @@
 #This script handles the creation of Gmail service objects using OAuth2 authentication.
 import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from cachetools import LRUCache, TLRUCache
 from dotenv import load_dotenv
+from google.auth.exceptions import RefreshError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
 
 #This script will use the variables defined for the client credentials from the .env file. SO here we load them.
 load_dotenv()
 
-#First function: Create a gmail service, takes in four parameters.
-#Handles the creation of service objects for different Google APIs.
+#Refresh access tokens this many seconds BEFORE they expire, so a request never starts with a token that is about to expire.
+TOKEN_REFRESH_MARGIN = 300
 
-#client_secret_file: Path to the client secret file, contains credentials for the google application.
-#api_name: Name of the Google API to connect to (e.g., 'gmail').
-#api_version: Version of the API to use (e.g., 'v1').
-#scopes: Define the level of access the application is requesting.
-def create_gmail_service(api_name, api_version, *scopes, prefix =''):
-    API_SERCE_NAME = api_name
-    API_VERSION = api_version
-    SCOPES = [scope for scope in scopes[0]]
+#Token files are stored in GOOGLE_TOKEN_DIR if it is set, otherwise in a token_files folder in the working directory.
+#Set it to a shared absolute path when several workers run from different directories.
+TOKEN_DIR = os.getenv('GOOGLE_TOKEN_DIR') or os.path.join(os.getcwd(), 'token_files')
+
+#In-process credentials cache keyed by account (api name, api version, prefix).
+#Entries are evicted when the access token expires (TLRU = time aware least recently used), so stale tokens do not stay in memory.
+def _credentials_ttu(cache_key, creds, now):
+    if not creds.expiry:
+        return now + 3600
+    return creds.expiry.replace(tzinfo=timezone.utc).timestamp()
+
+_credentials_cache = TLRUCache(maxsize=1024, ttu=_credentials_ttu, timer=time.time)
+
+#One lock per account, so concurrent refreshes for the same account are coalesced into a single refresh.
+_cache_lock = threading.Lock()
+_account_locks = {}
 
-    #Here I build the client configuration using environment variables.
+#httplib2 (used by the service objects) is not thread safe, so built services are cached per thread.
+#A service takes about 400 KB, so each thread only keeps its most recently used ones and rebuilds the others.
+SERVICES_PER_THREAD = int(os.getenv('GMAIL_SERVICES_PER_THREAD', '8'))
+_thread_services = threading.local()
+
+#Raised instead of starting the OAuth flow in the browser when interactive=False (server code paths),
+#when the account has no token file or its refresh token was revoked.
+class AuthorizationRequiredError(Exception):
+    pass
+
+def _get_account_lock(cache_key):
+    with _cache_lock:
+        return _account_locks.setdefault(cache_key, threading.Lock())
+
+#Helper function to check if the credentials expire within TOKEN_REFRESH_MARGIN seconds.
+def _expires_soon(creds):
+    if not creds.expiry:
+        return False
+    return creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None) < timedelta(seconds=TOKEN_REFRESH_MARGIN)
+
+#The discovery document describes every Gmail endpoint. It is loaded and parsed once per process from the copy bundled
+#with google-api-python-client, instead of being fetched from Google (or parsed again) every time a service is built.
+#Building resources adds the common parameters to the method descriptions of the document, so every resource is
+#built once here: services of all threads then share a document that is no longer modified.
+@lru_cache(maxsize=None)
+def _get_discovery_document(api_name, api_version):
+    document = get_static_doc(api_name, api_version)
+    if not document:
+        return None
+    document = json.loads(document)
+
+    def build_resources(resource, description):
+        for name, child in description.get('resources', {}).items():
+            build_resources(getattr(resource, name)(), child)
+
+    build_resources(build_from_document(document, http=build_http()), document)
+    return document
+
+#Here I build the client configuration using environment variables.
+def _get_client_config():
     client_config = {
         "web": {
             "client_id": os.getenv("GOOGLE_CLIENT_ID"),
@@ -41,53 +97,139 @@ def create_gmail_service(api_name, api_version, *scopes, prefix =''):
     
     if not client_config["web"]["client_secret"]:
         raise ValueError("GOOGLE_CLIENT_SECRET not found in environment variables.")
-    
 
+    return client_config
+
+def _token_file_path(api_name, api_version, prefix=''):
+    return os.path.join(TOKEN_DIR, f'token_{api_name}_{api_version}{prefix}.json')
+
+#Helper function to write the token file. It writes to a temporary file first and then replaces the token file,
+#so another worker reading the token file never sees a half written file.
+def _save_credentials(creds, token_path):
+    temp_path = f'{token_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(temp_path, token_path)
+
+#Helper function that runs the OAuth flow in the browser, or raises AuthorizationRequiredError when not interactive.
+def _run_oauth_flow(SCOPES, interactive, account):
+    if not interactive:
+        raise AuthorizationRequiredError(f'No valid token for Gmail account {account}, it has to sign in again.')
+    flow = InstalledAppFlow.from_client_config(_get_client_config(), SCOPES)
+    #Make sure it always ask for consent and offline access to get refresh tokens.
+    return flow.run_local_server(port=8080, access_type='offline', prompt='consent')
+
+#Helper function that loads the credentials of an account from its token file, refreshes them or runs the OAuth flow.
+def _load_credentials(api_name, api_version, SCOPES, prefix='', interactive=True):
     #Creates token file that stores unique token for Gmail API services.
     creds = None
-    working_dir = os.getcwd()
-    token_dir = 'token_files'
-    token_file = f'token_{API_SERCE_NAME}_{API_VERSION}{prefix}.json'
+    token_path = _token_file_path(api_name, api_version, prefix)
 
     #Check if the token file directory exists.
-    if not os.path.exists(os.path.join(working_dir, token_dir)):
-        os.mkdir(os.path.join(working_dir, token_dir))
+    os.makedirs(TOKEN_DIR, exist_ok=True)
 
     #Look for existing token, if nto found then create a new one by going through the OUAth flow.
-    if os.path.exists(os.path.join(working_dir, token_dir, token_file)):
+    if os.path.exists(token_path):
         #This function reads the token file and parses the JSON content to create a Credentials object.
-        creds = Credentials.from_authorized_user_file(os.path.join(working_dir, token_dir, token_file), SCOPES) 
+        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
 
-    #This statement checks if the credentials are valid, it can be either expired or mising. If expired, it automatically refreshes one, if missingm it goes through the OAuth flow.    
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
+    #This statement checks if the credentials are valid, it can be either expired, about to expire or mising.
+    #If expired, it automatically refreshes one, if missingm it goes through the OAuth flow.
+    if not creds or not creds.valid or _expires_soon(creds):
+        if creds and creds.refresh_token:
             #Try block to attempt to refresh the token using the refresh function
             #Except block to ensure that it will re-authenticate if the refresh fails
+            #When not interactive only a rejected refresh token asks for a new sign in, other errors (network) are raised as they are.
             try:
                 print("User's credentials have expired. Attempting to refresh user credentials.")
                 creds.refresh(Request())
-            except Exception:
+            except Exception as e:
+                if not interactive and not isinstance(e, RefreshError):
+                    raise
                 print("Refresh user credentials failed. Re-running OAuth flow.")
-                flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
-                creds = flow.run_local_server(port=8080, access_type='offline', prompt='consent')
+                creds = _run_oauth_flow(SCOPES, interactive, prefix.lstrip('_') or api_name)
         else:
-            flow = InstalledAppFlow.from_client_config(client_config, SCOPES)
-            #Make sure it always ask for consent and offline access to get refresh tokens.
-            creds = flow.run_local_server(port=8080, access_type='offline', prompt='consent')
+            creds = _run_oauth_flow(SCOPES, interactive, prefix.lstrip('_') or api_name)
+
+        _save_credentials(creds, token_path)
+
+    return creds
+
+#Function to get the credentials of an account from the in-process cache.
+#The token file is only read on a cache miss, and tokens are refreshed proactively before they expire.
+#Only one thread refreshes a given account at a time, the others wait and then reuse the refreshed credentials.
+#interactive=False raises AuthorizationRequiredError instead of opening the browser, the app never waits on a sign in.
+def get_gmail_credentials(api_name, api_version, SCOPES, prefix='', interactive=True):
+    cache_key = (api_name, api_version, prefix)
+
+    with _get_account_lock(cache_key):
+        creds = _credentials_cache.get(cache_key)
+        if creds is None:
+            creds = _load_credentials(api_name, api_version, SCOPES, prefix, interactive)
+        elif _expires_soon(creds):
+            print("User's credentials are about to expire. Refreshing user credentials.")
+            try:
+                creds.refresh(Request())
+                _save_credentials(creds, _token_file_path(api_name, api_version, prefix))
+            except Exception:
+                creds = _load_credentials(api_name, api_version, SCOPES, prefix, interactive)
+        _credentials_cache[cache_key] = creds
+
+    return creds
 
-        with open(os.path.join(working_dir, token_dir, token_file), 'w') as token:
-            token.write(creds.to_json())
+#Function to drop the cached credentials and services of an account, e.g. after the user revoked access.
+def clear_gmail_service_cache(api_name, api_version, prefix=''):
+    cache_key = (api_name, api_version, prefix)
+    with _get_account_lock(cache_key):
+        _credentials_cache.pop(cache_key, None)
+    getattr(_thread_services, 'services', {}).pop(cache_key, None)
+
+#First function: Create a gmail service, takes in four parameters.
+#Handles the creation of service objects for different Google APIs.
+#Service objects are cached per account (and per thread), so calling this function again is cheap.
+
+#client_secret_file: Path to the client secret file, contains credentials for the google application.
+#api_name: Name of the Google API to connect to (e.g., 'gmail').
+#api_version: Version of the API to use (e.g., 'v1').
+#scopes: Define the level of access the application is requesting.
+#interactive: False on server code paths, see get_gmail_credentials.
+def create_gmail_service(api_name, api_version, *scopes, prefix ='', interactive=True):
+    API_SERCE_NAME = api_name
+    API_VERSION = api_version
+    SCOPES = [scope for scope in scopes[0]]
+    cache_key = (API_SERCE_NAME, API_VERSION, prefix)
+
+    creds = get_gmail_credentials(API_SERCE_NAME, API_VERSION, SCOPES, prefix, interactive)
+
+    #Reuse the service built earlier in this thread if it still uses the same credentials object.
+    services = getattr(_thread_services, 'services', None)
+    if services is None:
+        services = _thread_services.services = LRUCache(maxsize=SERVICES_PER_THREAD)
+    cached = services.get(cache_key)
+    if cached and cached[0] is creds:
+        return cached[1]
 
     #After all is done, build the service object.
     try:
-        #Build() fetches all the API discovery documents from Google API
         #Creates dynamic service objects that has methosds matching to the API structure.
-        service = build(API_SERCE_NAME, API_VERSION, credentials=creds)
+        #The discovery document comes from the cache, so no request is made to Google here.
+        discovery_document = _get_discovery_document(API_SERCE_NAME, API_VERSION)
+        if discovery_document:
+            service = build_from_document(discovery_document, credentials=creds)
+        else:
+            #Build() fetches all the API discovery documents from Google API
+            service = build(API_SERCE_NAME, API_VERSION, credentials=creds)
         print(f'{API_SERCE_NAME} service created successfully')
+        #The account key is used by the request scheduler to keep the quota of each account separate.
+        service.account_key = f'{API_SERCE_NAME}_{API_VERSION}{prefix}'
+        services[cache_key] = (creds, service)
         #After the service object is created, it will return a resource object with all the methods (all available endpoints with their parameters) for interacting with the service.
         return service
     except Exception as e:
         print(e)
         print(f'Failed to create servicw instance for {API_SERCE_NAME}')
-        os.remove(os.path.join(working_dir, token_dir, token_file))
-        return None
\ No newline at end of file
+        clear_gmail_service_cache(API_SERCE_NAME, API_VERSION, prefix)
+        token_path = _token_file_path(API_SERCE_NAME, API_VERSION, prefix)
+        if os.path.exists(token_path):
+            os.remove(token_path)
+        return None
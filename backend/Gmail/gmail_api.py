@@ -1,44 +1,168 @@
 import os
+import json
+import uuid
+import tempfile
+import mimetypes
+import sys
+import time
+import functools
+import weakref
 import base64
+import re
 
 #Email mime modules for creating and formatting email messages in Python. Provide classes for handling different parts of an email
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
+from email.message import Message as MIMEMessage
+import httplib2
+import httpx
+from google_auth_httplib2 import AuthorizedHttp, Request as AuthRequest
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
 from Google_API import create_gmail_service
+from gmail_scheduler import scheduler, is_retryable_error, QUOTA_UNITS, INTERACTIVE, BULK
 
-def initialize_gmail_service(api_name = 'gmail', api_version = 'v1', scopes = ['https://mail.google.com/']):
-    service = create_gmail_service(api_name, api_version, scopes)
+#The Message struct and the call metrics are shared with the Outlook adapter and the app, they live in backend/mailcore.
+#mailcore does not import the app package, so using this script does not load the app's settings.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.append(BACKEND_DIR)
+from mailcore.models import Attachment, Message, epoch_from_date_header
+from mailcore.metrics import metrics
+
+#Every call made through the scheduler is counted in the app metrics (GET /metrics).
+scheduler.on_call = functools.partial(metrics.record, 'gmail')
+
+#prefix selects the account (each account has its own token file), services are cached so this is cheap to call again.
+#interactive=False raises AuthorizationRequiredError instead of opening the browser when the account has to sign in.
+def initialize_gmail_service(api_name = 'gmail', api_version = 'v1', scopes = ['https://mail.google.com/'], prefix = '', interactive=True):
+    service = create_gmail_service(api_name, api_version, scopes, prefix=prefix, interactive=interactive)
     return service
 
-#Helper function to extract the body from email payload (data structure in email messages that contains the actual content of the email) (body text, headers, attachments ...)
-def extract_body(payload):
+#Every Gmail call goes through the shared request scheduler, which keeps the account under its quota and retries rate limited calls.
+#The account is identified by the account_key set by create_gmail_service (falls back to the service object itself).
+def _get_account_key(service):
+    return getattr(service, 'account_key', None) or id(service)
+
+def _execute(service, request, method, priority=BULK):
+    return scheduler.execute(request, method, _get_account_key(service), priority=priority)
+
+#Maximum number of bytes decoded for an email body, longer bodies are cut off at this size.
+MAX_BODY_BYTES = 1024 * 1024
+
+#Helper function to walk through every part of an email payload (data structure in email messages that contains the actual content of the email) (body text, headers, attachments ...)
+#Gmail API structures email content in parts, especially for multipart emails (HTML + plain text), and parts can be nested to any depth
+#e.g. multipart/mixed -> multipart/related -> multipart/alternative -> text/plain.
+#A stack is used instead of recursion, and parts are yielded in the same order as they appear in the email.
+def walk_payload_parts(payload):
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        yield part
+        stack.extend(reversed(part.get('parts', [])))
+
+#Helper function to read the value of a part header (case insensitive).
+def _get_part_header(part, name):
+    return next((header['value'] for header in part.get('headers', []) if header['name'].lower() == name), None)
+
+#Helper function to check if a part is an attachment (has a file name or an attachment Content-Disposition).
+def _is_attachment_part(part):
+    if part.get('filename'):
+        return True
+    disposition = _get_part_header(part, 'content-disposition') or ''
+    return disposition.lower().startswith('attachment')
 
+#Helper function to check if an attachment is shown inside the email body (e.g. an embedded image) rather than listed as a file.
+def _is_inline_part(part):
+    disposition = _get_part_header(part, 'content-disposition') or ''
+    return disposition.lower().startswith('inline')
+
+#This function lists every leaf part of the email without decoding any data.
+#Each item has the part ID, mime type, file name, size in bytes and the attachment ID to download it with (if any).
+def get_part_manifest(payload):
+    manifest = []
+    for part in walk_payload_parts(payload):
+        if part.get('mimeType', '').startswith('multipart/'):
+            continue
+        part_body = part.get('body', {})
+        manifest.append({
+            'part_id': part.get('partId', ''),
+            'mime_type': part.get('mimeType', 'application/octet-stream'),
+            'filename': part.get('filename') or None,
+            'size': part_body.get('size', 0),
+            'attachment_id': part_body.get('attachmentId'),
+            'is_attachment': _is_attachment_part(part),
+            'inline': _is_inline_part(part)
+        })
+    return manifest
+
+#Helper function to get the charset of a text part from its Content-Type header, e.g. 'text/plain; charset="iso-8859-1"'.
+def _get_part_charset(part):
+    content_type = _get_part_header(part, 'content-type')
+    if not content_type:
+        return None
+    header = MIMEMessage()
+    header['Content-Type'] = content_type
+    return header.get_content_charset()
+
+#Helper function to decode the base64 data of a part, decoding at most max_bytes bytes.
+#Only the needed prefix of the base64 string is decoded, so a huge part never gets decoded in full.
+def _decode_part_data(data, charset=None, max_bytes=MAX_BODY_BYTES):
+    #Every 4 base64 characters decode to 3 bytes.
+    encoded = data[:((max_bytes + 2) // 3) * 4]
+    encoded += '=' * (-len(encoded) % 4)
+    raw = base64.urlsafe_b64decode(encoded)[:max_bytes]
+    try:
+        return raw.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        #Unknown charset name in the email, fall back to UTF-8.
+        return raw.decode('utf-8', errors='replace')
+
+#Helper function to extract the body from email payload.
+#Picks the first inline text/plain part (or text/html if the email has no plain text version) at any nesting depth,
+#and decodes only that part using its own charset.
+def extract_body(payload, max_bytes=MAX_BODY_BYTES):
     #Default body: no text body is found
     body = '<Text body not available>'
 
-    #Checks if parts or body exists in the payload
-    #Gmail API structures email content in parts, especially for multipart emails (HTML + plain text)
-    #Sometimes it can have nested parts, Base64 encoded content.
-    #Multipart emails are the most common format used today, in this loop it will iterate through the parts to find the plain text version of the email body.
-    if 'parts' in payload:
-        for part in payload['parts']:
-            
-            if part['mimeType'] == 'multipart/alternative':
-                for subpart in part['parts']:
-                    if subpart['mimeType'] == 'text/plain' and 'data' in subpart['body']:
-                        body = base64.urlsafe_b64decode(subpart['body']['data']).decode('utf-8')
-                        break
-
-            elif part['mimeType'] == 'text/plain' and 'data' in part['body']:
-                body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                break
+    selected = None
+    for mime_type in ('text/plain', 'text/html'):
+        selected = next((part for part in walk_payload_parts(payload)
+                         if part.get('mimeType') == mime_type
+                         and 'data' in part.get('body', {})
+                         and not _is_attachment_part(part)), None)
+        if selected:
+            break
 
-    elif 'body' in payload and 'data' in payload['body']:
-        body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+    #Single part emails of any other type (e.g. text/calendar) still have their content in the payload body.
+    if not selected and 'data' in payload.get('body', {}):
+        selected = payload
+
+    if selected:
+        body = _decode_part_data(selected['body']['data'], _get_part_charset(selected), max_bytes)
     return body
 
+#Cache of folder name -> label ID per service object, so the labels list is not re-fetched on every call.
+#A WeakKeyDictionary is used so the cached labels are dropped together with the service object.
+_folder_label_cache = weakref.WeakKeyDictionary()
+
+#Function to find the label ID of a folder name (case insensitive) e.g. 'inbox' -> 'INBOX'.
+def resolve_folder_label_id(service, folder_name, user_id='me'):
+    labels_by_name = _folder_label_cache.setdefault(service, {}).get(user_id)
+
+    if labels_by_name is None or folder_name.lower() not in labels_by_name:
+        #Get all the user's gmail labels into a variable call label_results.
+        label_results = _execute(service, service.users().labels().list(userId=user_id), 'labels.list')
+        #Then from the label results, build a lookup of lower case label name to label ID.
+        labels_by_name = {label['name'].lower(): label['id'] for label in label_results.get('labels', [])}
+        _folder_label_cache[service][user_id] = labels_by_name
+
+    folder_label_id = labels_by_name.get(folder_name.lower())
+    if not folder_label_id:
+        raise ValueError(f'Folder name "{folder_name}" not found.')
+    return folder_label_id
+
 #Function to get email messages from Gmail API service, user_id represents the user account.
 #This function WILL ONLY fetch email_id and email thread ID.
 def get_email_messages(service, user_id='me', label_ids = None, folder_name = 'INBOX', max_results=5):
@@ -47,22 +171,11 @@ def get_email_messages(service, user_id='me', label_ids = None, folder_name = 'I
     #Use for pagination
     next_page_token = None
 
-    #Checks if the provided folder name exists.
+    #Checks if the provided folder name exists, the label ID is resolved once per service and then cached.
     if folder_name:
-        #Get all the user's gmail labels into a variable call label_results.
-        label_results = service.users().labels().list(userId=user_id).execute()
-        #Then from the label results, extract the labels into a list called labels.
-        labels = label_results.get('labels', [])
-
-        #Here I created a folder_label_id variable that uses a list comprehension to find the label ID that matches the provided folder name with case insensitivity.
-        folder_label_id = next((label['id'] for label in labels if label['name'].lower() == folder_name.lower()), None)
-        if folder_label_id:
-            if label_ids:
-                label_ids.append(folder_label_id)
-            else:
-                label_ids = [folder_label_id]
-        else:
-            raise ValueError(f'Folder name "{folder_name}" not found.')
+        folder_label_id = resolve_folder_label_id(service, folder_name, user_id)
+        #Copy the list so the caller's label_ids list is not modified.
+        label_ids = (label_ids or []) + [folder_label_id]
 
     #This while loop will continue fetching email messages until maximum results is reached or no more messages left.    
     while True:
@@ -75,7 +188,8 @@ def get_email_messages(service, user_id='me', label_ids = None, folder_name = 'I
             labelIds=label_ids,
             pageToken=next_page_token,
             maxResults=min(500, max_results - len(messages)) if max_results else 500
-        ).execute()
+        )
+        result = _execute(service, result, 'messages.list')
 
         #After the API call, extend the messages list with the retrieved messages from the result.
         #Then update the next_page_token to get the next set of messages in the next iteration.
@@ -90,101 +204,552 @@ def get_email_messages(service, user_id='me', label_ids = None, folder_name = 'I
     #This ensures we return the exact number of messages requested even if we retrieve more due to the batching process.
     return messages[:max_results] if max_results else messages   
 
+#Function to get the profile of the mailbox: emailAddress, messagesTotal, threadsTotal and historyId.
+def get_mailbox_profile(service, user_id='me'):
+    return _execute(service, service.users().getProfile(userId=user_id), 'getProfile')
+
+#Function to get the current historyId of the mailbox, this is the checkpoint incremental syncs start from.
+def get_mailbox_history_id(service, user_id='me'):
+    return get_mailbox_profile(service, user_id)['historyId']
+
+#This function returns only what changed in the mailbox since start_history_id using the Gmail history API.
+#With a folder_name only the changes of that folder are returned (same emails as a full sync of the folder):
+#an email moved into the folder (folder label added) is reported as added, and one moved out of it (label removed) as deleted.
+#The result is a dictionary with:
+#added: IDs of new messages, deleted: IDs of removed messages,
+#label_changes: message ID -> {'added': [...], 'removed': [...]} label IDs,
+#history_id: the new checkpoint to store for the next sync.
+#Raises HttpError 404 if start_history_id is too old (Gmail keeps history for about a week).
+def sync_email_changes(service, start_history_id, user_id='me', folder_name=None):
+    added = {}
+    deleted = set()
+    label_changes = {}
+    history_id = start_history_id
+    next_page_token = None
+    folder_label_id = resolve_folder_label_id(service, folder_name, user_id) if folder_name else None
+
+    while True:
+        result = service.users().history().list(
+            userId=user_id,
+            startHistoryId=start_history_id,
+            labelId=folder_label_id,
+            historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+            pageToken=next_page_token,
+            maxResults=500
+        )
+        result = _execute(service, result, 'history.list')
+
+        #History records come back oldest first, so later records override earlier ones for the same message.
+        for record in result.get('history', []):
+            for item in record.get('messagesAdded', []):
+                message_id = item['message']['id']
+                #Emails created outside the folder (e.g. sent or draft emails) are not part of it.
+                if folder_label_id and folder_label_id not in item['message'].get('labelIds', [folder_label_id]):
+                    continue
+                added[message_id] = True
+                deleted.discard(message_id)
+
+            for item in record.get('messagesDeleted', []):
+                message_id = item['message']['id']
+                added.pop(message_id, None)
+                label_changes.pop(message_id, None)
+                deleted.add(message_id)
+
+            for change_type, key in (('labelsAdded', 'added'), ('labelsRemoved', 'removed')):
+                for item in record.get(change_type, []):
+                    message_id = item['message']['id']
+                    #Moved into the folder: the email is fetched like a new one. Moved out of it: removed from the store.
+                    if folder_label_id in item.get('labelIds', []):
+                        if key == 'added':
+                            added[message_id] = True
+                            deleted.discard(message_id)
+                        else:
+                            added.pop(message_id, None)
+                            label_changes.pop(message_id, None)
+                            deleted.add(message_id)
+                    if message_id in deleted:
+                        continue
+                    change = label_changes.setdefault(message_id, {'added': [], 'removed': []})
+                    other = 'removed' if key == 'added' else 'added'
+                    for label_id in item.get('labelIds', []):
+                        #A label that was added and later removed (or the other way round) cancels out.
+                        if label_id in change[other]:
+                            change[other].remove(label_id)
+                        elif label_id not in change[key]:
+                            change[key].append(label_id)
+
+        history_id = result.get('historyId', history_id)
+        next_page_token = result.get('nextPageToken')
+        if not next_page_token:
+            break
+
+    #New messages are fetched in full anyway, so their label changes do not need to be reported separately.
+    label_changes = {message_id: change for message_id, change in label_changes.items()
+                     if message_id not in added and (change['added'] or change['removed'])}
+
+    return {
+        'added': list(added),
+        'deleted': list(deleted),
+        'label_changes': label_changes,
+        'history_id': history_id,
+        'full_resync': False
+    }
+
+#Helper functions to store the historyId checkpoint of a mailbox in a JSON file (same folder layout as the token files).
+def _sync_checkpoint_path(prefix=''):
+    sync_dir = os.path.join(os.getcwd(), 'sync_files')
+    if not os.path.exists(sync_dir):
+        os.mkdir(sync_dir)
+    return os.path.join(sync_dir, f'sync_gmail{prefix}.json')
+
+def load_sync_checkpoint(prefix=''):
+    checkpoint_path = _sync_checkpoint_path(prefix)
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r') as checkpoint_file:
+        return json.load(checkpoint_file).get('history_id')
+
+def save_sync_checkpoint(history_id, prefix=''):
+    checkpoint_path = _sync_checkpoint_path(prefix)
+    #Write to a temporary file first and then replace, so a crash never leaves a half written checkpoint.
+    with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+        json.dump({'history_id': history_id}, checkpoint_file)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+#This function performs a full resync: every message ID in the folder is reported as added.
+#The historyId is read BEFORE listing, so changes that happen during the listing are picked up by the next incremental sync.
+def full_email_sync(service, user_id='me', folder_name='INBOX'):
+    history_id = get_mailbox_history_id(service, user_id)
+    messages = get_email_messages(service, user_id=user_id, folder_name=folder_name, max_results=None)
+    return {
+        'added': [message['id'] for message in messages],
+        'deleted': [],
+        'label_changes': {},
+        'history_id': history_id,
+        'full_resync': True
+    }
+
+#This function asks Gmail to push a notification to a Cloud Pub/Sub topic whenever the mailbox changes,
+#so new emails are noticed without polling. topic_name looks like 'projects/<project>/topics/<topic>'.
+#The watch expires after about 7 days, so it has to be renewed (calling this function again renews it).
+#Returns {'historyId': ..., 'expiration': <epoch milliseconds>}.
+def start_gmail_watch(service, topic_name, label_ids=None, user_id='me'):
+    request = service.users().watch(userId=user_id, body={
+        'topicName': topic_name,
+        'labelIds': label_ids or ['INBOX'],
+        'labelFilterBehavior': 'INCLUDE'
+    })
+    return _execute(service, request, 'watch')
+
+#Function to stop the push notifications of the mailbox.
+def stop_gmail_watch(service, user_id='me'):
+    return _execute(service, service.users().stop(userId=user_id), 'stop')
+
+#This function returns the changes since start_history_id, or a full resync when there is no usable checkpoint.
+#A full resync is used when start_history_id is None, or when it has expired (404 from the history API).
+def get_email_changes(service, start_history_id, user_id='me', folder_name='INBOX'):
+    if start_history_id:
+        try:
+            return sync_email_changes(service, start_history_id, user_id, folder_name)
+        except HttpError as e:
+            if getattr(e.resp, 'status', None) != 404:
+                raise
+            print("Sync checkpoint has expired. Running a full resync.")
+
+    return full_email_sync(service, user_id, folder_name)
+
+#Incremental sync entry point, so a refresh only costs time proportional to what changed.
+#It loads the stored checkpoint, applies only the changes since then and saves the new checkpoint.
+#prefix identifies the account, same as the prefix used for the token file.
+def incremental_email_sync(service, user_id='me', folder_name='INBOX', prefix=''):
+    changes = get_email_changes(service, load_sync_checkpoint(prefix), user_id, folder_name)
+    save_sync_checkpoint(changes['history_id'], prefix)
+    return changes
+
 #This function will retrieve the full details of a specific email.
 #Takes in message_id as a parmeter to identify the email to fetch.
 def get_email_message_details(service, message_id, user_id='me'):
     #Use the Gmail API to get the full details of a specific email message using its unique message ID.
     #Using the provided message_id and format 'full' to get all details of the email.
-    message = service.users().messages().get(userId=user_id, id=message_id, format='full').execute()
+    #Opening an email is interactive, so it goes before bulk sync calls of the same account.
+    message = _execute(service, service.users().messages().get(userId=user_id, id=message_id, format='full'), 'messages.get', INTERACTIVE)
+    return parse_email_message(message)
+
+#Headers needed for the inbox list view, only these are requested in metadata mode.
+LIST_VIEW_HEADERS = ['Subject', 'From', 'To', 'Date']
+
+#Field mask for metadata mode, so the response only contains what the list view shows.
+LIST_VIEW_FIELDS = 'id,threadId,labelIds,snippet,internalDate,payload(mimeType,headers)'
+
+#Helper function to build a lookup of lower case header name -> value in a single pass over the headers.
+#If a header appears more than once, the first value is kept.
+def index_headers(headers):
+    header_values = {}
+    for header in headers:
+        header_values.setdefault(header['name'].lower(), header['value'])
+    return header_values
+
+#Helper function that turns a raw Gmail message resource into a Message (see mailcore/models.py).
+#Shared by the single and the bulk fetch functions so both return exactly the same shape.
+#For messages fetched in metadata mode (include_body=False) the body is None, it is fetched later when the email is opened.
+def parse_email_message(message, include_body=True):
+    message_id = message['id']
 
     #From the response, extract the payload from the message and retrieve the headers.
     #Headers contain improtant metadata such as subject, sender, recipient, date.
     payload = message['payload']
-    headers = payload.get('headers', [])
+    headers = index_headers(payload.get('headers', []))
 
-    #Here use list comprehension to find the header with teh name "subject" and extracct it's value.
-    subject = next((header['value'] for header in headers if header['name'].lower() == 'subject'), None)
+    #Here find the "subject" header and extract it's value.
+    subject = headers.get('subject')
     if not subject:
         subject = message.get('subject', 'No subject')
 
     #Extract all otther metadata with similar approach here.
-    sender = next((header['value'] for header in headers if header['name'].lower() == 'from'), 'Unknown sender')
-    recipient = next((header['value'] for header in headers if header['name'].lower() == 'to'), 'Unknown recipient(s)')
+    sender = headers.get('from', 'Unknown sender')
+    recipient = headers.get('to', 'Unknown recipient(s)')
     snippet = message.get('snippet', 'No snippet available')
     thread_id = message.get('threadId', message_id)
-    has_attachments = any(part.get('filename') for part in payload.get('parts', []) if part.get('filename'))
-    date = next((header['value'] for header in headers if header['name'].lower() == 'date'), 'No date available')
-    star = message.get('labelIds', []).count('STARRED') > 0
-    label = ' , '.join(message.get('labelIds', []))
-
-    #Using the extract_body function to get the body content from the email payload.
-    body = extract_body(payload)
-
-    email_details = {
-        'id': message_id,
-        'subject': subject,
-        'from': sender,
-        'to': recipient,
-        'snippet': snippet,
-        'thread_id': thread_id,
-        'body': body,
-        'has_attachments': has_attachments,
-        'date': date,
-        'starred': star,
-        'label': label
-    }
-    return email_details 
+    label_ids = tuple(message.get('labelIds', []))
+    star = 'STARRED' in label_ids
 
-#This function will send an email with attachments.
-def send_email_with_attachment(service, to, subject, body, body_type='plain', attachment_paths=None):
-    #First create the email, by creating a MIMEMultipart object to represent the email message that is about to send.
+    #The date is parsed from the Date header, Gmail's internalDate (epoch milliseconds) is used when it is missing or invalid.
+    date = epoch_from_date_header(headers.get('date'))
+    if not date and message.get('internalDate'):
+        date = int(message['internalDate']) // 1000
+
+    if include_body:
+        #The attachments are listed from the part manifest, at any nesting depth. Only their IDs are kept, the data is downloaded on demand.
+        attachments = tuple(
+            Attachment(
+                part_id=part['part_id'],
+                filename=part['filename'] or 'attachment',
+                mime_type=part['mime_type'],
+                size=part['size'],
+                attachment_id=part['attachment_id'],
+                inline=part['inline']
+            )
+            for part in get_part_manifest(payload) if part['is_attachment']
+        )
+        has_attachments = bool(attachments)
+        #Using the extract_body function to get the body content from the email payload.
+        body = extract_body(payload)
+    else:
+        #Metadata mode has no parts, an email with attachments is almost always multipart/mixed.
+        has_attachments = payload.get('mimeType') == 'multipart/mixed'
+        attachments = None
+        body = None
+
+    return Message(
+        id=message_id,
+        thread_id=thread_id,
+        subject=subject,
+        sender=sender,
+        recipient=recipient,
+        snippet=snippet,
+        body=body,
+        has_attachments=has_attachments,
+        date=date,
+        starred=star,
+        labels=label_ids,
+        attachments=attachments
+    )
+
+#This function retrieves only what the inbox list view needs (subject, from, to, date, snippet, labels) for one email.
+#It uses format 'metadata' with a field mask, so the body and inline parts are not downloaded.
+def get_email_message_summary(service, message_id, user_id='me'):
+    message = service.users().messages().get(
+        userId=user_id,
+        id=message_id,
+        format='metadata',
+        metadataHeaders=LIST_VIEW_HEADERS,
+        fields=LIST_VIEW_FIELDS
+    )
+    message = _execute(service, message, 'messages.get', INTERACTIVE)
+    return parse_email_message(message, include_body=False)
+
+#Raised by the bulk fetch functions when some emails could not be fetched (still rate limited after max_retries, or failed).
+#emails has the emails that were fetched (same as the normal return value) and failed_ids the IDs of the others,
+#so the caller can keep what was fetched and try the rest again.
+class BulkFetchError(Exception):
+    def __init__(self, emails, failed_ids):
+        super().__init__(f'{len(failed_ids)} emails could not be fetched.')
+        self.emails = emails
+        self.failed_ids = failed_ids
+
+#This function retrieves the full details of many emails at once using the Gmail batch endpoint.
+#Instead of one HTTP round-trip per email, up to batch_size (max 100) messages().get calls are sent in a single request.
+#Returns a list of Messages (same as get_email_message_details) in the same order as message_ids.
+#Emails deleted in the meantime (404) are left out. If other emails fail, the whole batch is still fetched and then BulkFetchError is raised.
+def get_email_message_details_bulk(service, message_ids, user_id='me', batch_size=100, max_retries=5):
+    return _get_messages_bulk(service, message_ids, user_id, batch_size, max_retries, include_body=True, format='full')
+
+#Same as get_email_message_details_bulk but in metadata mode (see get_email_message_summary), for the inbox list view.
+def get_email_message_summaries_bulk(service, message_ids, user_id='me', batch_size=100, max_retries=5):
+    return _get_messages_bulk(
+        service, message_ids, user_id, batch_size, max_retries, include_body=False,
+        format='metadata', metadataHeaders=LIST_VIEW_HEADERS, fields=LIST_VIEW_FIELDS
+    )
+
+#Helper function doing the batched messages().get calls, get_params are passed to every messages().get call.
+def _get_messages_bulk(service, message_ids, user_id, batch_size, max_retries, include_body, **get_params):
+    if batch_size < 1 or batch_size > 100:
+        raise ValueError("batch_size must be between 1 and 100")
+
+    #Store the details by message ID so the results can be returned in the requested order at the end.
+    results = {}
+    failed = []
+    pending = list(dict.fromkeys(message_ids))
+    attempt = 0
+    #googleapiclient rebuilds every resource object on each service.users() / .messages() call, so it is built once here.
+    messages_resource = service.users().messages()
+
+    while pending:
+        #Messages that hit the rate limit (or a server error) in this round, these are retried in the next round after a backoff.
+        rate_limited = []
+
+        #Callback for each message in the batch, it is called once per message when the batch response comes back.
+        def handle_response(request_id, response, exception):
+            if exception is None:
+                results[request_id] = parse_email_message(response, include_body=include_body)
+            elif is_retryable_error(exception):
+                rate_limited.append(request_id)
+            elif getattr(exception.resp, 'status', None) == 404:
+                print(f'Email {request_id} no longer exists, skipping it.')
+            else:
+                print(f'Failed to fetch email {request_id}: {exception}')
+                failed.append(request_id)
+
+        #Split the pending message IDs into chunks of batch_size and send each chunk as one batch request.
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=handle_response)
+            for message_id in chunk:
+                batch.add(
+                    messages_resource.get(userId=user_id, id=message_id, **get_params),
+                    request_id=message_id
+                )
+
+            #Every messages().get in the batch is charged separately, so the scheduler takes the quota of the whole chunk first.
+            units = QUOTA_UNITS['messages.get'] * len(chunk)
+            scheduler.acquire(_get_account_key(service), units, BULK)
+
+            #If the whole batch request is rate limited, retry all messages of this chunk.
+            started = time.monotonic()
+            try:
+                batch.execute()
+                scheduler.record_call('batch.messages.get', started, units)
+            except HttpError as e:
+                scheduler.record_call('batch.messages.get', started, units, e)
+                if not is_retryable_error(e):
+                    raise
+                rate_limited.extend(chunk)
+
+        pending = rate_limited
+        if pending:
+            attempt += 1
+            if attempt > max_retries:
+                print(f'Giving up on {len(pending)} emails after {max_retries} retries due to rate limiting.')
+                failed.extend(pending)
+                break
+            #Exponential backoff with random jitter before retrying the rate limited messages.
+            time.sleep(scheduler.backoff_delay(attempt))
+
+    emails = [results[message_id] for message_id in dict.fromkeys(message_ids) if message_id in results]
+    if failed:
+        raise BulkFetchError(emails, failed)
+    return emails
+
+#Attachment downloads are read from the response in chunks of this size (base64 text, 3/4 of it once decoded).
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+#Helper class decoding the base64url "data" string of an attachments.get response into output as the response arrives.
+#Only whole groups of 4 base64 characters are decoded, the rest is kept for the next chunk.
+class _AttachmentDataDecoder:
+    def __init__(self, output):
+        self._output = output
+        self._head = b''
+        self._pending = b''
+        self._in_data = False
+        self._done = False
+
+    def write(self, chunk):
+        if self._done:
+            return
+        if not self._in_data:
+            #The response starts with {"data": " (other fields are not requested), wait until it has arrived.
+            self._head += chunk
+            match = re.search(rb'"data"\s*:\s*"', self._head)
+            if match is None:
+                return
+            chunk = self._head[match.end():]
+            self._head = b''
+            self._in_data = True
+        end = chunk.find(b'"')
+        if end != -1:
+            chunk = chunk[:end]
+            self._done = True
+        data = self._pending + chunk
+        complete = len(data) - len(data) % 4
+        self._output.write(base64.urlsafe_b64decode(data[:complete]))
+        self._pending = data[complete:]
+
+    def close(self):
+        if self._in_data and not self._done:
+            raise ValueError('The attachment data in the response is incomplete.')
+        if self._pending:
+            self._output.write(base64.urlsafe_b64decode(self._pending + b'=' * (-len(self._pending) % 4)))
+
+#Helper function to get the Authorization header of a googleapiclient request, refreshing the credentials of its service if needed.
+#Services built without credentials send none.
+def _get_auth_headers(request):
+    headers = {}
+    if isinstance(request.http, AuthorizedHttp):
+        request.http.credentials.before_request(AuthRequest(request.http.http), 'GET', request.uri, headers)
+    return headers
+
+#This function downloads the data of one attachment with its attachment ID (from the part manifest) into output (a file opened in binary mode).
+#Gmail returns the attachment base64 encoded in a JSON response. googleapiclient reads whole responses, so its request is sent with httpx
+#and the response is decoded while it streams in: neither the response nor the attachment is ever fully in memory.
+#The call goes through the scheduler's quota and retries like every other Gmail call, nothing is written to output before a successful response.
+def download_attachment_data(service, message_id, attachment_id, output, user_id='me'):
+    request = service.users().messages().attachments().get(userId=user_id, messageId=message_id, id=attachment_id, fields='data')
+    method = 'messages.attachments.get'
+    units = QUOTA_UNITS[method]
+    attempt = 0
+    while True:
+        scheduler.acquire(_get_account_key(service), units, INTERACTIVE)
+        started = time.monotonic()
+        with httpx.stream('GET', request.uri, headers=_get_auth_headers(request), timeout=30.0) as response:
+            if not response.is_error:
+                decoder = _AttachmentDataDecoder(output)
+                for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    decoder.write(chunk)
+                decoder.close()
+                scheduler.record_call(method, started, units)
+                return
+            error = HttpError(httplib2.Response({'status': response.status_code, **response.headers}), response.read(), uri=request.uri)
+        scheduler.record_call(method, started, units, error)
+        if attempt >= scheduler.max_retries or not is_retryable_error(error, method):
+            raise error
+        time.sleep(scheduler.backoff_delay(attempt))
+        attempt += 1
+
+#This function downloads the attachment in part part_id of an email into output (a file opened in binary mode), returns its attachment_id.
+#Gmail attachment IDs change every time the email is fetched and old ones stop working after a while,
+#so when the stored attachment_id is missing or rejected, the email is fetched again to get the current ID of the part.
+#Small parts have their data in the email itself and no attachment ID, their data is decoded from the email.
+def download_attachment(service, message_id, part_id, output, attachment_id=None, user_id='me'):
+    if attachment_id:
+        try:
+            download_attachment_data(service, message_id, attachment_id, output, user_id)
+            return attachment_id
+        except HttpError as e:
+            if e.resp.status not in (400, 404):
+                raise
+
+    message = _execute(service, service.users().messages().get(userId=user_id, id=message_id, format='full'), 'messages.get', INTERACTIVE)
+    part = next((part for part in walk_payload_parts(message['payload']) if part.get('partId', '') == part_id), None)
+    if part is None:
+        raise KeyError(f"Email {message_id} has no part {part_id}.")
+    part_body = part.get('body', {})
+    if part_body.get('attachmentId'):
+        download_attachment_data(service, message_id, part_body['attachmentId'], output, user_id)
+        return part_body['attachmentId']
+    data = part_body.get('data', '')
+    output.write(base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)))
+    return None
+
+#Attachments are read and base64 encoded in chunks of this size.
+#57 bytes encode to exactly one 76 character base64 line, so every chunk ends on a complete line.
+ATTACHMENT_READ_CHUNK_SIZE = 57 * 1024
+
+#Messages bigger than this are sent with a resumable upload in chunks of this size (must be a multiple of 256 KB).
+#Smaller messages are sent in a single upload request.
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+
+#Helper function to guess the Content-Type of an attachment from its file name, e.g. report.pdf -> application/pdf.
+def _guess_mime_type(path):
+    mime_type, encoding = mimetypes.guess_type(str(path))
+    #Compressed files (e.g. .tar.gz) are sent as generic binary files.
+    if mime_type is None or encoding is not None:
+        return 'application', 'octet-stream'
+    return mime_type.split('/', 1)
+
+#Helper function that writes the MIME message to the output file without loading the attachments into memory.
+#The headers of each part are built with the email library, and the attachment data is streamed from disk and base64 encoded chunk by chunk.
+def _write_mime_message(output, to, subject, body, body_type, attachment_paths):
+    #Create a MIMEMultipart object for the headers of the email, its parts are written one by one below.
     message = MIMEMultipart()
     message['to'] = to
     message['subject'] = subject
+    boundary = f'==============={uuid.uuid4().hex}=='
+    message.set_boundary(boundary)
+    #Only the headers of the (still empty) multipart message are written, they end at the first blank line.
+    header_bytes = message.as_bytes()
+    output.write(header_bytes[:header_bytes.index(b'\n\n') + 2])
 
+    #Attach the email body to the message object using MIMEText, along by specifying the body type.
+    text_part = MIMEText(body, body_type.lower())
+    del text_part['MIME-Version']
+    output.write(f'--{boundary}\n'.encode())
+    output.write(text_part.as_bytes())
+    output.write(b'\n')
+
+    for attachment_path in attachment_paths or []:
+        #Extract the filename.
+        filename = os.path.basename(attachment_path)
+
+        #Creates a MIME part with the guessed type, e.g. application/pdf or image/png.
+        part = MIMEBase(*_guess_mime_type(attachment_path))
+        del part['MIME-Version']
+        part['Content-Transfer-Encoding'] = 'base64'
+        #Add a header to the attachment part to indicate it's an attachment with the filename.
+        part.add_header('Content-Disposition', 'attachment', filename=filename)
+        output.write(f'--{boundary}\n'.encode())
+        output.write(part.as_bytes())
+
+        #Open the file in binary read mode (rb) and encode it chunk by chunk into the output file.
+        with open(attachment_path, 'rb') as attachment_file:
+            while True:
+                chunk = attachment_file.read(ATTACHMENT_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output.write(base64.encodebytes(chunk))
+
+    output.write(f'--{boundary}--\n'.encode())
+
+#This function will send an email with attachments.
+#The email is written to a temporary file on disk and uploaded to Gmail as message/rfc822 media, in chunks for big emails.
+#So the attachments are never fully loaded in memory, instead of the raw message being base64 encoded twice in memory.
+def send_email_with_attachment(service, to, subject, body, body_type='plain', attachment_paths=None):
     #Validates the body_type input, ensures that it is either plain or HTML.
     if body_type.lower() not in ['plain', 'html']:
         raise ValueError("body_type must be either 'plain' or 'html'")
-    
-    #Attach the email body to the message object using MIMEText, along by specifying the body type.
-    message.attach(MIMEText(body, body_type.lower()))
-
-    #This block will check for the attachment paths provided.
-    if attachment_paths:
-        #Iterate through each attachment path to attach files to the email.
-        for attachment_path in attachment_paths:
-            #For each attachment found, first check if the file exists.
-            if os.path.exists(attachment_path):
-                #Extract the filename.
-                filename = os.path.basename(attachment_path)
-
-                #Open the file in binary read mode (rb) to read it's content.
-                with open(attachment_path, 'rb') as attachment_file:
-                    #Creates a MIME part with type application/octet-stream, which is a generic binary file type.
-                    part = MIMEBase('application', 'octet-stream')
-                    #Reads the entire file and set it as the payload.
-                    part.set_payload(attachment_file.read())
-
-                #NExt step is to encode the payload using Base64 encoding.
-                #This ensures the data remains safe during email transmission.
-                encoders.encode_base64(part)
-
-                #THen add a header to the attachment part to indicate it's an attachment with the filename.   
-                part.add_header("Content-Disposition", f'attachment; filename="{filename}"')
-                
-                #After everything attach the part to the main message object.
-                message.attach(part)
 
-            else:
-                raise FileNotFoundError(f"Attachment file '{attachment_path}' not found.")
+    #For each attachment, first check if the file exists before anything is written or sent.
+    for attachment_path in attachment_paths or []:
+        if not os.path.exists(attachment_path):
+            raise FileNotFoundError(f"Attachment file '{attachment_path}' not found.")
+
+    with tempfile.TemporaryFile() as message_file:
+        _write_mime_message(message_file, to, subject, body, body_type, attachment_paths)
+        message_size = message_file.tell()
+        message_file.seek(0)
 
-    #First encode the entire message as a url save base64 string.        
-    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+        media = MediaIoBaseUpload(
+            message_file,
+            mimetype='message/rfc822',
+            chunksize=UPLOAD_CHUNK_SIZE,
+            resumable=message_size > UPLOAD_CHUNK_SIZE
+        )
 
-    #Use the Gmail API to send the email message.
-    sent_message = service.users().messages().send(
-        userId='me',
-        body={'raw': raw_message}
-    ).execute()
+        #Use the Gmail API to send the email message.
+        sent_message = service.users().messages().send(
+            userId='me',
+            media_body=media
+        )
+        #Sending is interactive, so it goes before bulk sync calls of the same account.
+        sent_message = _execute(service, sent_message, 'messages.send', INTERACTIVE)
 
     return sent_message
@@ -0,0 +1,165 @@
+#This script contains the request scheduler that every Gmail API call in gmail_api.py goes through.
+#It keeps each account under Gmail's per-user quota, retries rate limited and failed calls with backoff,
+#and lets interactive calls (sending or opening an email) go before bulk sync calls.
+import time
+import random
+import threading
+from collections import defaultdict
+from googleapiclient.errors import HttpError
+
+#Quota units charged by Gmail for each method (https://developers.google.com/gmail/api/reference/quota).
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'labels.list': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.attachments.get': 5,
+    'messages.send': 100,
+    'watch': 100,
+    'stop': 50
+}
+DEFAULT_QUOTA_UNITS = 5
+
+#Gmail allows 250 quota units per user per second.
+PER_USER_UNITS_PER_SECOND = 250
+
+#Priority lanes, interactive calls are always served before bulk calls of the same account.
+INTERACTIVE = 0
+BULK = 1
+
+#Helper function to check if an HttpError from the Gmail API is a rate limit error.
+#Gmail reports rate limits either as 429 or as 403 with a rateLimitExceeded / userRateLimitExceeded reason.
+def is_rate_limit_error(error):
+    status = getattr(error.resp, 'status', None)
+    if status == 429:
+        return True
+    if status == 403:
+        reasons = [detail.get('reason') for detail in (error.error_details or []) if isinstance(detail, dict)]
+        return any(reason in ('rateLimitExceeded', 'userRateLimitExceeded') for reason in reasons)
+    return False
+
+#Methods that are not safe to repeat: after a server error (5xx) Gmail may still have sent the email, so retrying could
+#send it twice. They are only retried when rate limited, as rate limited calls are rejected before they are processed.
+NON_IDEMPOTENT_METHODS = ('messages.send',)
+
+#Helper function to check if a failed call is worth retrying: rate limits, and server errors (5xx) of idempotent methods.
+def is_retryable_error(error, method=None):
+    if is_rate_limit_error(error):
+        return True
+    status = getattr(error.resp, 'status', None)
+    return method not in NON_IDEMPOTENT_METHODS and status is not None and int(status) >= 500
+
+#Token bucket of one account: it fills up at `rate` quota units per second, up to `capacity` units.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    #Calls costing more than the bucket can hold (e.g. a batch of 100 messages.get) wait for a full bucket
+    #and leave it in debt, so the following calls wait until the account is back under its quota.
+    def needed(self, units):
+        return min(units, self.capacity)
+
+    def seconds_until(self, units):
+        return max(0.0, (self.needed(units) - self.tokens) / self.rate)
+
+class GmailRequestScheduler:
+    def __init__(self, units_per_second=PER_USER_UNITS_PER_SECOND, burst=PER_USER_UNITS_PER_SECOND,
+                 max_retries=5, base_delay=1.0, max_delay=32.0):
+        self.units_per_second = units_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._condition = threading.Condition()
+        self._buckets = {}
+        #Number of interactive calls waiting per account, bulk calls of that account wait while it is not zero.
+        self._waiting_interactive = defaultdict(int)
+        #Optional function called after every call with (method, seconds, quota_units=, error=, throttled=), e.g. to collect metrics.
+        self.on_call = None
+
+    def _get_bucket(self, account):
+        bucket = self._buckets.get(account)
+        if bucket is None:
+            bucket = self._buckets[account] = TokenBucket(self.units_per_second, self.burst)
+        return bucket
+
+    #Takes the quota units for the call if the account has them. Returns 0 when they were taken, otherwise the
+    #number of seconds to wait before trying again. Must be called with the condition held.
+    def _take(self, account, units, priority):
+        bucket = self._get_bucket(account)
+        bucket.refill()
+        blocked = priority == BULK and self._waiting_interactive[account] > 0
+        if not blocked and bucket.tokens >= bucket.needed(units):
+            bucket.tokens -= units
+            return 0
+        return bucket.seconds_until(units) or 0.05
+
+    #Blocks until the account has enough quota units for the call, then takes them.
+    def acquire(self, account, units, priority=BULK):
+        with self._condition:
+            if priority == INTERACTIVE:
+                self._waiting_interactive[account] += 1
+            try:
+                while True:
+                    wait = self._take(account, units, priority)
+                    if not wait:
+                        return
+                    #A bulk call blocked by interactive calls is woken up by notify_all when they are done.
+                    self._condition.wait(timeout=wait)
+            finally:
+                if priority == INTERACTIVE:
+                    self._waiting_interactive[account] -= 1
+                    self._condition.notify_all()
+
+    #Same as acquire without blocking, for async callers (app/fetcher.py) that wait with their own sleep.
+    #Returns 0 when the units were taken, otherwise the number of seconds to wait before calling it again.
+    def try_acquire(self, account, units, priority=BULK):
+        with self._condition:
+            return self._take(account, units, priority)
+
+    #Exponential backoff with full jitter: a random delay between 0 and base_delay * 2^attempt (capped at max_delay).
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    #Reports a finished call to on_call. started is the time.monotonic() value taken before the call.
+    def record_call(self, method, started, units, error=None):
+        if self.on_call is not None:
+            self.on_call(
+                method,
+                time.monotonic() - started,
+                quota_units=units,
+                error=error is not None,
+                throttled=error is not None and is_rate_limit_error(error)
+            )
+
+    #Executes a googleapiclient request for the account once it has quota, retrying rate limited and 5xx errors
+    #(only rate limited errors for NON_IDEMPOTENT_METHODS).
+    #method is the Gmail method name used to look up its quota cost, e.g. 'messages.get'.
+    def execute(self, request, method, account, priority=BULK, units=None):
+        units = units or QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS)
+        attempt = 0
+        while True:
+            self.acquire(account, units, priority)
+            started = time.monotonic()
+            try:
+                response = request.execute()
+                self.record_call(method, started, units)
+                return response
+            except HttpError as e:
+                self.record_call(method, started, units, e)
+                if attempt >= self.max_retries or not is_retryable_error(e, method):
+                    raise
+                time.sleep(self.backoff_delay(attempt))
+                attempt += 1
+
+#Scheduler shared by every Gmail call in this process, so all calls of an account share the same quota.
+scheduler = GmailRequestScheduler()
@@ -1,4 +1,5 @@
-from gmail_api import initialize_gmail_service, get_email_messages, get_email_message_details
+from datetime import datetime, timezone
+from gmail_api import initialize_gmail_service, get_email_messages, get_email_message_details_bulk
 
 service = initialize_gmail_service()
 
@@ -6,19 +7,19 @@ emails = get_email_messages(service, max_results=1)
 
 print(f"\nFetching details for {len(emails)} emails...\n")
 
-for email in emails:
-    #Fetch full details for each email to get subject, snippet, etc.
-    details = get_email_message_details(service, email['id'])
+#Fetch full details for all emails in batches to get subject, snippet, etc.
+all_details = get_email_message_details_bulk(service, [email['id'] for email in emails])
 
-    print(f"Email ID: {details['id']}")
-    print(f"Thread ID: {details['thread_id']}")
-    print(f"From: {details['from']}")
-    print(f"To: {details['to']}")
-    print(f"Subject: {details['subject']}")
-    print(f"Body: {details['body']}")
-    print(f"Date: {details['date']}")
-    print(f"Snippet: {details['snippet']}")
-    print(f"Starred: {details['starred']}")
-    print(f"Has Attachments: {details['has_attachments']}")
-    print(f"Labels: {details['label']}")
+for details in all_details:
+    print(f"Email ID: {details.id}")
+    print(f"Thread ID: {details.thread_id}")
+    print(f"From: {details.sender}")
+    print(f"To: {details.recipient}")
+    print(f"Subject: {details.subject}")
+    print(f"Body: {details.body}")
+    print(f"Date: {datetime.fromtimestamp(details.date, tz=timezone.utc)}")
+    print(f"Snippet: {details.snippet}")
+    print(f"Starred: {details.starred}")
+    print(f"Has Attachments: {details.has_attachments}")
+    print(f"Labels: {', '.join(details.labels)}")
     print("-" * 80)
\ No newline at end of file
@@ -1,48 +1,127 @@
 #This script contains the function to generate user access token to connect to Microsoft Graph API using OAuth2 authentication.
 import os
+import threading
 import webbrowser
 import msal
 
 MS_GRAPH_BASE_ENDPOINT = 'https://graph.microsoft.com/v1.0/'
 
+#msal keeps access tokens and refresh tokens in a token cache, which is saved to this file so it survives restarts.
+#Each account (username) has its own cache file next to it, e.g. msal_token_cache_alice@example.com.json.
+TOKEN_CACHE_FILE = os.getenv('MSAL_TOKEN_CACHE_FILE') or 'msal_token_cache.json'
+
+#Token caches, msal client applications and locks are kept per account, like the per-account token files of Google_API.py.
+#Several worker processes share the cache files: a process only writes the file of the account it refreshed,
+#and reloads a cache file when another process replaced it, so processes do not overwrite each other's tokens.
+_token_caches = {}
+_token_cache_mtimes = {}
+_clients = {}
+#Only one thread acquires a token for an account at a time, so concurrent refreshes of that account are coalesced into one.
+#Other accounts are not blocked by it.
+_account_locks = {}
+_account_locks_lock = threading.Lock()
+
+#Raised instead of starting the interactive sign in when interactive=False (server code paths).
+class AuthorizationRequiredError(Exception):
+    pass
+
+def _get_account_lock(username):
+    with _account_locks_lock:
+        return _account_locks.setdefault(username, threading.Lock())
+
+def _token_cache_path(username):
+    if not username:
+        return TOKEN_CACHE_FILE
+    root, extension = os.path.splitext(TOKEN_CACHE_FILE)
+    return f'{root}_{username}{extension}'
+
+#Loads the token cache of the account, and loads it again whenever its file was replaced since (e.g. by another worker).
+#Accounts that signed in before the caches were kept per account are read from the shared cache file.
+#Must be called with the account lock held.
+def _load_token_cache(username):
+    cache = _token_caches.get(username)
+    if cache is None:
+        cache = _token_caches[username] = msal.SerializableTokenCache()
+
+    path = _token_cache_path(username)
+    if not os.path.exists(path):
+        path = TOKEN_CACHE_FILE
+    if os.path.exists(path):
+        mtime = os.path.getmtime(path)
+        if _token_cache_mtimes.get(username) != (path, mtime):
+            with open(path, 'r') as file:
+                cache.deserialize(file.read())
+            _token_cache_mtimes[username] = (path, mtime)
+    return cache
+
+#Write the token cache back to the account's file only when msal changed it (new or refreshed tokens).
+#It writes to a temporary file first and then replaces the file, so another process never reads a half written cache.
+def _save_token_cache(username, cache):
+    if cache.has_state_changed:
+        path = _token_cache_path(username)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(cache.serialize())
+        os.replace(temp_path, path)
+        _token_cache_mtimes[username] = (path, os.path.getmtime(path))
+
+def _get_client(app_id, client_secret, username, cache):
+    client = _clients.get((app_id, username))
+    if client is None:
+        #ConfidentialClientApplication is used here since it is a web app where client secrets can be securely stored in.
+        client = msal.ConfidentialClientApplication(
+            client_id = app_id,
+            client_credential = client_secret,
+            authority = 'https://login.microsoftonline.com/common',
+            token_cache = cache
+        )
+        _clients[(app_id, username)] = client
+    return client
+
 #This function will handle the authentication process and return an access token for the Microsoft Graph API
-def get_access_token(app_id, client_secret, scopes):
-    #ConfidentialClientApplication is used here since it is a web app where client secrets can be securely stored in.
-    client = msal.ConfidentialClientApplication(
-        client_id = app_id,
-        client_credential = client_secret,
-        authority = 'https://login.microsoftonline.com/common'
-    )
-
-    #Check if there is a refresh token stored.
-    refresh_token = None
-    if os.path.exists('refresh_token.txt'):
-        with open ('refresh_token.txt', 'r') as file:
-            refresh_token = file.read().strip()
-
-    if refresh_token:
-        #If refresh token exists, try to acquire a new token using the refresh token
-        token_response = client.acquire_token_by_refresh_token(refresh_token, scopes = scopes)
-    else:
-        #Perform authorization flow if no refresh token found
-        auth_request_url = client.get_authorization_request_url(scopes)
-        webbrowser.open(auth_request_url)
-        authorization_code = input('Enter the authorization code: ')
+#username selects the account when more than one account has signed in, by default the first account is used.
+#When the account has no valid token, interactive=True opens the sign in page and asks for the authorization code,
+#interactive=False raises AuthorizationRequiredError instead (the app never waits for input).
+def get_access_token(app_id, client_secret, scopes, username=None, interactive=True):
+    with _get_account_lock(username):
+        cache = _load_token_cache(username)
+        client = _get_client(app_id, client_secret, username, cache)
+
+        #First try the token cache. acquire_token_silent returns the cached access token while it is valid
+        #and uses the cached refresh token to get a new one shortly before it expires.
+        token_response = None
+        accounts = client.get_accounts(username=username)
+        if accounts:
+            token_response = client.acquire_token_silent(scopes, account=accounts[0])
+
+        if not token_response:
+            #Check if there is a refresh token stored by older versions of this script, it is moved into the token cache.
+            refresh_token = None
+            if os.path.exists('refresh_token.txt'):
+                with open ('refresh_token.txt', 'r') as file:
+                    refresh_token = file.read().strip()
+
+            if refresh_token:
+                #If refresh token exists, try to acquire a new token using the refresh token
+                token_response = client.acquire_token_by_refresh_token(refresh_token, scopes = scopes)
+                if 'access_token' in token_response:
+                    os.remove('refresh_token.txt')
+            elif not interactive:
+                raise AuthorizationRequiredError(f'No valid token for Outlook account {username or "(default)"}, it has to sign in again.')
+            else:
+                #Perform authorization flow if no refresh token found
+                auth_request_url = client.get_authorization_request_url(scopes)
+                webbrowser.open(auth_request_url)
+                authorization_code = input('Enter the authorization code: ')
 
-        if not authorization_code:
-            raise ValueError("Authorization code is empty")
-        
-        token_response = client.acquire_token_by_authorization_code(code = authorization_code, scopes = scopes)
+                if not authorization_code:
+                    raise ValueError("Authorization code is empty")
+
+                token_response = client.acquire_token_by_authorization_code(code = authorization_code, scopes = scopes)
+
+        _save_token_cache(username, cache)
 
     if 'access_token' in token_response:
-        if 'refresh_token' in token_response:
-            with open('refresh_token.txt', 'w') as file:
-                file.write(token_response['refresh_token'])
-            
         return token_response['access_token']
     else:
         raise Exception("Failed to acquire access token: " + str(token_response))
-    
-
-
-    
\ No newline at end of file
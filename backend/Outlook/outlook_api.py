@@ -0,0 +1,349 @@
+#This script contains the functions to work with Outlook emails through the Microsoft Graph API.
+#It is the Outlook counterpart of gmail_api.py and returns the same Message structs.
+import os
+import sys
+import time
+import random
+from datetime import datetime, timedelta, timezone
+
+import httpx
+from Microsoft_API import MS_GRAPH_BASE_ENDPOINT
+
+#The Message struct and the call metrics are shared with the Gmail adapter and the app, they live in backend/mailcore.
+#mailcore does not import the app package, so using this script does not load the app's settings.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.append(BACKEND_DIR)
+from mailcore.models import Attachment, Message, UNKNOWN_DATE
+from mailcore.metrics import metrics, graph_method_name
+
+#Fields requested from Microsoft Graph for each message, so only the data we actually use is downloaded.
+MESSAGE_SELECT_FIELDS = 'id,conversationId,subject,from,toRecipients,bodyPreview,body,hasAttachments,receivedDateTime,flag,isRead,categories'
+
+#Same fields without the body, for the inbox list view. The body is fetched when the email is opened.
+LIST_VIEW_SELECT_FIELDS = 'id,conversationId,subject,from,toRecipients,bodyPreview,hasAttachments,receivedDateTime,flag,isRead,categories'
+
+#Attachments listed with the full message (name, type and size only, the content is downloaded on demand).
+ATTACHMENT_EXPAND = 'attachments($select=id,name,contentType,size,isInline)'
+
+#Maximum number of characters kept of an email body, longer bodies are cut off (same limit as MAX_BODY_BYTES in gmail_api.py).
+MAX_BODY_CHARS = 1024 * 1024
+
+#Attachment content is written to the output file in chunks of this size.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+#Microsoft Graph accepts at most 20 requests in one $batch request.
+GRAPH_BATCH_SIZE = 20
+
+#Graph subscriptions on messages last at most 10080 minutes (7 days), a little less is requested to be safe.
+SUBSCRIPTION_MINUTES = 10000
+
+#Status codes returned when Graph is throttling or temporarily unavailable, these requests are retried.
+#Only reads are sent through graph_request and the $batch endpoint, so retrying after a server error is safe.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+#Helper function to format a Graph emailAddress object as "Name <address>", same as a Gmail From/To header.
+def _format_email_address(recipient):
+    email_address = (recipient or {}).get('emailAddress', {})
+    name = email_address.get('name')
+    address = email_address.get('address')
+    if name and address and name != address:
+        return f'{name} <{address}>'
+    return address or name
+
+#Helper function to turn the expanded attachments of a Graph message into Attachments.
+#Reference attachments (links to OneDrive files) have no content to download, so they are left out.
+def _parse_outlook_attachments(message):
+    if 'attachments' not in message:
+        return None
+    return tuple(
+        Attachment(
+            part_id=attachment['id'],
+            filename=attachment.get('name') or 'attachment',
+            mime_type=attachment.get('contentType') or 'application/octet-stream',
+            size=attachment.get('size', 0),
+            attachment_id=attachment['id'],
+            inline=bool(attachment.get('isInline'))
+        )
+        for attachment in message['attachments']
+        if attachment.get('@odata.type') != '#microsoft.graph.referenceAttachment'
+    )
+
+#This function turns a Microsoft Graph message resource into the same Message that get_email_message_details in gmail_api.py returns.
+#So the rest of the app does not need to know which provider an email came from.
+def parse_outlook_message(message):
+    message_id = message['id']
+
+    sender = _format_email_address(message.get('from')) or 'Unknown sender'
+    recipients = [_format_email_address(recipient) for recipient in message.get('toRecipients', [])]
+    recipient = ', '.join(address for address in recipients if address) or 'Unknown recipient(s)'
+
+    #Graph returns ISO 8601 dates in UTC, e.g. 2024-01-01T10:00:00Z.
+    date = UNKNOWN_DATE
+    if message.get('receivedDateTime'):
+        date = int(datetime.fromisoformat(message['receivedDateTime'].replace('Z', '+00:00')).timestamp())
+
+    #Outlook has no labels, the closest things are categories and the read state.
+    labels = list(message.get('categories', []))
+    if message.get('isRead') is False:
+        labels.append('UNREAD')
+
+    #The body is None when it was not selected (list view), it is fetched later when the email is opened.
+    body = None
+    if 'body' in message:
+        body = ((message.get('body') or {}).get('content') or '<Text body not available>')[:MAX_BODY_CHARS]
+
+    return Message(
+        id=message_id,
+        thread_id=message.get('conversationId', message_id),
+        subject=message.get('subject') or 'No subject',
+        sender=sender,
+        recipient=recipient,
+        snippet=message.get('bodyPreview') or 'No snippet available',
+        body=body,
+        has_attachments=bool(message.get('hasAttachments')),
+        date=date,
+        starred=(message.get('flag') or {}).get('flagStatus') == 'flagged',
+        labels=tuple(labels),
+        #Only set when the attachments were expanded (full message), None otherwise.
+        attachments=_parse_outlook_attachments(message)
+    )
+
+#Function to create an HTTP session for the Microsoft Graph API with the user's access token (see get_access_token in Microsoft_API.py).
+#The session keeps connections open between calls, it is the Outlook equivalent of the Gmail service object.
+def initialize_outlook_session(access_token):
+    return httpx.Client(
+        base_url=MS_GRAPH_BASE_ENDPOINT,
+        headers={
+            'Authorization': 'Bearer ' + access_token,
+            #Ask Graph for plain text bodies, same as the text/plain part extracted for Gmail.
+            'Prefer': 'outlook.body-content-type="text"'
+        },
+        timeout=30.0
+    )
+
+#Helper function to work out how long to wait before retrying a throttled request.
+#Graph sends a Retry-After header (in seconds) when it throttles, otherwise exponential backoff with jitter is used.
+def _get_retry_delay(headers, attempt):
+    retry_after = (headers or {}).get('Retry-After') or (headers or {}).get('retry-after')
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 32) + random.random()
+
+#Helper function to send a request to Graph and return the JSON response, retrying throttled requests.
+def graph_request(session, method, url, max_retries=5, **kwargs):
+    for attempt in range(max_retries + 1):
+        started = time.monotonic()
+        response = session.request(method, url, **kwargs)
+        #Every call is counted in the app metrics (GET /metrics), Graph has no quota units.
+        metrics.record(
+            'outlook',
+            graph_method_name(method, url),
+            time.monotonic() - started,
+            error=response.is_error,
+            throttled=response.status_code == 429
+        )
+        if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+            time.sleep(_get_retry_delay(response.headers, attempt + 1))
+            continue
+        response.raise_for_status()
+        return response.json() if response.content else {}
+
+#Function to get email messages from an Outlook folder, it WILL ONLY fetch the email ID and thread (conversation) ID.
+#Pages through the results with $top and the @odata.nextLink returned by Graph.
+def get_email_messages(session, folder_name='inbox', max_results=5):
+    messages = []
+    url = f'me/mailFolders/{folder_name}/messages'
+    params = {'$select': 'id,conversationId', '$top': min(1000, max_results) if max_results else 1000}
+
+    while url:
+        result = graph_request(session, 'GET', url, params=params)
+        messages.extend({'id': message['id'], 'threadId': message.get('conversationId')} for message in result.get('value', []))
+
+        #The next link already contains all query parameters.
+        url = result.get('@odata.nextLink')
+        params = None
+        if max_results and len(messages) >= max_results:
+            break
+
+    return messages[:max_results] if max_results else messages
+
+#This function will retrieve the full details of a specific email.
+def get_email_message_details(session, message_id):
+    message = graph_request(session, 'GET', f'me/messages/{message_id}', params={'$select': MESSAGE_SELECT_FIELDS, '$expand': ATTACHMENT_EXPAND})
+    return parse_outlook_message(message)
+
+#This function downloads the content of an attachment into output (a file opened in binary mode).
+#The $value endpoint returns the raw bytes, they are streamed to output so the attachment is never fully in memory.
+def download_attachment(session, message_id, attachment_id, output, max_retries=5):
+    url = f'me/messages/{message_id}/attachments/{attachment_id}/$value'
+    for attempt in range(max_retries + 1):
+        started = time.monotonic()
+        with session.stream('GET', url) as response:
+            #Recorded when the headers arrive, the time spent streaming depends on the attachment size.
+            metrics.record(
+                'outlook',
+                graph_method_name('GET', url),
+                time.monotonic() - started,
+                error=response.is_error,
+                throttled=response.status_code == 429
+            )
+            if response.status_code in RETRY_STATUS_CODES and attempt < max_retries:
+                time.sleep(_get_retry_delay(response.headers, attempt + 1))
+                continue
+            if response.is_error:
+                response.read()
+                response.raise_for_status()
+            for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                output.write(chunk)
+            return
+
+#Raised by get_email_message_details_bulk when some emails could not be fetched (still throttled after max_retries, or failed).
+#emails has the emails that were fetched (same as the normal return value) and failed_ids the IDs of the others,
+#so the caller can keep what was fetched and try the rest again (same as BulkFetchError in gmail_api.py).
+class BulkFetchError(Exception):
+    def __init__(self, emails, failed_ids):
+        super().__init__(f'{len(failed_ids)} emails could not be fetched.')
+        self.emails = emails
+        self.failed_ids = failed_ids
+
+#This function retrieves the details of many emails at once using the Graph $batch endpoint (20 requests per batch).
+#Returns a list of Messages in the same order as message_ids.
+#Throttled requests are retried after the Retry-After delay. Emails deleted in the meantime (404) are left out.
+#If other emails fail, the whole list is still fetched and then BulkFetchError is raised.
+def get_email_message_details_bulk(session, message_ids, batch_size=GRAPH_BATCH_SIZE, max_retries=5, select_fields=MESSAGE_SELECT_FIELDS):
+    if batch_size < 1 or batch_size > GRAPH_BATCH_SIZE:
+        raise ValueError(f"batch_size must be between 1 and {GRAPH_BATCH_SIZE}")
+
+    #Full messages (with the body) also list their attachments.
+    query = f'$select={select_fields}'
+    if 'body' in select_fields.split(','):
+        query += f'&$expand={ATTACHMENT_EXPAND}'
+
+    results = {}
+    failed = []
+    pending = list(dict.fromkeys(message_ids))
+    attempt = 0
+
+    while pending:
+        throttled = []
+        retry_delay = 0
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch_body = {
+                'requests': [
+                    {
+                        'id': str(index),
+                        'method': 'GET',
+                        'url': f'/me/messages/{message_id}?{query}',
+                        'headers': {'Prefer': 'outlook.body-content-type="text"'}
+                    }
+                    for index, message_id in enumerate(chunk)
+                ]
+            }
+            result = graph_request(session, 'POST', '$batch', json=batch_body)
+
+            #Each response has the id of its request, responses can come back in any order.
+            for response in result.get('responses', []):
+                message_id = chunk[int(response['id'])]
+                if response.get('status') == 200:
+                    results[message_id] = parse_outlook_message(response['body'])
+                elif response.get('status') in RETRY_STATUS_CODES:
+                    throttled.append(message_id)
+                    retry_delay = max(retry_delay, _get_retry_delay(response.get('headers'), attempt + 1))
+                elif response.get('status') == 404:
+                    print(f'Email {message_id} no longer exists, skipping it.')
+                else:
+                    print(f"Failed to fetch email {message_id}: {response.get('status')} {response.get('body')}")
+                    failed.append(message_id)
+
+        pending = throttled
+        if pending:
+            attempt += 1
+            if attempt > max_retries:
+                print(f'Giving up on {len(pending)} emails after {max_retries} retries due to throttling.')
+                failed.extend(pending)
+                break
+            time.sleep(retry_delay)
+
+    emails = [results[message_id] for message_id in dict.fromkeys(message_ids) if message_id in results]
+    if failed:
+        raise BulkFetchError(emails, failed)
+    return emails
+
+#This function returns what changed in an Outlook folder since the last sync using Graph delta queries.
+#delta_link is the checkpoint returned by the previous sync, without it every message in the folder is returned (full sync).
+#The result is a dictionary with:
+#emails: email details of new and changed messages (without body), deleted: IDs of removed messages,
+#delta_link: the new checkpoint to store for the next sync.
+#Raises httpx.HTTPStatusError 410 if the delta link has expired.
+def sync_email_changes(session, delta_link=None, folder_name='inbox'):
+    emails = {}
+    deleted = set()
+
+    url = delta_link or f'me/mailFolders/{folder_name}/messages/delta'
+    params = None if delta_link else {'$select': LIST_VIEW_SELECT_FIELDS}
+    new_delta_link = None
+
+    while url:
+        result = graph_request(session, 'GET', url, params=params, headers={'Prefer': 'odata.maxpagesize=100'})
+        for message in result.get('value', []):
+            if '@removed' in message:
+                emails.pop(message['id'], None)
+                deleted.add(message['id'])
+            else:
+                emails[message['id']] = parse_outlook_message(message)
+                deleted.discard(message['id'])
+
+        #Pages have a next link, the last page has the delta link to use for the next sync.
+        url = result.get('@odata.nextLink')
+        params = None
+        new_delta_link = result.get('@odata.deltaLink', new_delta_link)
+
+    return {
+        'emails': list(emails.values()),
+        'deleted': list(deleted),
+        'delta_link': new_delta_link,
+        'full_resync': delta_link is None
+    }
+
+#This function returns the changes since delta_link, or a full resync when there is no usable delta link.
+#A full resync is used when delta_link is None, or when it has expired (410 Gone from Graph).
+def get_email_changes(session, delta_link=None, folder_name='inbox'):
+    if delta_link:
+        try:
+            return sync_email_changes(session, delta_link, folder_name)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 410:
+                raise
+            print("Sync delta link has expired. Running a full resync.")
+
+    return sync_email_changes(session, None, folder_name)
+
+#Helper function for the expirationDateTime of a subscription, `minutes` from now in ISO 8601 format.
+def _subscription_expiration(minutes):
+    return (datetime.now(timezone.utc) + timedelta(minutes=minutes)).isoformat().replace('+00:00', 'Z')
+
+#This function creates a Graph change notification subscription, so Graph calls notification_url when emails
+#in the folder are created, updated or deleted. client_state is a secret sent back with every notification.
+#notification_url must be public and answer the validation request (see /webhooks/outlook in app/main.py).
+#Returns the subscription, with its 'id' and 'expirationDateTime'.
+def create_subscription(session, notification_url, client_state, folder_name='inbox', minutes=SUBSCRIPTION_MINUTES):
+    return graph_request(session, 'POST', 'subscriptions', json={
+        'changeType': 'created,updated,deleted',
+        'notificationUrl': notification_url,
+        'resource': f"me/mailFolders('{folder_name}')/messages",
+        'expirationDateTime': _subscription_expiration(minutes),
+        'clientState': client_state
+    })
+
+#Function to extend a subscription before it expires.
+def renew_subscription(session, subscription_id, minutes=SUBSCRIPTION_MINUTES):
+    return graph_request(session, 'PATCH', f'subscriptions/{subscription_id}', json={
+        'expirationDateTime': _subscription_expiration(minutes)
+    })
+
+def delete_subscription(session, subscription_id):
+    return graph_request(session, 'DELETE', f'subscriptions/{subscription_id}')
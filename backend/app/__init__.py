@@ -0,0 +1,15 @@
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# Load the .env file before any app module reads its settings.
+load_dotenv()
+
+# The Gmail and Outlook folders are plain script folders (their modules import each other by name),
+# so they are added to the import path to let the app import gmail_api / outlook_api directly.
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for provider_dir in ("Gmail", "Outlook"):
+    provider_path = os.path.join(BACKEND_DIR, provider_dir)
+    if provider_path not in sys.path:
+        sys.path.append(provider_path)
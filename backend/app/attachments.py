@@ -0,0 +1,195 @@
+# Attachment downloads. Sync only records the attachment manifest (store.StoredAttachment); a file is downloaded
+# from the provider the first time it is opened and kept in a local disk cache, so opening it again neither calls
+# the provider nor loads it in memory: the API serves it from disk in chunks, with Range requests.
+# Files are named by the SHA-256 of their content, so a file forwarded across many messages or accounts is stored
+# once, whichever worker process downloaded it. The cache is capped at ATTACHMENT_CACHE_MAX_BYTES, the least recently
+# opened files are removed first.
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from contextlib import suppress
+
+import gmail_api
+import outlook_api
+from app import store, sync
+
+ATTACHMENT_CACHE_DIR = os.getenv("ATTACHMENT_CACHE_DIR", "attachment_cache")
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv("ATTACHMENT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+# Temp files older than this are left over from crashed downloads.
+STALE_TEMP_FILE_SECONDS = 24 * 60 * 60
+
+# Concurrent opens of the same attachment wait for a single download, attachments are spread over these locks.
+DOWNLOAD_LOCK_COUNT = 64
+
+
+# Hashes what is written to the file, so the cache key is known when the download ends without reading it again.
+class _HashingWriter:
+    def __init__(self, file):
+        self._file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+
+# Content-addressed file cache: <directory>/<first 2 hex digits>/<sha256>.
+# The folder is shared by every worker process, so the files on disk are the only state: the last use of a file is
+# its mtime (updated by get), and the size cap is enforced by scanning the folder after each new file.
+class AttachmentCache:
+    def __init__(self, directory, max_bytes, min_age_seconds=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Files used more recently than this are never evicted, so a path returned by get stays valid while the
+        # response opens it (once open, the file can be read to the end even if it is removed).
+        self.min_age_seconds = min_age_seconds
+        self._temp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self._temp_dir, exist_ok=True)
+        self._remove_stale_temp_files()
+
+    # Downloads interrupted by a crash are left in the temp folder. Temp files still being written by other
+    # processes are recent, so only files untouched for a day are removed.
+    def _remove_stale_temp_files(self):
+        cutoff = time.time() - STALE_TEMP_FILE_SECONDS
+        for entry in os.scandir(self._temp_dir):
+            with suppress(FileNotFoundError):
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+
+    # (mtime, content_sha256, size) of every cached file, least recently used first.
+    def _files(self):
+        files = []
+        for folder in os.scandir(self.directory):
+            if folder.is_dir() and folder.path != self._temp_dir:
+                for file in os.scandir(folder.path):
+                    with suppress(FileNotFoundError):
+                        stat = file.stat()
+                        files.append((stat.st_mtime, file.name, stat.st_size))
+        return sorted(files)
+
+    @property
+    def total_bytes(self):
+        return sum(size for _, _, size in self._files())
+
+    def path(self, content_sha256):
+        return os.path.join(self.directory, content_sha256[:2], content_sha256)
+
+    # Path of the cached file, or None when it is not (or no longer) in the cache.
+    def get(self, content_sha256):
+        path = self.path(content_sha256)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    # Stores the file written by write(file) and returns its SHA-256.
+    # The file is written to the temp folder and moved in place once complete, so readers never see a partial file.
+    def add(self, write):
+        fd, temp_path = tempfile.mkstemp(dir=self._temp_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                writer = _HashingWriter(file)
+                write(writer)
+            content_sha256 = writer.hash.hexdigest()
+            path = self.path(content_sha256)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+
+        self._evict()
+        return content_sha256
+
+    # Removes the least recently used files until the cache fits in max_bytes, skipping files used in the last
+    # min_age_seconds (the cache can go over max_bytes for that long).
+    def _evict(self):
+        files = self._files()
+        total_bytes = sum(size for _, _, size in files)
+        cutoff = time.time() - self.min_age_seconds
+        for mtime, content_sha256, size in files:
+            if total_bytes <= self.max_bytes or mtime >= cutoff:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(self.path(content_sha256))
+            total_bytes -= size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+_download_locks = [threading.Lock() for _ in range(DOWNLOAD_LOCK_COUNT)]
+
+
+# Attachment cache shared by the requests of this process.
+def get_attachment_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = AttachmentCache(ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MAX_BYTES)
+        return _cache
+
+
+# Attachments of a stored message. The manifest is recorded with the full email, so it is fetched here when the
+# email was only synced as list view metadata (or synced before manifests were recorded).
+def list_attachments(session, account_id, provider, message_id):
+    message = store.get_message(session, account_id, provider, message_id)
+    if message is None:
+        raise LookupError("Message not found")
+    attachments = store.get_attachments(session, account_id, provider, message_id)
+    if message.body is None or (message.has_attachments and not attachments):
+        sync.load_message_body(session, account_id, provider, message_id)
+        attachments = store.get_attachments(session, account_id, provider, message_id)
+    return attachments
+
+
+def _download(cache, account_id, provider, attachment):
+    if provider == "gmail":
+        service = sync.get_gmail_service(account_id)
+        attachment_ids = []
+        content_sha256 = cache.add(
+            lambda file: attachment_ids.append(gmail_api.download_attachment(
+                service, attachment.message_id, attachment.part_id, file, attachment.attachment_id
+            ))
+        )
+        return content_sha256, attachment_ids[0]
+
+    with sync.get_outlook_session(account_id) as graph_session:
+        content_sha256 = cache.add(
+            lambda file: outlook_api.download_attachment(graph_session, attachment.message_id, attachment.attachment_id, file)
+        )
+    return content_sha256, None
+
+
+# Returns (attachment, path of the file in the cache), downloading the file first if it is not cached.
+# Raises LookupError when the message or the attachment does not exist.
+def open_attachment(session, account_id, provider, message_id, part_id):
+    attachment = store.get_attachment(session, account_id, provider, message_id, part_id)
+    if attachment is None:
+        attachments = list_attachments(session, account_id, provider, message_id)
+        attachment = next((attachment for attachment in attachments if attachment.part_id == part_id), None)
+        if attachment is None:
+            raise LookupError("Attachment not found")
+
+    cache = get_attachment_cache()
+    path = attachment.content_sha256 and cache.get(attachment.content_sha256)
+    if path:
+        return attachment, path
+
+    with _download_locks[hash((account_id, provider, message_id, part_id)) % DOWNLOAD_LOCK_COUNT]:
+        # Another request may have downloaded it while this one was waiting.
+        session.refresh(attachment)
+        path = attachment.content_sha256 and cache.get(attachment.content_sha256)
+        if path:
+            return attachment, path
+
+        content_sha256, attachment_id = _download(cache, account_id, provider, attachment)
+        store.save_attachment_content(session, attachment, content_sha256, attachment_id)
+        session.commit()
+    return attachment, cache.path(content_sha256)
@@ -0,0 +1,170 @@
+# Categorization of synced emails (the "AI-powered categorization" of the inbox).
+# Emails are classified in micro-batches by a pluggable backend: a deterministic keyword classifier for local
+# runs and tests, or a model served over HTTP when CATEGORIZER_URL is set. Results are cached by a hash of the
+# subject and body, in memory and in the message store, so duplicates and thread replies quoting the same text
+# are classified once.
+import hashlib
+import logging
+import os
+import re
+import threading
+
+import httpx
+from cachetools import LRUCache
+
+from app import store
+
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ("primary", "social", "promotions", "updates", "finance", "travel")
+DEFAULT_CATEGORY = "primary"
+
+# Model backend, the keyword classifier is used when no URL is configured.
+CATEGORIZER_URL = os.getenv("CATEGORIZER_URL")
+CATEGORIZER_API_KEY = os.getenv("CATEGORIZER_API_KEY")
+CATEGORIZER_MODEL = os.getenv("CATEGORIZER_MODEL")
+# Emails sent to the backend per call.
+CATEGORIZER_BATCH_SIZE = int(os.getenv("CATEGORIZER_BATCH_SIZE", "32"))
+
+# Only the start of the body is sent to the model, it is enough to classify an email and keeps batches small.
+MAX_BODY_CHARS = 2000
+
+# Re: / Fwd: prefixes (and their usual translations) are removed, so replies hash like the email they answer.
+REPLY_PREFIX = re.compile(r"^\s*((re|fw|fwd|aw|wg|sv|tr)\s*(\[\d+\])?\s*:\s*)+", re.IGNORECASE)
+
+
+def _normalize_subject(subject):
+    return REPLY_PREFIX.sub("", subject or "").strip().lower()
+
+
+# Emails synced without their body are hashed with the snippet instead.
+def _email_text(email):
+    return email.body or email.snippet or ""
+
+
+def content_hash(email):
+    text = _email_text(email)[:MAX_BODY_CHARS].strip()
+    return hashlib.sha256(f"{_normalize_subject(email.subject)}\n{text}".encode()).hexdigest()
+
+
+# Deterministic classifier: the first category whose keywords appear in the sender, subject or body.
+# Used when no model backend is configured and in tests.
+class KeywordClassifier:
+    RULES = (
+        ("finance", ("invoice", "receipt", "payment", "statement", "bank", "transaction", "refund")),
+        ("travel", ("flight", "booking", "itinerary", "boarding pass", "hotel", "reservation")),
+        ("social", ("facebook", "linkedin", "twitter", "instagram", "friend request", "mentioned you")),
+        ("promotions", ("unsubscribe", "% off", "sale", "discount", "offer", "deal", "coupon")),
+        ("updates", ("notification", "no-reply", "noreply", "your account", "password", "security alert")),
+    )
+
+    def classify_batch(self, emails):
+        return [self.classify(email) for email in emails]
+
+    def classify(self, email):
+        text = " ".join([email.sender, email.subject, _email_text(email)]).lower()
+        for category, keywords in self.RULES:
+            if any(keyword in text for keyword in keywords):
+                return category
+        return DEFAULT_CATEGORY
+
+
+# Model backend behind an HTTP endpoint. One POST per batch:
+#   {"model": ..., "categories": [...], "emails": [{"id", "subject", "from", "body"}, ...]}
+# answered with {"categories": ["finance", ...]} in the same order as the emails.
+class HttpClassifier:
+    def __init__(self, url, api_key=None, model=None, timeout=60.0, client=None):
+        self.url = url
+        self.model = model
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self._client = client or httpx.Client(timeout=timeout, headers=headers)
+
+    def classify_batch(self, emails):
+        payload = {
+            "model": self.model,
+            "categories": list(CATEGORIES),
+            "emails": [
+                {
+                    "id": email.id,
+                    "subject": email.subject,
+                    "from": email.sender,
+                    "body": _email_text(email)[:MAX_BODY_CHARS],
+                }
+                for email in emails
+            ],
+        }
+        response = self._client.post(self.url, json=payload)
+        response.raise_for_status()
+        categories = response.json()["categories"]
+        if len(categories) != len(emails):
+            raise ValueError(f"Expected {len(emails)} categories, got {len(categories)}.")
+        return [category if category in CATEGORIES else DEFAULT_CATEGORY for category in categories]
+
+
+# Classifies emails with as few backend calls as possible: cached results first (memory, then the store),
+# then the remaining distinct contents in batches of batch_size.
+class Categorizer:
+    def __init__(self, backend, batch_size=CATEGORIZER_BATCH_SIZE, cache_size=50000):
+        self.backend = backend
+        self.batch_size = batch_size
+        self._cache = LRUCache(maxsize=cache_size)
+        self._cache_lock = threading.Lock()
+
+    def _cached(self, content_hashes):
+        with self._cache_lock:
+            return {value: self._cache[value] for value in content_hashes if value in self._cache}
+
+    def _remember(self, categories):
+        with self._cache_lock:
+            self._cache.update(categories)
+
+    # Returns {content_hash: category} for the emails, keyed by their content hash.
+    def classify(self, session, emails):
+        emails_by_hash = {}
+        for email in emails:
+            emails_by_hash.setdefault(content_hash(email), email)
+
+        categories = self._cached(emails_by_hash)
+        missing = [value for value in emails_by_hash if value not in categories]
+        if missing:
+            stored = store.find_categories(session, missing)
+            self._remember(stored)
+            categories.update(stored)
+            missing = [value for value in missing if value not in stored]
+
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            results = dict(zip(batch, self.backend.classify_batch([emails_by_hash[value] for value in batch])))
+            self._remember(results)
+            categories.update(results)
+        return categories
+
+    # Sets category and content_hash on each Message before it is stored.
+    # A failing backend does not fail the sync: the emails are stored without a category.
+    def categorize(self, session, emails):
+        try:
+            categories = self.classify(session, emails)
+        except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Categorization of %d emails failed: %s", len(emails), e)
+            categories = {}
+        for email in emails:
+            email.content_hash = content_hash(email)
+            email.category = categories.get(email.content_hash)
+        return emails
+
+
+_categorizer = None
+_categorizer_lock = threading.Lock()
+
+
+# Categorizer shared by the sync jobs of this process, so they share its cache.
+def get_categorizer():
+    global _categorizer
+    with _categorizer_lock:
+        if _categorizer is None:
+            if CATEGORIZER_URL:
+                backend = HttpClassifier(CATEGORIZER_URL, api_key=CATEGORIZER_API_KEY, model=CATEGORIZER_MODEL)
+            else:
+                backend = KeywordClassifier()
+            _categorizer = Categorizer(backend)
+        return _categorizer
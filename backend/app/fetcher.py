@@ -0,0 +1,215 @@
+# Async fetch engine used by the FastAPI app to read mail from many accounts at once.
+# gmail_api.py and outlook_api.py are synchronous (httplib2 / requests style) and would block the event loop,
+# so here the same endpoints are called with httpx.AsyncClient and the responses are parsed with the same
+# parse functions, which keeps the Message structs identical between the sync scripts and the app.
+# It reads the list view metadata of the latest emails straight from the providers (GET /live/messages).
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import anyio
+import httpx
+
+from gmail_api import LIST_VIEW_FIELDS, LIST_VIEW_HEADERS, parse_email_message
+from gmail_scheduler import DEFAULT_QUOTA_UNITS, INTERACTIVE, QUOTA_UNITS, scheduler
+from mailcore.metrics import metrics
+from outlook_api import LIST_VIEW_SELECT_FIELDS, parse_outlook_message
+
+logger = logging.getLogger(__name__)
+
+GMAIL_API_BASE_ENDPOINT = "https://gmail.googleapis.com/gmail/v1/"
+MS_GRAPH_BASE_ENDPOINT = "https://graph.microsoft.com/v1.0/"
+
+SUPPORTED_PROVIDERS = ("gmail", "outlook")
+
+# Throttled and temporarily failing requests are retried. Every request here is a GET, so retrying is safe.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+GMAIL_RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+@dataclass
+class MailAccount:
+    account_id: str
+    provider: str
+    # Blocking function returning a valid OAuth access token for the account, it is run in a worker thread.
+    get_access_token: Callable[[], str]
+    # Key of the account in the Gmail request scheduler, so these calls share the quota of the sync jobs of the
+    # account. Defaults to account_id.
+    quota_key: str | None = None
+
+    # An account id is only unique within its provider.
+    @property
+    def key(self):
+        return (self.provider, self.account_id)
+
+
+# Gmail also reports rate limits as 403 with a rateLimitExceeded / userRateLimitExceeded reason.
+def _is_retryable(response):
+    if response.status_code in RETRY_STATUS_CODES:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        errors = response.json().get("error", {}).get("errors", [])
+    except ValueError:
+        return False
+    return any(error.get("reason") in GMAIL_RATE_LIMIT_REASONS for error in errors)
+
+
+# Waits for the Retry-After header (seconds) when the provider sends one, otherwise backs off exponentially.
+def _retry_delay(response, attempt):
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return scheduler.backoff_delay(attempt)
+
+
+# Fetches mail for many accounts and providers concurrently.
+# Two limits are applied to every upstream request: a global one shared by all accounts (protects the worker
+# and its connection pool) and a per-account one (keeps one big mailbox from using every slot). Gmail requests
+# also take their quota units from the per-account token bucket of the Gmail request scheduler, without blocking
+# the event loop, so they stay under the per-user quota together with the sync jobs of the process.
+class AsyncMailFetcher:
+    def __init__(
+        self,
+        max_concurrency=100,
+        per_account_concurrency=4,
+        timeout=30.0,
+        max_retries=5,
+        client=None,
+        gmail_base_url=GMAIL_API_BASE_ENDPOINT,
+        graph_base_url=MS_GRAPH_BASE_ENDPOINT,
+    ):
+        self._client = client or httpx.AsyncClient(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+        self._global_slots = anyio.Semaphore(max_concurrency)
+        self._per_account_concurrency = per_account_concurrency
+        self._account_slots = {}
+        self._max_retries = max_retries
+        self._gmail_base_url = gmail_base_url
+        self._graph_base_url = graph_base_url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    def _account_semaphore(self, account):
+        semaphore = self._account_slots.get(account.key)
+        if semaphore is None:
+            semaphore = anyio.Semaphore(self._per_account_concurrency)
+            self._account_slots[account.key] = semaphore
+        return semaphore
+
+    # Interactive lane: these requests are made while a user waits for the response.
+    async def _acquire_quota(self, account, units):
+        while wait := scheduler.try_acquire(account.quota_key or account.account_id, units, INTERACTIVE):
+            await anyio.sleep(wait)
+
+    # method names the call in the metrics, e.g. 'messages.get' (Gmail quota units are looked up with it).
+    # Throttled and 5xx responses are retried up to max_retries times, then the error is raised.
+    async def _get_json(self, account, access_token, url, method, params=None, headers=None):
+        units = QUOTA_UNITS.get(method, DEFAULT_QUOTA_UNITS) if account.provider == "gmail" else 0
+        for attempt in range(self._max_retries + 1):
+            if units:
+                await self._acquire_quota(account, units)
+            # The per-account slot is taken first, so a request waiting on its own account never holds a global slot.
+            async with self._account_semaphore(account), self._global_slots:
+                started = time.monotonic()
+                response = await self._client.get(
+                    url,
+                    params=params,
+                    headers={"Authorization": f"Bearer {access_token}", **(headers or {})},
+                )
+            metrics.record(
+                account.provider,
+                method,
+                time.monotonic() - started,
+                quota_units=units,
+                error=response.is_error,
+                throttled=response.status_code == 429,
+            )
+            if attempt < self._max_retries and _is_retryable(response):
+                await anyio.sleep(_retry_delay(response, attempt))
+                continue
+            response.raise_for_status()
+            return response.json()
+
+    async def _access_token(self, account):
+        return await anyio.to_thread.run_sync(account.get_access_token)
+
+    # List view metadata of the latest emails (format 'metadata' with a field mask, same as
+    # get_email_message_summary), so bodies and attachments are not downloaded.
+    async def fetch_gmail_messages(self, account, access_token, label_id="INBOX", max_results=50):
+        listing = await self._get_json(
+            account,
+            access_token,
+            f"{self._gmail_base_url}users/me/messages",
+            "messages.list",
+            params={"labelIds": label_id, "maxResults": min(max_results, 500)},
+        )
+        message_ids = [message["id"] for message in listing.get("messages", [])][:max_results]
+
+        results = [None] * len(message_ids)
+
+        async def fetch_one(index, message_id):
+            message = await self._get_json(
+                account,
+                access_token,
+                f"{self._gmail_base_url}users/me/messages/{message_id}",
+                "messages.get",
+                params={"format": "metadata", "metadataHeaders": LIST_VIEW_HEADERS, "fields": LIST_VIEW_FIELDS},
+            )
+            results[index] = parse_email_message(message, include_body=False)
+
+        async with anyio.create_task_group() as task_group:
+            for index, message_id in enumerate(message_ids):
+                task_group.start_soon(fetch_one, index, message_id)
+        return results
+
+    async def fetch_outlook_messages(self, account, access_token, folder_name="inbox", max_results=50):
+        listing = await self._get_json(
+            account,
+            access_token,
+            f"{self._graph_base_url}me/mailFolders/{folder_name}/messages",
+            "GET /me/mailFolders/{id}/messages",
+            params={"$select": LIST_VIEW_SELECT_FIELDS, "$top": min(max_results, 1000)},
+        )
+        return [parse_outlook_message(message) for message in listing.get("value", [])][:max_results]
+
+    async def fetch_account(self, account, max_results=50):
+        if account.provider not in SUPPORTED_PROVIDERS:
+            raise ValueError(f'Unsupported provider "{account.provider}".')
+
+        access_token = await self._access_token(account)
+        if account.provider == "gmail":
+            return await self.fetch_gmail_messages(account, access_token, max_results=max_results)
+        return await self.fetch_outlook_messages(account, access_token, max_results=max_results)
+
+    # Fetch all accounts concurrently. Returns a dict of (provider, account_id) -> list of Messages, or the exception
+    # raised for that account, so one failing account does not cancel the others. An account listed twice is
+    # fetched once.
+    async def fetch_accounts(self, accounts, max_results=50):
+        results = {}
+
+        async def fetch_one(account):
+            try:
+                results[account.key] = await self.fetch_account(account, max_results=max_results)
+            except Exception as e:
+                logger.warning("Fetching %s account %s failed: %s", account.provider, account.account_id, e)
+                results[account.key] = e
+
+        unique_accounts = {}
+        for account in accounts:
+            unique_accounts.setdefault(account.key, account)
+        async with anyio.create_task_group() as task_group:
+            for account in unique_accounts.values():
+                task_group.start_soon(fetch_one, account)
+        return results
@@ -1,10 +1,61 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
+
+import anyio
+import msgspec
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from sqlalchemy.orm import Session
+
+from app import attachments, push, store, sync, sync_queue
+from app.fetcher import SUPPORTED_PROVIDERS, AsyncMailFetcher
+from app.models import MessageView
+from Google_API import AuthorizationRequiredError as GmailAuthorizationRequiredError
+from mailcore import metrics
+from Microsoft_API import AuthorizationRequiredError as OutlookAuthorizationRequiredError
+
+
+# One shared async fetcher per worker, so all handlers share its connection pool and concurrency limits (GET /live/messages).
+# Sync jobs are published to the sync queue. Without RabbitMQ (no AMQP_URL) the jobs are consumed by
+# workers running inside this process, with RabbitMQ they are consumed by `python -m app.sync_queue`.
+# Push subscriptions are renewed where the sync workers run, so API workers behind RabbitMQ do not renew them.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    store.init_db()
+    broker = await sync_queue.create_broker().connect()
+    app.state.sync_broker = broker
+
+    background_tasks = []
+    if isinstance(broker, sync_queue.InMemoryBroker):
+        background_tasks.append(asyncio.create_task(sync_queue.run_workers(broker, sync.run_sync_job, worker_count=1)))
+        background_tasks.append(asyncio.create_task(push.run_renewal_loop()))
+
+    try:
+        async with AsyncMailFetcher() as fetcher:
+            app.state.fetcher = fetcher
+            yield
+    finally:
+        for task in background_tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        await broker.close()
+
+
+# Response encoded with msgspec, for endpoints returning MessageView structs (app/models.py).
+# Returned directly from the endpoint, so FastAPI's jsonable_encoder and pydantic are skipped.
+class MsgspecJSONResponse(JSONResponse):
+    def render(self, content):
+        return msgspec.json.encode(content)
+
 
 app = FastAPI(
     title="AI Inbox Manager",
     description="Multi-platform inbox with AI-powered categorization",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS - Allow frontend to connect (when we build it later)
@@ -16,6 +67,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Accounts without a token that can still be refreshed have to sign in again, the API never starts a sign in itself.
+@app.exception_handler(GmailAuthorizationRequiredError)
+@app.exception_handler(OutlookAuthorizationRequiredError)
+async def authorization_required(request: Request, exc: Exception):
+    return JSONResponse({"detail": str(exc)}, status_code=401)
+
+
 @app.get("/")
 def root():
     return {
@@ -26,4 +84,225 @@ def root():
 
 @app.get("/health")
 def health_check():
-    return {"status": "healthy"}
\ No newline at end of file
+    return {"status": "healthy"}
+
+
+# Provider call counts, latencies and Gmail quota units since the worker started, plus the process RSS.
+@app.get("/metrics")
+def get_metrics():
+    return metrics.snapshot()
+
+
+# Inbox page served from the local message store (newest first). Pass next_cursor back as cursor for the next page.
+@app.get("/accounts/{account_id}/messages")
+def list_messages(
+    account_id: str,
+    provider: str | None = None,
+    label: str | None = None,
+    starred: bool | None = None,
+    category: str | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    session: Session = Depends(store.get_session),
+):
+    try:
+        messages, next_cursor = store.list_messages(
+            session,
+            account_id,
+            provider=provider,
+            label=label,
+            starred=starred,
+            category=category,
+            limit=limit,
+            cursor=cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return MsgspecJSONResponse({
+        "messages": [store.message_view(message, include_body=False) for message in messages],
+        "next_cursor": next_cursor,
+    })
+
+
+# Ranked full-text search over the synced mail of every account, or only the accounts given with account_id
+# (repeatable). Results are best match first, pass next_cursor back as cursor for the next page.
+@app.get("/search")
+def search(
+    q: str = Query(..., min_length=1),
+    account_id: list[str] | None = Query(None),
+    provider: str | None = None,
+    label: str | None = None,
+    starred: bool | None = None,
+    has_attachments: bool | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: str | None = None,
+    session: Session = Depends(store.get_session),
+):
+    try:
+        results, next_cursor = store.search_messages(
+            session,
+            q,
+            account_ids=account_id,
+            provider=provider,
+            label=label,
+            starred=starred,
+            has_attachments=has_attachments,
+            date_from=date_from,
+            date_to=date_to,
+            limit=limit,
+            cursor=cursor,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return MsgspecJSONResponse({
+        "results": [store.message_view(message, include_body=False, rank=rank) for message, rank in results],
+        "next_cursor": next_cursor,
+    })
+
+
+# Latest emails of several accounts read straight from the providers, without waiting for a sync. account is
+# repeatable, as provider:account_id, an account listed twice is returned once. Accounts are fetched concurrently,
+# and an account that fails is reported in errors (keyed by provider:account_id) without failing the others.
+@app.get("/live/messages")
+async def live_messages(
+    request: Request,
+    account: list[str] = Query(..., min_length=1),
+    max_results: int = Query(20, ge=1, le=100),
+):
+    accounts = {}
+    for value in account:
+        provider, _, account_id = value.partition(":")
+        if provider not in SUPPORTED_PROVIDERS or not account_id:
+            raise HTTPException(status_code=400, detail=f'Invalid account "{value}", expected provider:account_id')
+        if (provider, account_id) not in accounts:
+            accounts[(provider, account_id)] = sync.get_mail_account(account_id, provider)
+    accounts = list(accounts.values())
+
+    results = await request.app.state.fetcher.fetch_accounts(accounts, max_results=max_results)
+    messages, errors = [], {}
+    for mail_account in accounts:
+        result = results[mail_account.key]
+        if isinstance(result, Exception):
+            errors[f"{mail_account.provider}:{mail_account.account_id}"] = str(result)
+            continue
+        messages.extend(
+            MessageView(
+                account_id=mail_account.account_id,
+                provider=mail_account.provider,
+                id=message.id,
+                thread_id=message.thread_id,
+                subject=message.subject,
+                sender=message.sender,
+                recipient=message.recipient,
+                snippet=message.snippet,
+                has_attachments=message.has_attachments,
+                date=message.date,
+                starred=message.starred,
+                labels=message.labels,
+                category=None,
+            )
+            for message in result
+        )
+    messages.sort(key=lambda message: message.date, reverse=True)
+    return MsgspecJSONResponse({"messages": messages, "errors": errors})
+
+
+@app.get("/accounts/{account_id}/messages/{provider}/{message_id}")
+def get_message(account_id: str, provider: str, message_id: str, session: Session = Depends(store.get_session)):
+    message = store.get_message(session, account_id, provider, message_id)
+    if message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+
+    # Sync only stores list view metadata, the body is fetched from the provider the first time the email is opened.
+    if message.body is None and provider in ("gmail", "outlook"):
+        message = sync.load_message_body(session, account_id, provider, message_id)
+    return MsgspecJSONResponse(store.message_view(message))
+
+
+@app.get("/accounts/{account_id}/messages/{provider}/{message_id}/attachments")
+def list_attachments(account_id: str, provider: str, message_id: str, session: Session = Depends(store.get_session)):
+    try:
+        stored = attachments.list_attachments(session, account_id, provider, message_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return MsgspecJSONResponse({"attachments": [store.attachment_view(attachment) for attachment in stored]})
+
+
+# Serves an attachment from the local attachment cache, it is downloaded from the provider the first time.
+# The file is streamed from disk and Range requests are answered with 206, so large files can be read in parts.
+@app.get("/accounts/{account_id}/messages/{provider}/{message_id}/attachments/{part_id}")
+def download_attachment(
+    account_id: str, provider: str, message_id: str, part_id: str, session: Session = Depends(store.get_session)
+):
+    try:
+        attachment, path = attachments.open_attachment(session, account_id, provider, message_id, part_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FileResponse(
+        path,
+        media_type=attachment.mime_type,
+        filename=attachment.filename,
+        content_disposition_type="inline" if attachment.inline else "attachment",
+    )
+
+
+# Queues a background sync of the mailbox. Returns straight away, the sync runs on the sync workers.
+@app.post("/accounts/{account_id}/sync", status_code=202)
+async def queue_sync(account_id: str, request: Request, provider: str = "gmail"):
+    if provider not in ("gmail", "outlook"):
+        raise HTTPException(status_code=400, detail=f'Unsupported provider "{provider}"')
+    queued = await sync_queue.enqueue_sync(request.app.state.sync_broker, account_id, provider)
+    return {"account_id": account_id, "provider": provider, "queued": queued}
+
+
+# Starts push notifications for the mailbox (Gmail watch or Graph subscription), renewed automatically.
+@app.post("/accounts/{account_id}/push")
+def register_push(account_id: str, provider: str = "gmail", session: Session = Depends(store.get_session)):
+    try:
+        subscription = push.register_push(session, account_id, provider)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"account_id": account_id, "provider": provider, "expires_at": subscription.expires_at}
+
+
+async def _queue_syncs(request, find_accounts, payload):
+    def lookup():
+        with store.SessionLocal() as session:
+            return find_accounts(session, payload)
+
+    for account_id, provider in await anyio.to_thread.run_sync(lookup):
+        await sync_queue.enqueue_sync(request.app.state.sync_broker, account_id, provider)
+
+
+# Cloud Pub/Sub push endpoint for Gmail watch notifications. Any 2xx response acknowledges the message.
+@app.post("/webhooks/gmail", status_code=204)
+async def gmail_webhook(request: Request, token: str | None = None):
+    if not push.is_valid_gmail_push_token(token):
+        raise HTTPException(status_code=403, detail="Invalid token")
+    try:
+        await _queue_syncs(request, push.accounts_for_gmail_notification, await request.json())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(status_code=204)
+
+
+# Microsoft Graph change notifications. When a subscription is created Graph first calls this URL with a
+# validationToken, which has to be echoed back as plain text within 10 seconds.
+@app.post("/webhooks/outlook", status_code=202)
+async def outlook_webhook(request: Request, validationToken: str | None = None):
+    if validationToken is not None:
+        return PlainTextResponse(validationToken)
+    try:
+        payload = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid notification.")
+    await _queue_syncs(request, push.accounts_for_outlook_notifications, payload)
+    return Response(status_code=202)
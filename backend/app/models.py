@@ -0,0 +1,32 @@
+# API response types, built from the stored messages (app/store.py). The Message struct the adapters return is in
+# mailcore/models.py.
+import msgspec
+
+
+# A stored message as returned by the API, encoded as a JSON object.
+# body is left out of list pages, rank is only set on search results.
+class MessageView(msgspec.Struct, omit_defaults=True, gc=False):
+    account_id: str
+    provider: str
+    id: str
+    thread_id: str
+    subject: str
+    sender: str = msgspec.field(name="from")
+    recipient: str = msgspec.field(name="to")
+    snippet: str
+    has_attachments: bool
+    date: int
+    starred: bool
+    labels: tuple[str, ...]
+    category: str | None
+    body: str | None = None
+    rank: float | None = None
+
+
+# An attachment of a stored message as returned by the API, the file itself is served by the download endpoint.
+class AttachmentView(msgspec.Struct, gc=False):
+    part_id: str
+    filename: str
+    mime_type: str
+    size: int
+    inline: bool
@@ -0,0 +1,166 @@
+# Push ingestion: Gmail watch notifications (through Cloud Pub/Sub) and Microsoft Graph change notifications.
+# A notification only says that a mailbox changed, so each one queues an incremental sync of that mailbox
+# (Gmail history / Graph delta), which fetches just the changed emails. Watches and subscriptions expire
+# after a few days and are renewed by run_renewal_loop, which runs next to the sync workers (python -m app.sync_queue,
+# or the API process when it runs the sync workers itself).
+import asyncio
+import base64
+import hmac
+import json
+import logging
+import os
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import anyio
+import httpx
+
+import outlook_api
+from app import store, sync
+from gmail_api import get_mailbox_profile, start_gmail_watch
+
+logger = logging.getLogger(__name__)
+
+# Cloud Pub/Sub topic Gmail publishes to, e.g. projects/my-project/topics/gmail-push.
+GMAIL_PUBSUB_TOPIC = os.getenv("GMAIL_PUBSUB_TOPIC")
+# Secret added as ?token= to the Pub/Sub push endpoint URL, so only Pub/Sub can call /webhooks/gmail.
+# Every Gmail notification is rejected while it is not set.
+GMAIL_PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN")
+# Public base URL of this API, Graph sends its notifications to {PUSH_NOTIFICATION_URL}/webhooks/outlook.
+PUSH_NOTIFICATION_URL = os.getenv("PUSH_NOTIFICATION_URL")
+
+# Watches and subscriptions expiring within this time are renewed.
+RENEW_BEFORE = timedelta(days=2)
+RENEWAL_INTERVAL_SECONDS = 3600
+# Sync lease taken by the process doing a renewal round, so when several worker processes run the renewal loop only
+# one of them renews (two would both create a new Graph subscription for an expired one).
+RENEWAL_LEASE = ("push-renewal", "push")
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+def register_gmail_watch(session, account_id, service):
+    if not GMAIL_PUBSUB_TOPIC:
+        raise ValueError("GMAIL_PUBSUB_TOPIC not found in environment variables.")
+    # Gmail notifications only carry the email address, so it is stored to find the account again.
+    email_address = get_mailbox_profile(service)["emailAddress"]
+    watch = start_gmail_watch(service, GMAIL_PUBSUB_TOPIC)
+    expires_at = datetime.fromtimestamp(int(watch["expiration"]) / 1000, tz=timezone.utc)
+    return store.save_push_subscription(session, account_id, "gmail", email_address.lower(), expires_at)
+
+
+def register_outlook_subscription(session, account_id, graph_session):
+    if not PUSH_NOTIFICATION_URL:
+        raise ValueError("PUSH_NOTIFICATION_URL not found in environment variables.")
+    client_state = secrets.token_urlsafe(32)
+    subscription = outlook_api.create_subscription(
+        graph_session, f"{PUSH_NOTIFICATION_URL.rstrip('/')}/webhooks/outlook", client_state
+    )
+    expires_at = datetime.fromisoformat(subscription["expirationDateTime"].replace("Z", "+00:00"))
+    return store.save_push_subscription(
+        session, account_id, "outlook", subscription["id"], expires_at, client_state=client_state
+    )
+
+
+def register_push(session, account_id, provider):
+    if provider == "gmail":
+        return register_gmail_watch(session, account_id, sync.get_gmail_service(account_id))
+    if provider == "outlook":
+        with sync.get_outlook_session(account_id) as graph_session:
+            return register_outlook_subscription(session, account_id, graph_session)
+    raise ValueError(f'Unsupported provider "{provider}".')
+
+
+def renew_push_subscription(session, subscription):
+    if subscription.provider == "gmail":
+        # Calling watch again on the mailbox renews it.
+        return register_push(session, subscription.account_id, "gmail")
+
+    with sync.get_outlook_session(subscription.account_id) as graph_session:
+        try:
+            renewed = outlook_api.renew_subscription(graph_session, subscription.subscription_id)
+        except httpx.HTTPStatusError as e:
+            # The subscription is already gone (expired or removed by Graph), create a new one.
+            if e.response.status_code != 404:
+                raise
+            return register_outlook_subscription(session, subscription.account_id, graph_session)
+
+    subscription.expires_at = datetime.fromisoformat(renewed["expirationDateTime"].replace("Z", "+00:00"))
+    session.commit()
+    return subscription
+
+
+def renew_expiring_subscriptions():
+    renewed = 0
+    with store.SessionLocal() as session:
+        for subscription in store.list_expiring_push_subscriptions(session, _utcnow() + RENEW_BEFORE):
+            try:
+                renew_push_subscription(session, subscription)
+                renewed += 1
+            except Exception as e:
+                session.rollback()
+                logger.warning("Renewing %s push for account %s failed: %s",
+                               subscription.provider, subscription.account_id, e)
+    return renewed
+
+
+# The lease lasts half an interval, so it has expired when the processes try again.
+def _take_renewal_lease(owner, interval):
+    with store.SessionLocal() as session:
+        return store.acquire_sync_lease(session, *RENEWAL_LEASE, owner, interval / 2)
+
+
+async def run_renewal_loop(interval=RENEWAL_INTERVAL_SECONDS):
+    owner = f"renewal:{uuid.uuid4().hex[:8]}"
+    while True:
+        try:
+            if await anyio.to_thread.run_sync(_take_renewal_lease, owner, interval):
+                await anyio.to_thread.run_sync(renew_expiring_subscriptions)
+        except Exception:
+            logger.exception("Push renewal round failed")
+        await asyncio.sleep(interval)
+
+
+# Pub/Sub push body: {"message": {"data": base64 of {"emailAddress": ..., "historyId": ...}, ...}, "subscription": ...}
+def parse_gmail_notification(payload):
+    try:
+        data = json.loads(base64.b64decode(payload["message"]["data"]))
+        return data["emailAddress"].lower(), data.get("historyId")
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Invalid Gmail push notification.")
+
+
+def is_valid_gmail_push_token(token):
+    if not GMAIL_PUSH_TOKEN:
+        logger.warning("Rejecting Gmail notification: GMAIL_PUSH_TOKEN is not set.")
+        return False
+    return hmac.compare_digest(token or "", GMAIL_PUSH_TOKEN)
+
+
+# Returns the (account_id, provider) mailboxes to sync for a Gmail notification.
+def accounts_for_gmail_notification(session, payload):
+    email_address, _ = parse_gmail_notification(payload)
+    subscription = store.find_push_subscription(session, "gmail", email_address)
+    if subscription is None:
+        logger.info("Ignoring Gmail notification for unknown mailbox %s", email_address)
+        return []
+    return [(subscription.account_id, "gmail")]
+
+
+# Returns the (account_id, provider) mailboxes to sync for a Graph notification batch.
+# Notifications whose clientState does not match the stored secret are ignored.
+def accounts_for_outlook_notifications(session, payload):
+    accounts = []
+    for notification in payload.get("value", []):
+        subscription = store.find_push_subscription(session, "outlook", notification.get("subscriptionId", ""))
+        if subscription is None or not hmac.compare_digest(
+            notification.get("clientState") or "", subscription.client_state or ""
+        ):
+            logger.warning("Ignoring Graph notification for subscription %s", notification.get("subscriptionId"))
+            continue
+        if (subscription.account_id, "outlook") not in accounts:
+            accounts.append((subscription.account_id, "outlook"))
+    return accounts
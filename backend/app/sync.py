@@ -0,0 +1,185 @@
+# Sync jobs: bring the local message store up to date with a provider mailbox.
+import os
+
+import outlook_api
+from app import store
+from app.categorize import get_categorizer
+from app.fetcher import MailAccount
+from Google_API import get_gmail_credentials
+from Microsoft_API import get_access_token
+from gmail_api import (
+    BulkFetchError,
+    get_email_changes,
+    get_email_message_details,
+    get_email_message_details_bulk,
+    get_email_message_summaries_bulk,
+    initialize_gmail_service,
+)
+
+
+# Each account has its own Gmail token file, named with the account ID as prefix.
+# Raises Google_API.AuthorizationRequiredError when the account has to sign in again, the app never prompts for it.
+def get_gmail_service(account_id):
+    return initialize_gmail_service(prefix=f"_{account_id}", interactive=False)
+
+
+OUTLOOK_SCOPES = ["User.Read", "Mail.ReadWrite", "Mail.Send"]
+
+
+# Outlook accounts are identified by their username (email address) in the msal token cache.
+# Raises AuthorizationRequiredError when the account has to sign in again, the app never prompts for it.
+def get_outlook_access_token(account_id):
+    return get_access_token(
+        app_id=os.getenv("MICROSOFT_CLIENT_ID"),
+        client_secret=os.getenv("MICROSOFT_CLIENT_SECRET"),
+        scopes=OUTLOOK_SCOPES,
+        username=account_id,
+        interactive=False,
+    )
+
+
+def get_outlook_session(account_id):
+    return outlook_api.initialize_outlook_session(get_outlook_access_token(account_id))
+
+
+# Account for the async fetcher (app/fetcher.py), with the same tokens as the sync jobs. The Gmail quota key is the
+# account_key create_gmail_service gives the service of the account, so both share the account's quota bucket.
+def get_mail_account(account_id, provider):
+    if provider == "gmail":
+        prefix = f"_{account_id}"
+        return MailAccount(
+            account_id,
+            provider,
+            lambda: get_gmail_credentials("gmail", "v1", ["https://mail.google.com/"], prefix, interactive=False).token,
+            quota_key=f"gmail_v1{prefix}",
+        )
+    if provider == "outlook":
+        return MailAccount(account_id, provider, lambda: get_outlook_access_token(account_id))
+    raise ValueError(f'Unsupported provider "{provider}".')
+
+
+# Incremental Gmail sync of one account into the store.
+# Uses the stored historyId checkpoint (full resync when missing or expired), fetches the new emails with the
+# batch endpoint, categorizes them and upserts them in bulk, then saves the new checkpoint in the same transaction.
+# By default only the list view metadata is synced, bodies are fetched when an email is opened (load_gmail_body).
+# If some new emails can not be fetched, the others are stored but the checkpoint is not moved and BulkFetchError
+# is raised: the sync job is retried from the same checkpoint, so the missing emails are fetched again.
+def sync_gmail_account(session, account_id, service, folder_name="INBOX", full_bodies=False):
+    checkpoint = store.get_checkpoint(session, account_id, "gmail")
+    changes = get_email_changes(service, checkpoint, folder_name=folder_name)
+
+    fetch = get_email_message_details_bulk if full_bodies else get_email_message_summaries_bulk
+    try:
+        emails = fetch(service, changes["added"])
+    except BulkFetchError as e:
+        get_categorizer().categorize(session, e.emails)
+        store.upsert_messages(session, account_id, "gmail", e.emails)
+        session.commit()
+        raise
+    get_categorizer().categorize(session, emails)
+    store.upsert_messages(session, account_id, "gmail", emails)
+
+    if changes["full_resync"]:
+        store.delete_messages_not_in(session, account_id, "gmail", changes["added"])
+    else:
+        store.delete_messages(session, account_id, "gmail", changes["deleted"])
+        store.apply_label_changes(session, account_id, "gmail", changes["label_changes"])
+
+    store.save_checkpoint(session, account_id, "gmail", changes["history_id"])
+    session.commit()
+
+    return {
+        "upserted": len(emails),
+        "deleted": len(changes["deleted"]),
+        "label_changes": len(changes["label_changes"]),
+        "full_resync": changes["full_resync"],
+    }
+
+
+# Stores the full email of an opened message. An email stored without a category (the categorizer was failing
+# when it was synced) is categorized now, on its body.
+def _store_full_email(session, account_id, provider, email):
+    stored = store.get_message(session, account_id, provider, email.id)
+    if stored is None or stored.category is None:
+        get_categorizer().categorize(session, [email])
+    store.upsert_messages(session, account_id, provider, [email])
+    session.commit()
+
+    # The upsert bypasses the ORM, so reload the row in case the session already holds it without the body.
+    message = store.get_message(session, account_id, provider, email.id)
+    session.refresh(message)
+    return message
+
+
+# Fetches the full email (body and attachment manifest) the first time it is opened and keeps it in the store.
+def load_gmail_body(session, account_id, message_id, service):
+    return _store_full_email(session, account_id, "gmail", get_email_message_details(service, message_id))
+
+
+# Incremental Outlook sync of one account into the store, using the stored Graph delta link as checkpoint.
+# Delta responses already carry the list view fields of every new or changed email, so no extra fetch is needed.
+def sync_outlook_account(session, account_id, graph_session, folder_name="inbox"):
+    checkpoint = store.get_checkpoint(session, account_id, "outlook")
+    changes = outlook_api.get_email_changes(graph_session, checkpoint, folder_name=folder_name)
+
+    get_categorizer().categorize(session, changes["emails"])
+    store.upsert_messages(session, account_id, "outlook", changes["emails"])
+    if changes["full_resync"]:
+        store.delete_messages_not_in(session, account_id, "outlook", [email.id for email in changes["emails"]])
+    else:
+        store.delete_messages(session, account_id, "outlook", changes["deleted"])
+
+    store.save_checkpoint(session, account_id, "outlook", changes["delta_link"])
+    session.commit()
+
+    return {
+        "upserted": len(changes["emails"]),
+        "deleted": len(changes["deleted"]),
+        "label_changes": 0,
+        "full_resync": changes["full_resync"],
+    }
+
+
+def load_outlook_body(session, account_id, message_id, graph_session):
+    return _store_full_email(session, account_id, "outlook", outlook_api.get_email_message_details(graph_session, message_id))
+
+
+# Emails stored without a category are categorized again after each sync job, at most this many per job.
+RECATEGORIZE_LIMIT = 500
+
+
+# Categorizes the stored emails of the account that have no category, e.g. synced while the categorizer was failing.
+# Returns how many of them got one.
+def recategorize_account(session, account_id, provider, limit=RECATEGORIZE_LIMIT):
+    emails = [store.stored_email(message) for message in store.find_uncategorized_messages(session, account_id, provider, limit)]
+    if not emails:
+        return 0
+    get_categorizer().categorize(session, emails)
+    categorized = store.save_categories(session, account_id, provider, emails)
+    session.commit()
+    return categorized
+
+
+# Fetches the full email from its provider and stores its body and attachment manifest.
+def load_message_body(session, account_id, provider, message_id):
+    if provider == "gmail":
+        return load_gmail_body(session, account_id, message_id, get_gmail_service(account_id))
+    if provider == "outlook":
+        with get_outlook_session(account_id) as graph_session:
+            return load_outlook_body(session, account_id, message_id, graph_session)
+    raise ValueError(f'Unsupported provider "{provider}".')
+
+
+# Runs one queued sync job (see app.sync_queue) with its own database session, then categorizes the emails of the
+# account that are still without a category.
+def run_sync_job(job):
+    with store.SessionLocal() as session:
+        if job.provider == "gmail":
+            result = sync_gmail_account(session, job.account_id, get_gmail_service(job.account_id))
+        elif job.provider == "outlook":
+            with get_outlook_session(job.account_id) as graph_session:
+                result = sync_outlook_account(session, job.account_id, graph_session)
+        else:
+            raise ValueError(f'Unsupported provider "{job.provider}".')
+        result["recategorized"] = recategorize_account(session, job.account_id, job.provider)
+        return result
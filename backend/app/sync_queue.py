@@ -0,0 +1,327 @@
+# Background sync pipeline: the API publishes one sync job per mailbox, a pool of async workers consumes them.
+# RabbitMQ (aio-pika) is used when AMQP_URL is set, otherwise an in-memory broker with the same behaviour
+# runs inside the API process (local development and tests).
+#
+# Run workers against RabbitMQ from the backend folder with: python -m app.sync_queue
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import uuid
+from contextlib import suppress
+from dataclasses import asdict, dataclass
+
+import anyio
+
+from app import store
+
+logger = logging.getLogger(__name__)
+
+AMQP_URL = os.getenv("AMQP_URL")
+
+SYNC_QUEUE = "mail.sync"
+# Jobs waiting for their retry delay sit in one queue per delay step (mail.sync.retry.<seconds>), they expire back
+# into SYNC_QUEUE. RabbitMQ only expires messages at the head of a queue, so every message of a queue has the
+# queue's TTL: a long delay never holds back a shorter one queued behind it.
+RETRY_QUEUE = "mail.sync.retry"
+# Delays are rounded up to the next step, longer ones wait for the last step.
+RETRY_DELAY_STEPS = (1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 1800, 3600)
+# Jobs that failed max_attempts times.
+DEAD_LETTER_QUEUE = "mail.sync.dead"
+
+# How long a job waits before trying again when another worker is syncing the same mailbox.
+LEASE_BUSY_DELAY = 5.0
+
+
+@dataclass
+class SyncJob:
+    account_id: str
+    provider: str
+    attempt: int = 0
+
+    def to_bytes(self):
+        return json.dumps(asdict(self)).encode()
+
+    @classmethod
+    def from_bytes(cls, body):
+        return cls(**json.loads(body))
+
+
+def retry_queue_name(seconds):
+    return f"{RETRY_QUEUE}.{seconds}"
+
+
+# Smallest delay step that waits at least delay seconds.
+def retry_delay_step(delay):
+    return next((seconds for seconds in RETRY_DELAY_STEPS if seconds >= delay), RETRY_DELAY_STEPS[-1])
+
+
+# Stand-in for RabbitMQ used when no AMQP_URL is configured. Delayed publishes are scheduled on the event loop
+# and dead-lettered jobs are kept in a list so they can be inspected.
+class InMemoryBroker:
+    def __init__(self):
+        self._queue = asyncio.Queue()
+        self._delayed = set()
+        self.dead_letters = []
+
+    # Jobs of a previous run were lost with its queue, so their queued flags are cleared.
+    async def connect(self):
+        def clear_queued():
+            with store.SessionLocal() as session:
+                store.clear_sync_queued(session)
+
+        await anyio.to_thread.run_sync(clear_queued)
+        return self
+
+    async def close(self):
+        for handle in self._delayed:
+            handle.cancel()
+        self._delayed.clear()
+
+    async def publish(self, job, delay=0.0):
+        if delay <= 0:
+            self._queue.put_nowait(job.to_bytes())
+            return
+
+        body = job.to_bytes()
+
+        def release():
+            self._delayed.discard(handle)
+            self._queue.put_nowait(body)
+
+        handle = asyncio.get_running_loop().call_later(delay, release)
+        self._delayed.add(handle)
+
+    async def dead_letter(self, job):
+        self.dead_letters.append(job)
+
+    # Calls handler for every job, with at most prefetch jobs being handled at the same time.
+    async def consume(self, handler, prefetch):
+        slots = anyio.Semaphore(prefetch)
+
+        # A failing handler is logged, it must not stop the workers (RabbitMQ requeues the message instead).
+        async def handle(body):
+            try:
+                await handler(SyncJob.from_bytes(body))
+            except Exception:
+                logger.exception("Sync job handler failed")
+            finally:
+                slots.release()
+                self._queue.task_done()
+
+        async with anyio.create_task_group() as task_group:
+            while True:
+                await slots.acquire()
+                body = await self._queue.get()
+                task_group.start_soon(handle, body)
+
+    # Waits until every published job (delayed ones included) has been handled.
+    async def join(self):
+        while True:
+            await self._queue.join()
+            if not self._delayed:
+                return
+            await asyncio.sleep(0.01)
+
+
+class RabbitMQBroker:
+    def __init__(self, url):
+        self._url = url
+        self._connection = None
+        self._channel = None
+
+    async def connect(self):
+        import aio_pika
+
+        self._connection = await aio_pika.connect_robust(self._url)
+        self._channel = await self._connection.channel()
+        await self._channel.declare_queue(SYNC_QUEUE, durable=True)
+        # Messages published to a delay queue are moved back to SYNC_QUEUE once the queue's TTL passes.
+        for seconds in RETRY_DELAY_STEPS:
+            await self._channel.declare_queue(
+                retry_queue_name(seconds),
+                durable=True,
+                arguments={
+                    "x-message-ttl": seconds * 1000,
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": SYNC_QUEUE,
+                },
+            )
+        await self._channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+        return self
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+
+    async def _publish(self, job, routing_key):
+        import aio_pika
+
+        await self._channel.default_exchange.publish(
+            aio_pika.Message(
+                job.to_bytes(),
+                content_type="application/json",
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            ),
+            routing_key=routing_key,
+        )
+
+    async def publish(self, job, delay=0.0):
+        if delay > 0:
+            await self._publish(job, retry_queue_name(retry_delay_step(delay)))
+        else:
+            await self._publish(job, SYNC_QUEUE)
+
+    async def dead_letter(self, job):
+        await self._publish(job, DEAD_LETTER_QUEUE)
+
+    async def consume(self, handler, prefetch):
+        # Each consumer gets its own channel, so the prefetch limit applies per consumer.
+        channel = await self._connection.channel()
+        await channel.set_qos(prefetch_count=prefetch)
+        queue = await channel.declare_queue(SYNC_QUEUE, durable=True)
+
+        async def on_message(message):
+            # The message is acked once the handler returns. The handler deals with retries itself.
+            async with message.process(requeue=True):
+                await handler(SyncJob.from_bytes(message.body))
+
+        await queue.consume(on_message)
+        await asyncio.Future()
+
+
+def create_broker():
+    if AMQP_URL:
+        return RabbitMQBroker(AMQP_URL)
+    return InMemoryBroker()
+
+
+# Publishes a sync job for the mailbox unless one is already waiting in the queue.
+# Returns True when a job was published.
+async def enqueue_sync(broker, account_id, provider):
+    def mark_queued():
+        with store.SessionLocal() as session:
+            return store.mark_sync_queued(session, account_id, provider)
+
+    def clear_queued():
+        with store.SessionLocal() as session:
+            store.clear_sync_queued(session, account_id, provider)
+
+    if not await anyio.to_thread.run_sync(mark_queued):
+        return False
+    try:
+        await broker.publish(SyncJob(account_id=account_id, provider=provider))
+    except BaseException:
+        # Otherwise the flag would block every later sync of the mailbox until it expires.
+        await anyio.to_thread.run_sync(clear_queued)
+        raise
+    return True
+
+
+# Consumes sync jobs and runs them. The blocking sync code runs in worker threads, so the event loop stays free.
+# A mailbox is synced by at most one worker at a time (sync lease in the store, renewed every lease_seconds / 3
+# while the sync runs), failed jobs are retried with exponential backoff and dead-lettered after max_attempts.
+class SyncWorker:
+    def __init__(self, broker, sync_function, prefetch=10, max_attempts=5, retry_base_delay=5.0, lease_seconds=600):
+        self.broker = broker
+        self.sync_function = sync_function
+        self.prefetch = prefetch
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def _acquire_lease(self, job, owner):
+        with store.SessionLocal() as session:
+            return store.acquire_sync_lease(session, job.account_id, job.provider, owner, self.lease_seconds)
+
+    def _renew_lease(self, job, owner):
+        with store.SessionLocal() as session:
+            return store.renew_sync_lease(session, job.account_id, job.provider, owner, self.lease_seconds)
+
+    def _release_lease(self, job, owner):
+        with store.SessionLocal() as session:
+            store.release_sync_lease(session, job.account_id, job.provider, owner)
+
+    # Keeps the lease alive while a long sync (e.g. a full Gmail resync) runs past lease_seconds.
+    async def _keep_lease(self, job, owner):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                if not await anyio.to_thread.run_sync(self._renew_lease, job, owner):
+                    logger.warning("Lost the sync lease of %s account %s", job.provider, job.account_id)
+                    return
+            except Exception:
+                logger.exception("Renewing the sync lease of %s account %s failed", job.provider, job.account_id)
+
+    def retry_delay(self, attempt):
+        return self.retry_base_delay * 2 ** (attempt - 1) + random.uniform(0, self.retry_base_delay)
+
+    async def handle(self, job):
+        # Each job is its own lease owner, so two jobs for one mailbox on the same worker do not overlap either.
+        owner = f"{self.worker_id}:{uuid.uuid4().hex[:8]}"
+        try:
+            acquired = await anyio.to_thread.run_sync(self._acquire_lease, job, owner)
+        except Exception:
+            logger.exception("Could not take the sync lease of %s account %s", job.provider, job.account_id)
+            acquired = False
+        if not acquired:
+            await self.broker.publish(job, delay=LEASE_BUSY_DELAY)
+            return
+
+        heartbeat = asyncio.create_task(self._keep_lease(job, owner))
+        try:
+            result = await anyio.to_thread.run_sync(self.sync_function, job)
+            logger.info("Synced %s account %s: %s", job.provider, job.account_id, result)
+        except Exception as e:
+            job = SyncJob(account_id=job.account_id, provider=job.provider, attempt=job.attempt + 1)
+            if job.attempt >= self.max_attempts:
+                logger.error("Sync of %s account %s failed %d times, dead-lettering: %s",
+                             job.provider, job.account_id, job.attempt, e)
+                await self.broker.dead_letter(job)
+            else:
+                logger.warning("Sync of %s account %s failed (attempt %d), retrying: %s",
+                               job.provider, job.account_id, job.attempt, e)
+                await self.broker.publish(job, delay=self.retry_delay(job.attempt))
+        finally:
+            heartbeat.cancel()
+            with suppress(asyncio.CancelledError):
+                await heartbeat
+            await anyio.to_thread.run_sync(self._release_lease, job, owner)
+
+    async def run(self):
+        await self.broker.consume(self.handle, self.prefetch)
+
+
+# Runs worker_count workers on the broker until cancelled.
+async def run_workers(broker, sync_function, worker_count=4, **worker_options):
+    async with anyio.create_task_group() as task_group:
+        for _ in range(worker_count):
+            task_group.start_soon(SyncWorker(broker, sync_function, **worker_options).run)
+
+
+# Sync worker process. It also renews the push subscriptions (app.push), the API processes do not.
+async def main():
+    from app.push import run_renewal_loop
+    from app.sync import run_sync_job
+
+    logging.basicConfig(level=logging.INFO)
+    store.init_db()
+    broker = await create_broker().connect()
+    try:
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(run_renewal_loop)
+            await run_workers(
+                broker,
+                run_sync_job,
+                worker_count=int(os.getenv("SYNC_WORKERS", "4")),
+                prefetch=int(os.getenv("SYNC_PREFETCH", "10")),
+            )
+    finally:
+        await broker.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,112 @@
+# Tests of the attachment cache and of the attachment manifest in the message store.
+# Run from the backend folder: python -m pytest app/test_attachments.py
+# Downloads through the API are exercised against the stub server in benchmarks/test_attachments.py.
+import os
+import tempfile
+import time
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_attachments.db"))
+
+import pytest
+
+from app import store
+from app.attachments import AttachmentCache
+from mailcore.models import Attachment, Message
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    store.init_db()
+
+
+def _add(cache, data):
+    return cache.add(lambda file: file.write(data))
+
+
+def test_same_content_is_stored_once(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=1024)
+
+    first = _add(cache, b"invoice")
+    second = _add(cache, b"invoice")
+
+    assert first == second
+    assert cache.total_bytes == len(b"invoice")
+    with open(cache.get(first), "rb") as file:
+        assert file.read() == b"invoice"
+
+
+# Makes the file look last used seconds ago.
+def _age(cache, content_sha256, seconds):
+    used = time.time() - seconds
+    os.utime(cache.path(content_sha256), (used, used))
+
+
+def test_least_recently_opened_files_are_evicted(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=250, min_age_seconds=0)
+    oldest = _add(cache, b"a" * 100)
+    opened = _add(cache, b"b" * 100)
+    _age(cache, oldest, 300)
+    _age(cache, opened, 200)
+    cache.get(oldest)
+
+    newest = _add(cache, b"c" * 100)
+
+    assert cache.get(opened) is None
+    assert cache.get(oldest) is not None and cache.get(newest) is not None
+    assert cache.total_bytes == 200
+
+
+# Each worker process has its own AttachmentCache on the same folder.
+def test_cache_is_shared_between_workers(tmp_path):
+    first = AttachmentCache(str(tmp_path), max_bytes=250)
+    second = AttachmentCache(str(tmp_path), max_bytes=250)
+
+    shared = _add(first, b"a" * 100)
+    assert second.get(shared) is not None
+
+    # A worker starting up leaves the downloads in progress of the others alone.
+    in_progress = tmp_path / "tmp" / "download"
+    in_progress.write_bytes(b"partial")
+    AttachmentCache(str(tmp_path), max_bytes=250)
+    assert in_progress.exists()
+
+    # Recently used files are kept even over the cap (their paths may be about to be served), older ones are evicted.
+    _add(second, b"b" * 100)
+    _add(second, b"c" * 100)
+    assert first.total_bytes == 300
+    _age(first, shared, 120)
+    _add(second, b"d" * 10)
+    assert first.get(shared) is None and first.total_bytes == 210
+
+
+def _email(attachments):
+    return Message(
+        id="m1", thread_id="m1", subject="Invoice", sender="alice@example.com", recipient="bob@example.com",
+        snippet="", body="See attached.", has_attachments=bool(attachments), date=0, starred=False, labels=(),
+        attachments=attachments,
+    )
+
+
+def test_refetched_manifest_keeps_downloaded_attachments():
+    invoice = Attachment(part_id="1", filename="invoice.pdf", mime_type="application/pdf", size=10, attachment_id="a1")
+    logo = Attachment(part_id="2", filename="logo.png", mime_type="image/png", size=5, attachment_id="a2", inline=True)
+    with store.SessionLocal() as session:
+        store.upsert_messages(session, "alice", "gmail", [_email((invoice, logo))])
+        store.save_attachment_content(session, store.get_attachment(session, "alice", "gmail", "m1", "1"), "f" * 64)
+        session.commit()
+
+        # Gmail issued a new attachment ID and the logo was removed. Metadata-only syncs leave the manifest alone.
+        refetched = Attachment(part_id="1", filename="invoice.pdf", mime_type="application/pdf", size=10, attachment_id="a3")
+        store.upsert_messages(session, "alice", "gmail", [_email((refetched,))])
+        store.upsert_messages(session, "alice", "gmail", [_email(None)])
+        session.commit()
+        session.expire_all()
+
+        stored = store.get_attachments(session, "alice", "gmail", "m1")
+        assert [(attachment.part_id, attachment.attachment_id, attachment.content_sha256) for attachment in stored] == [
+            ("1", "a3", "f" * 64)
+        ]
+
+        store.delete_messages(session, "alice", "gmail", ["m1"])
+        session.commit()
+        assert store.get_attachments(session, "alice", "gmail", "m1") == []
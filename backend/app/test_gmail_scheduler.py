@@ -0,0 +1,84 @@
+# Tests of the Gmail request scheduler (Gmail/gmail_scheduler.py) with its real quota rates: token bucket debt,
+# priority lanes and which failed calls are retried. The benchmarks lift the quota, so they do not cover it.
+# Run from the backend folder: python -m pytest app/test_gmail_scheduler.py
+import threading
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import app  # noqa: F401 (adds the Gmail folder to the import path)
+from gmail_scheduler import BULK, INTERACTIVE, GmailRequestScheduler
+
+
+# googleapiclient request stand-in: fails with the given HTTP statuses, then succeeds.
+class FakeRequest:
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def execute(self):
+        self.calls += 1
+        if self.statuses:
+            raise HttpError(httplib2.Response({"status": self.statuses.pop(0)}), b"{}")
+        return {"id": "sent"}
+
+
+def _scheduler(**kwargs):
+    return GmailRequestScheduler(base_delay=0.001, max_delay=0.01, **kwargs)
+
+
+def test_reads_are_retried_on_server_errors():
+    request = FakeRequest(500, 503)
+    assert _scheduler().execute(request, "messages.get", "alice") == {"id": "sent"}
+    assert request.calls == 3
+
+
+def test_send_is_only_retried_when_rate_limited():
+    rate_limited = FakeRequest(429)
+    assert _scheduler().execute(rate_limited, "messages.send", "alice", INTERACTIVE) == {"id": "sent"}
+    assert rate_limited.calls == 2
+
+    # Gmail may have sent the email before failing, so it is not sent again.
+    failed = FakeRequest(500)
+    with pytest.raises(HttpError):
+        _scheduler().execute(failed, "messages.send", "alice", INTERACTIVE)
+    assert failed.calls == 1
+
+
+def test_call_larger_than_the_bucket_leaves_it_in_debt():
+    scheduler = _scheduler(units_per_second=1000, burst=100)
+
+    # A 300 unit batch only waits for a full bucket, the 200 units over it delay the next call by 0.205 s.
+    started = time.monotonic()
+    scheduler.acquire("alice", 300)
+    assert time.monotonic() - started < 0.05
+    scheduler.acquire("alice", 5)
+    assert time.monotonic() - started >= 0.2
+
+    # Other accounts have their own bucket.
+    started = time.monotonic()
+    scheduler.acquire("bob", 100)
+    assert time.monotonic() - started < 0.05
+
+
+def test_interactive_calls_go_before_waiting_bulk_calls():
+    scheduler = _scheduler(units_per_second=100, burst=10)
+    scheduler.acquire("alice", 10)
+    order = []
+
+    def acquire(priority):
+        scheduler.acquire("alice", 10, priority)
+        order.append(priority)
+
+    bulk = threading.Thread(target=acquire, args=(BULK,))
+    interactive = threading.Thread(target=acquire, args=(INTERACTIVE,))
+    bulk.start()
+    # The bulk call is already waiting for quota when the interactive call arrives.
+    time.sleep(0.02)
+    interactive.start()
+    bulk.join(timeout=5)
+    interactive.join(timeout=5)
+
+    assert order == [INTERACTIVE, BULK]
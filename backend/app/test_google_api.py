@@ -0,0 +1,87 @@
+# Tests of the Gmail credentials and service cache (Gmail/Google_API.py) with local token files, no Google calls:
+# server code paths never start the OAuth flow, and each thread keeps a bounded number of services.
+# Run from the backend folder: python -m pytest app/test_google_api.py
+import itertools
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_google_api.db"))
+
+import pytest
+from fastapi.testclient import TestClient
+from google.auth.exceptions import RefreshError, TransportError
+from google.oauth2.credentials import Credentials
+
+import Google_API
+from app.main import app
+from Google_API import AuthorizationRequiredError, create_gmail_service
+
+SCOPES = ["https://mail.google.com/"]
+
+_account_ids = itertools.count()
+
+
+@pytest.fixture(autouse=True)
+def token_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(Google_API, "TOKEN_DIR", str(tmp_path))
+
+    def no_browser(*args, **kwargs):
+        raise AssertionError("The OAuth flow was started.")
+
+    monkeypatch.setattr(Google_API.InstalledAppFlow, "from_client_config", no_browser)
+    return tmp_path
+
+
+# Token file of a new account, returns its prefix.
+def _save_token(token_dir, expires_in=timedelta(hours=1)):
+    prefix = f"_google-{next(_account_ids)}"
+    expiry = datetime.now(timezone.utc) + expires_in
+    with open(token_dir / f"token_gmail_v1{prefix}.json", "w") as file:
+        json.dump({
+            "token": "access", "refresh_token": "refresh", "client_id": "id", "client_secret": "secret",
+            "scopes": SCOPES, "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }, file)
+    return prefix
+
+
+def test_missing_or_revoked_token_raises_instead_of_signing_in(token_dir, monkeypatch):
+    with pytest.raises(AuthorizationRequiredError):
+        create_gmail_service("gmail", "v1", SCOPES, prefix=f"_google-{next(_account_ids)}", interactive=False)
+
+    def revoked(self, request):
+        raise RefreshError("invalid_grant: Token has been expired or revoked.")
+
+    monkeypatch.setattr(Credentials, "refresh", revoked)
+    with pytest.raises(AuthorizationRequiredError):
+        create_gmail_service("gmail", "v1", SCOPES, prefix=_save_token(token_dir, -timedelta(hours=1)), interactive=False)
+
+    # A network error is not a reason to sign in again.
+    def offline(self, request):
+        raise TransportError("connection refused")
+
+    monkeypatch.setattr(Credentials, "refresh", offline)
+    with pytest.raises(TransportError):
+        create_gmail_service("gmail", "v1", SCOPES, prefix=_save_token(token_dir, -timedelta(hours=1)), interactive=False)
+
+
+def test_api_answers_401_when_the_account_has_to_sign_in():
+    with TestClient(app) as client:
+        assert client.post("/accounts/nobody/push", params={"provider": "gmail"}).status_code == 401
+
+        response = client.get("/live/messages", params={"account": "gmail:nobody"})
+        assert response.status_code == 200
+        assert "sign in again" in response.json()["errors"]["gmail:nobody"]
+
+
+def test_each_thread_keeps_a_bounded_number_of_services(token_dir):
+    prefixes = [_save_token(token_dir) for _ in range(Google_API.SERVICES_PER_THREAD + 4)]
+
+    services = [create_gmail_service("gmail", "v1", SCOPES, prefix=prefix, interactive=False) for prefix in prefixes]
+
+    assert len(Google_API._thread_services.services) == Google_API.SERVICES_PER_THREAD
+    assert create_gmail_service("gmail", "v1", SCOPES, prefix=prefixes[-1], interactive=False) is services[-1]
+    assert create_gmail_service("gmail", "v1", SCOPES, prefix=prefixes[0], interactive=False) is not services[0]
+    # The discovery document was parsed once and is shared by every service.
+    assert Google_API._get_discovery_document.cache_info().currsize == 1
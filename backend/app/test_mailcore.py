@@ -0,0 +1,21 @@
+# The provider adapters take the Message types and the call metrics from mailcore, importing them does not import
+# the app package (its settings and import path changes).
+# Run from the backend folder: python -m pytest app/test_mailcore.py
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_adapters_do_not_import_the_app():
+    code = (
+        "import sys, gmail_api, outlook_api; "
+        "print(sorted({name.split('.')[0] for name in sys.modules} & {'app', 'mailcore'}))"
+    )
+    path = os.pathsep.join(os.path.join(BACKEND_DIR, folder) for folder in ("Gmail", "Outlook"))
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=BACKEND_DIR, env={**os.environ, "PYTHONPATH": path},
+        capture_output=True, text=True, check=True,
+    )
+    assert result.stdout.strip() == "['mailcore']"
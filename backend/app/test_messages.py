@@ -0,0 +1,78 @@
+# Tests of the inbox pages served from the message store (GET /accounts/{account_id}/messages): order, filters
+# and keyset cursor paging, including emails received at the same second.
+# Run from the backend folder: python -m pytest app/test_messages.py
+import os
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_messages.db"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import store
+from app.main import app
+from mailcore.models import Message
+
+START = 1_700_000_000
+
+
+def _email(message_id, date, starred=False, labels=("INBOX",), category=None):
+    return Message(
+        id=message_id, thread_id=message_id, subject=f"Subject {message_id}", sender="alice@example.com",
+        recipient="bob@example.com", snippet="Hello", body="Hello Bob", has_attachments=False, date=date,
+        starred=starred, labels=labels, category=category,
+    )
+
+
+@pytest.fixture(scope="module")
+def client():
+    store.init_db()
+    with store.SessionLocal() as session:
+        store.upsert_messages(session, "bob", "gmail", [
+            _email("m1", START),
+            # m2, m3 and m4 arrived at the same second.
+            _email("m2", START + 60, starred=True, category="finance"),
+            _email("m3", START + 60, labels=("INBOX", "UNREAD")),
+            _email("m4", START + 60, labels=("SENT",)),
+            _email("m5", START + 120, category="finance"),
+        ])
+        store.upsert_messages(session, "bob", "outlook", [_email("o1", START + 30)])
+        store.upsert_messages(session, "carol", "gmail", [_email("c1", START + 90)])
+        session.commit()
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def _ids(client, **params):
+    response = client.get("/accounts/bob/messages", params=params)
+    assert response.status_code == 200, response.text
+    return [message["id"] for message in response.json()["messages"]]
+
+
+def test_newest_first_with_filters(client):
+    assert _ids(client) == ["m5", "m4", "m3", "m2", "o1", "m1"]
+    assert _ids(client, provider="outlook") == ["o1"]
+    assert _ids(client, label="UNREAD") == ["m3"]
+    assert _ids(client, starred=True) == ["m2"]
+    assert _ids(client, category="finance") == ["m5", "m2"]
+
+
+def test_list_view_leaves_the_body_out(client):
+    message = client.get("/accounts/bob/messages", params={"limit": 1}).json()["messages"][0]
+    assert message["from"] == "alice@example.com" and message["to"] == "bob@example.com"
+    assert "body" not in message
+
+
+def test_pages_follow_each_other_through_equal_dates(client):
+    ids, cursor = [], None
+    while True:
+        page = client.get("/accounts/bob/messages", params={"limit": 2, **({"cursor": cursor} if cursor else {})}).json()
+        ids.extend(message["id"] for message in page["messages"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == ["m5", "m4", "m3", "m2", "o1", "m1"]
+
+
+def test_invalid_cursor(client):
+    assert client.get("/accounts/bob/messages", params={"cursor": "not-a-cursor"}).status_code == 400
@@ -0,0 +1,37 @@
+# Tests of the provider call metrics served by GET /metrics.
+# Run from the backend folder: python -m pytest app/test_metrics.py
+import os
+import tempfile
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_metrics.db"))
+
+from fastapi.testclient import TestClient
+
+from app.main import app
+from mailcore.metrics import graph_method_name, metrics
+
+
+def test_graph_ids_are_grouped_in_method_names():
+    assert graph_method_name("get", "me/messages/AAMkAGI2TG93000000000001AAA=") == "GET /me/messages/{id}"
+    assert (
+        graph_method_name("GET", "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta?$skiptoken=abc")
+        == "GET /me/mailFolders/inbox/messages/delta"
+    )
+
+
+def test_metrics_endpoint_reports_calls_per_provider():
+    metrics.reset()
+    metrics.record("gmail", "messages.get", 0.02, quota_units=5)
+    metrics.record("gmail", "messages.get", 0.04, quota_units=5, throttled=True)
+    metrics.record("outlook", "GET /me/messages/{id}", 0.01)
+
+    with TestClient(app) as client:
+        response = client.get("/metrics")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["process"]["rss_bytes"] > 0
+    gmail = body["providers"]["gmail"]
+    assert (gmail["calls"], gmail["errors"], gmail["throttled"], gmail["quota_units"]) == (2, 1, 1, 10)
+    assert gmail["methods"]["messages.get"]["max_ms"] == 40.0
+    assert body["providers"]["outlook"]["calls"] == 1
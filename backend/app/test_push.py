@@ -0,0 +1,140 @@
+# Webhook tests with local fake Gmail Pub/Sub and Microsoft Graph notification payloads.
+# Run from the backend folder: python -m pytest app/test_push.py
+import base64
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_push.db"))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app import push, store, sync_queue
+from app.main import app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    queued = []
+
+    async def fake_enqueue_sync(broker, account_id, provider):
+        queued.append((account_id, provider))
+        return True
+
+    monkeypatch.setattr(sync_queue, "enqueue_sync", fake_enqueue_sync)
+    monkeypatch.setattr(push, "GMAIL_PUSH_TOKEN", "secret")
+    with TestClient(app) as test_client:
+        test_client.queued = queued
+        yield test_client
+
+
+def _save_subscription(account_id, provider, subscription_id, client_state=None):
+    with store.SessionLocal() as session:
+        store.save_push_subscription(
+            session, account_id, provider, subscription_id,
+            datetime.now(timezone.utc) + timedelta(days=5), client_state=client_state,
+        )
+
+
+def _gmail_payload(email_address, history_id="12345"):
+    data = json.dumps({"emailAddress": email_address, "historyId": history_id}).encode()
+    return {
+        "message": {"data": base64.b64encode(data).decode(), "messageId": "1", "publishTime": "2024-01-01T00:00:00Z"},
+        "subscription": "projects/test/subscriptions/gmail-push",
+    }
+
+
+def test_gmail_notification_queues_sync_of_the_mailbox(client):
+    _save_subscription("alice", "gmail", "alice@example.com")
+
+    response = client.post("/webhooks/gmail?token=secret", json=_gmail_payload("Alice@example.com"))
+
+    assert response.status_code == 204
+    assert client.queued == [("alice", "gmail")]
+
+
+def test_gmail_notification_for_unknown_mailbox_is_acknowledged(client):
+    response = client.post("/webhooks/gmail?token=secret", json=_gmail_payload("nobody@example.com"))
+
+    assert response.status_code == 204
+    assert client.queued == []
+
+
+def test_gmail_notification_with_wrong_token_is_rejected(client, monkeypatch):
+    assert client.post("/webhooks/gmail?token=wrong", json=_gmail_payload("a@example.com")).status_code == 403
+    assert client.post("/webhooks/gmail", json=_gmail_payload("a@example.com")).status_code == 403
+    assert client.post("/webhooks/gmail?token=secret", json=_gmail_payload("a@example.com")).status_code == 204
+
+    # Without a configured token there is no way to tell Pub/Sub from anyone else.
+    monkeypatch.setattr(push, "GMAIL_PUSH_TOKEN", None)
+    assert client.post("/webhooks/gmail", json=_gmail_payload("a@example.com")).status_code == 403
+    assert client.queued == []
+
+
+def test_malformed_gmail_notification(client):
+    assert client.post("/webhooks/gmail?token=secret", json={"message": {"data": "not base64 json"}}).status_code == 400
+
+
+def test_outlook_validation_token_is_echoed(client):
+    response = client.post("/webhooks/outlook?validationToken=abc%20123")
+
+    assert response.status_code == 200
+    assert response.text == "abc 123"
+    assert response.headers["content-type"].startswith("text/plain")
+
+
+def test_outlook_notifications_queue_one_sync_per_mailbox(client):
+    _save_subscription("bob@example.com", "outlook", "sub-1", client_state="state-1")
+    notification = {
+        "subscriptionId": "sub-1",
+        "clientState": "state-1",
+        "changeType": "created",
+        "resource": "Users/1/Messages/AAA",
+        "resourceData": {"id": "AAA"},
+    }
+
+    response = client.post("/webhooks/outlook", json={"value": [notification, dict(notification, resourceData={"id": "BBB"})]})
+
+    assert response.status_code == 202
+    assert client.queued == [("bob@example.com", "outlook")]
+
+
+def test_outlook_notification_with_wrong_client_state_is_ignored(client):
+    _save_subscription("carol@example.com", "outlook", "sub-2", client_state="state-2")
+
+    response = client.post("/webhooks/outlook", json={"value": [{"subscriptionId": "sub-2", "clientState": "forged"}]})
+
+    assert response.status_code == 202
+    assert client.queued == []
+
+
+def test_expiring_subscriptions_are_renewed(monkeypatch):
+    store.init_db()
+    with store.SessionLocal() as session:
+        store.save_push_subscription(session, "dave", "gmail", "dave@example.com", datetime.now(timezone.utc) + timedelta(hours=1))
+        store.save_push_subscription(session, "erin", "gmail", "erin@example.com", datetime.now(timezone.utc) + timedelta(days=6))
+
+    renewed = []
+
+    def fake_register_push(session, account_id, provider):
+        renewed.append(account_id)
+        return store.save_push_subscription(
+            session, account_id, provider, f"{account_id}@example.com", datetime.now(timezone.utc) + timedelta(days=7)
+        )
+
+    monkeypatch.setattr(push, "register_push", fake_register_push)
+
+    assert push.renew_expiring_subscriptions() >= 1
+    assert "dave" in renewed
+    assert "erin" not in renewed
+
+
+def test_one_process_renews_per_interval(monkeypatch):
+    store.init_db()
+    # The API started by the other tests runs the loop on the default lease.
+    monkeypatch.setattr(push, "RENEWAL_LEASE", ("push-renewal-test", "push"))
+
+    assert push._take_renewal_lease("renewal:first", 3600)
+    assert not push._take_renewal_lease("renewal:second", 3600)
@@ -0,0 +1,97 @@
+# Tests of full-text search (GET /search): filters and cursor paging through tied ranks, on SQLite, plus the
+# Postgres search column and rank expression, compiled without a server.
+# Run from the backend folder: python -m pytest app/test_search.py
+import os
+import tempfile
+from types import SimpleNamespace
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_search.db"))
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import postgresql
+
+from app import store
+from app.main import app
+from mailcore.models import Message
+
+DAY = 24 * 60 * 60
+START = 1_700_000_000
+
+
+@pytest.fixture(scope="module")
+def client():
+    store.init_db()
+    emails = [
+        # (account, provider, id, subject, day, starred, labels, attachments)
+        ("alice", "gmail", "g1", "Quarterly invoice", 1, False, ("INBOX",), True),
+        ("alice", "gmail", "g2", "Invoice reminder", 2, True, ("INBOX", "IMPORTANT"), False),
+        ("alice", "gmail", "g3", "Invoice paid", 3, False, ("ARCHIVE",), False),
+        ("alice", "outlook", "o1", "Invoice from the hotel", 4, False, ("INBOX",), True),
+        ("bob", "gmail", "b1", "Invoice for bob", 5, False, ("INBOX",), False),
+        ("bob", "gmail", "b2", "Lunch on friday", 6, False, ("INBOX",), False),
+    ]
+    with store.SessionLocal() as session:
+        for account_id, provider, message_id, subject, day, starred, labels, has_attachments in emails:
+            store.upsert_messages(session, account_id, provider, [Message(
+                id=message_id, thread_id=message_id, subject=subject, sender="shop@example.com",
+                recipient=f"{account_id}@example.com", snippet="", body=None, has_attachments=has_attachments,
+                date=START + day * DAY, starred=starred, labels=labels,
+            )])
+        session.commit()
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def _ids(client, **params):
+    response = client.get("/search", params={"q": "invoice", **params})
+    assert response.status_code == 200, response.text
+    return [result["id"] for result in response.json()["results"]]
+
+
+def test_filters(client):
+    assert _ids(client) == ["b1", "o1", "g3", "g2", "g1"]
+    assert _ids(client, account_id=["alice"]) == ["o1", "g3", "g2", "g1"]
+    assert _ids(client, account_id=["alice"], provider="gmail") == ["g3", "g2", "g1"]
+    assert _ids(client, account_id=["alice"], label="INBOX") == ["o1", "g2", "g1"]
+    assert _ids(client, starred=True) == ["g2"]
+    assert _ids(client, has_attachments=True) == ["o1", "g1"]
+    assert _ids(client, date_from="2023-11-16T00:00:00Z", date_to="2023-11-18T00:00:00Z") == ["g3", "g2"]
+    # Every word has to match.
+    assert _ids(client, q="invoice hotel") == ["o1"]
+
+
+def test_pages_follow_each_other_through_tied_ranks(client):
+    # On SQLite every result has rank 0, so the pages are split in the middle of a tie.
+    ids, cursor = [], None
+    while True:
+        page = client.get("/search", params={"q": "invoice", "limit": 2, **({"cursor": cursor} if cursor else {})}).json()
+        ids.extend(result["id"] for result in page["results"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert ids == ["b1", "o1", "g3", "g2", "g1"]
+
+
+def test_invalid_requests(client):
+    assert client.get("/search", params={"q": "invoice", "cursor": "not-a-cursor"}).status_code == 400
+    assert client.get("/search", params={"q": ""}).status_code == 422
+    assert client.get("/search", params={"q": "   "}).status_code == 400
+
+
+def test_postgres_search_column():
+    alter = store.SEARCH_VECTOR_DDL[1]
+    assert alter.startswith("ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (")
+    assert alter.endswith(") STORED")
+    # Generated columns can only name columns of their own row, unqualified, and only the start of the body is indexed.
+    assert "messages." not in alter
+    assert f"left(coalesce(body, ''), {store.SEARCH_BODY_CHARS})" in alter
+    assert "USING gin (search_vector)" in store.SEARCH_VECTOR_DDL[2]
+
+    # The rank is compared with the rank of the cursor as double precision.
+    postgres_session = SimpleNamespace(get_bind=lambda: SimpleNamespace(dialect=postgresql.dialect()))
+    match, rank = store._search_match(postgres_session, "invoice")
+    compiled = str(rank.compile(dialect=postgresql.dialect()))
+    assert compiled.startswith("CAST(ts_rank_cd(messages.search_vector, websearch_to_tsquery(")
+    assert compiled.endswith("AS FLOAT(53))")
+    assert str(match.compile(dialect=postgresql.dialect())).startswith("messages.search_vector @@ ")
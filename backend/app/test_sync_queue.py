@@ -0,0 +1,197 @@
+# Tests of the sync pipeline against the in-memory broker: queue dedup, retries, dead-lettering and sync leases,
+# and of the RabbitMQ broker's delay queues against a fake aio-pika channel.
+# Run from the backend folder: python -m pytest app/test_sync_queue.py
+import itertools
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test_sync_queue.db"))
+
+import anyio
+import pytest
+
+from app import store, sync_queue
+from app.sync_queue import InMemoryBroker, RabbitMQBroker, SyncJob, SyncWorker
+
+pytestmark = pytest.mark.anyio
+
+_account_ids = itertools.count()
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    store.init_db()
+
+
+@pytest.fixture
+def account_id():
+    return f"queue-{next(_account_ids)}"
+
+
+async def _run_until_idle(broker, worker, timeout=10):
+    with anyio.fail_after(timeout):
+        async with anyio.create_task_group() as task_group:
+            task_group.start_soon(worker.run)
+            await broker.join()
+            task_group.cancel_scope.cancel()
+
+
+async def test_mailbox_is_queued_once_until_a_worker_takes_it(account_id):
+    broker = await InMemoryBroker().connect()
+    synced = []
+
+    assert await sync_queue.enqueue_sync(broker, account_id, "gmail")
+    assert not await sync_queue.enqueue_sync(broker, account_id, "gmail")
+
+    await _run_until_idle(broker, SyncWorker(broker, lambda job: synced.append(job.account_id)))
+    assert synced == [account_id]
+    assert await sync_queue.enqueue_sync(broker, account_id, "gmail")
+
+
+async def test_failed_publish_does_not_block_the_mailbox(account_id):
+    broker = await InMemoryBroker().connect()
+
+    async def failing_publish(job, delay=0.0):
+        raise ConnectionError("broker down")
+
+    publish, broker.publish = broker.publish, failing_publish
+    with pytest.raises(ConnectionError):
+        await sync_queue.enqueue_sync(broker, account_id, "gmail")
+
+    broker.publish = publish
+    assert await sync_queue.enqueue_sync(broker, account_id, "gmail")
+
+
+async def test_stale_queued_flag_is_cleared(account_id, monkeypatch):
+    broker = await InMemoryBroker().connect()
+    assert await sync_queue.enqueue_sync(broker, account_id, "gmail")
+
+    # The job is lost (restart of an in-memory queue): a new broker clears the flag, and so does its expiry.
+    await InMemoryBroker().connect()
+    assert await sync_queue.enqueue_sync(broker, account_id, "gmail")
+    monkeypatch.setattr(store, "SYNC_QUEUED_TIMEOUT", timedelta(0))
+    assert await sync_queue.enqueue_sync(broker, account_id, "gmail")
+
+
+async def test_failed_sync_is_retried_then_dead_lettered(account_id):
+    broker = await InMemoryBroker().connect()
+    attempts = []
+
+    def flaky_sync(job):
+        attempts.append(job.attempt)
+        if job.account_id.endswith("-dead") or len(attempts) < 3:
+            raise RuntimeError("provider unavailable")
+
+    worker = SyncWorker(broker, flaky_sync, max_attempts=3, retry_base_delay=0.01)
+    await sync_queue.enqueue_sync(broker, account_id, "gmail")
+    await _run_until_idle(broker, worker)
+    assert attempts == [0, 1, 2] and broker.dead_letters == []
+
+    attempts.clear()
+    await sync_queue.enqueue_sync(broker, f"{account_id}-dead", "gmail")
+    await _run_until_idle(broker, worker)
+    assert attempts == [0, 1, 2]
+    assert [(job.account_id, job.attempt) for job in broker.dead_letters] == [(f"{account_id}-dead", 3)]
+
+
+async def test_lease_is_renewed_during_a_long_sync(account_id):
+    broker = await InMemoryBroker().connect()
+    taken_by_other_worker = []
+    done = threading.Event()
+
+    # Runs three times longer than the lease, another worker tries to take the mailbox meanwhile.
+    def long_sync(job):
+        deadline = time.monotonic() + 1.5
+        while time.monotonic() < deadline:
+            with store.SessionLocal() as session:
+                taken_by_other_worker.append(store.acquire_sync_lease(session, job.account_id, job.provider, "other", 0.5))
+            time.sleep(0.1)
+        done.set()
+
+    await sync_queue.enqueue_sync(broker, account_id, "gmail")
+    await _run_until_idle(broker, SyncWorker(broker, long_sync, lease_seconds=0.5))
+
+    assert done.is_set()
+    assert not any(taken_by_other_worker)
+
+
+async def test_handler_errors_do_not_stop_the_workers(account_id, monkeypatch):
+    broker = await InMemoryBroker().connect()
+    synced = []
+    calls = itertools.count()
+
+    class FlakyLeaseWorker(SyncWorker):
+        # The store is unreachable for the first lease request.
+        def _acquire_lease(self, job, owner):
+            if next(calls) == 0:
+                raise ConnectionError("database unavailable")
+            return super()._acquire_lease(job, owner)
+
+    monkeypatch.setattr(sync_queue, "LEASE_BUSY_DELAY", 0.01)
+    await sync_queue.enqueue_sync(broker, account_id, "gmail")
+    await _run_until_idle(broker, FlakyLeaseWorker(broker, lambda job: synced.append(job.account_id)))
+    assert synced == [account_id]
+
+
+# aio-pika channel stand-in: records the declared queues and the published messages.
+class FakeChannel:
+    def __init__(self):
+        self.queues = {}
+        self.published = []
+        self.default_exchange = self
+
+    async def declare_queue(self, name, durable=False, arguments=None):
+        self.queues[name] = arguments or {}
+
+    async def publish(self, message, routing_key):
+        self.published.append((routing_key, message))
+
+
+class FakeConnection:
+    def __init__(self, channel):
+        self._channel = channel
+
+    async def channel(self):
+        return self._channel
+
+
+async def test_rabbitmq_delays_use_one_queue_per_delay_step(monkeypatch):
+    import aio_pika
+
+    channel = FakeChannel()
+
+    async def connect_robust(url):
+        return FakeConnection(channel)
+
+    monkeypatch.setattr(aio_pika, "connect_robust", connect_robust)
+    broker = await RabbitMQBroker("amqp://test").connect()
+
+    # Each delay queue expires its messages back into the sync queue after its own TTL.
+    for seconds in sync_queue.RETRY_DELAY_STEPS:
+        assert channel.queues[f"mail.sync.retry.{seconds}"] == {
+            "x-message-ttl": seconds * 1000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": sync_queue.SYNC_QUEUE,
+        }
+
+    job = SyncJob(account_id="alice", provider="gmail")
+    for delay in (300, 5, 11.2, 0, 10**6):
+        await broker.publish(job, delay=delay)
+    await broker.dead_letter(job)
+
+    # A short delay published after a long one does not wait behind it, delays are rounded up to a step.
+    assert [routing_key for routing_key, _ in channel.published] == [
+        "mail.sync.retry.300", "mail.sync.retry.5", "mail.sync.retry.15", "mail.sync", "mail.sync.retry.3600",
+        "mail.sync.dead",
+    ]
+    # No per-message expiration, it would be checked only at the head of the queue.
+    assert all(message.expiration is None for _, message in channel.published)
+    assert SyncJob.from_bytes(channel.published[0][1].body) == job
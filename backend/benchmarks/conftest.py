@@ -0,0 +1,106 @@
+# Fixtures of the benchmark suite: the local stub server (see stub_server.py) and a `bench` fixture that
+# times a function and reports the results at the end of the run.
+#
+# Run from the backend folder: python -m pytest benchmarks
+# Set BENCHMARK_JSON=results.json to also write the results to a file, to compare two runs.
+import json
+import os
+import statistics
+import tempfile
+import time
+
+_work_dir = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(_work_dir, "benchmarks.db"))
+
+import pytest
+
+from app import attachments, store
+from gmail_api import scheduler
+from stub_server import StubConfig, StubServer
+
+_results = []
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    store.init_db()
+
+
+# Downloaded attachments go to the temp folder of the run. Set here rather than with ATTACHMENT_CACHE_DIR, as
+# app.attachments may already have been imported by the app tests.
+@pytest.fixture(scope="session", autouse=True)
+def attachment_cache_dir():
+    attachments.ATTACHMENT_CACHE_DIR = os.path.join(_work_dir, "attachments")
+
+
+# The real per-user quota (250 units/s) would make the benchmarks measure the quota instead of the code,
+# and the real backoff (seconds) would dominate the runs with 429 injection.
+@pytest.fixture(autouse=True)
+def fast_scheduler(monkeypatch):
+    monkeypatch.setattr(scheduler, "units_per_second", 10 ** 9)
+    monkeypatch.setattr(scheduler, "burst", 10 ** 9)
+    monkeypatch.setattr(scheduler, "base_delay", 0.001)
+    monkeypatch.setattr(scheduler, "max_delay", 0.01)
+
+
+# Starts a stub server: start_stub(message_count=1000, latency=0.002, rate_limit_every=50).
+@pytest.fixture
+def start_stub():
+    servers = []
+
+    def start(message_count=100, **config):
+        server = StubServer(StubConfig(**config), message_count=message_count).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def bench():
+    # Runs func `rounds` times (after one warm-up call unless warmup=False) and records the timings.
+    # items is the number of messages (or other units) handled per call, used for the throughput.
+    def run(name, func, rounds=5, items=None, warmup=True):
+        if warmup:
+            func()
+        timings = []
+        result = None
+        for _ in range(rounds):
+            started = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - started)
+        _results.append({
+            "name": name,
+            "rounds": rounds,
+            "min_ms": round(min(timings) * 1000, 3),
+            "mean_ms": round(statistics.mean(timings) * 1000, 3),
+            "max_ms": round(max(timings) * 1000, 3),
+            "items_per_second": round(items / statistics.mean(timings), 1) if items else None,
+        })
+        return result
+
+    return run
+
+
+# Records a measurement that is not a timing, e.g. peak memory.
+@pytest.fixture
+def record_measurement():
+    def record(name, **values):
+        _results.append({"name": name, **values})
+
+    return record
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section("benchmarks")
+    for result in _results:
+        values = ", ".join(f"{key}={value}" for key, value in result.items() if key != "name" and value is not None)
+        terminalreporter.write_line(f"{result['name']}: {values}")
+
+    if os.getenv("BENCHMARK_JSON"):
+        with open(os.environ["BENCHMARK_JSON"], "w") as file:
+            json.dump(_results, file, indent=2)
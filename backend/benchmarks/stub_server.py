@@ -0,0 +1,532 @@
+# Local stand-in for the Gmail API and Microsoft Graph, used by the benchmarks instead of the real services.
+# It replays the recorded responses in fixtures/ for a mailbox of message_count generated messages, and can
+# add latency to every request and answer every Nth request with a 429, to exercise the retry paths.
+#
+#   with StubServer(StubConfig(latency=0.005, rate_limit_every=50), message_count=1000) as server:
+#       server.url  ->  http://127.0.0.1:<port>
+import asyncio
+import base64
+import copy
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+GMAIL_RATE_LIMIT_ERROR = {
+    "error": {
+        "code": 429,
+        "message": "Too many concurrent requests for user.",
+        "errors": [{"message": "Too many concurrent requests for user.", "domain": "global", "reason": "rateLimitExceeded"}],
+        "status": "RESOURCE_EXHAUSTED",
+    }
+}
+GRAPH_THROTTLED_ERROR = {"error": {"code": "TooManyRequests", "message": "Application is over its MailboxConcurrency limit."}}
+
+
+@dataclass
+class StubConfig:
+    # Seconds added to every request (a batch request counts once).
+    latency: float = 0.0
+    # Every Nth request, or item of a batch request, is answered with a 429. 0 disables it.
+    rate_limit_every: int = 0
+    # Retry-After header of Graph 429 responses, in seconds.
+    retry_after: int = 0
+    # Size of the PDF attached to every message, in bytes. All messages carry the same file.
+    attachment_size: int = 45210
+
+
+def _load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name)) as file:
+        return json.load(file)
+
+
+def _gmail_messages(count):
+    recorded = _load_fixture("gmail_message.json")
+    messages = {}
+    for index in range(count):
+        message = copy.deepcopy(recorded)
+        message["id"] = message["threadId"] = f"18c2f0a1{index:08x}"
+        message["internalDate"] = str(int(recorded["internalDate"]) - index * 60000)
+        for header in message["payload"]["headers"]:
+            if header["name"] == "Subject":
+                header["value"] = f"{header['value']} #{index}"
+            elif header["name"] == "Date":
+                header["value"] = time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(int(message["internalDate"]) // 1000))
+        messages[message["id"]] = message
+    return messages
+
+
+def _graph_messages(count):
+    recorded = _load_fixture("graph_message.json")
+    messages = {}
+    for index in range(count):
+        message = copy.deepcopy(recorded)
+        message["id"] = f"AAMkAGI2TG93{index:012d}AAA="
+        message["conversationId"] = f"AAQkAGI2TG93{index:012d}AAA="
+        message["subject"] = f"{recorded['subject']} #{index}"
+        messages[message["id"]] = message
+    return messages
+
+
+# Gmail format=metadata response: no parts or bodies, only the requested headers.
+def _gmail_metadata(message, header_names):
+    header_names = {name.lower() for name in header_names}
+    return {
+        "id": message["id"],
+        "threadId": message["threadId"],
+        "labelIds": message["labelIds"],
+        "snippet": message["snippet"],
+        "internalDate": message["internalDate"],
+        "payload": {
+            "mimeType": message["payload"]["mimeType"],
+            "headers": [header for header in message["payload"]["headers"] if header["name"].lower() in header_names],
+        },
+    }
+
+
+def _graph_select(message, select):
+    if not select:
+        return message
+    fields = set(select.split(",")) | {"id"}
+    return {key: value for key, value in message.items() if key in fields}
+
+
+def _attachment_content(size):
+    pattern = b"%PDF-1.4\n" + bytes(range(256))
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def _graph_attachments(message_id, size):
+    return [{
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "id": f"{message_id[:-1]}BEAAAAA=",
+        "name": "invoice-october.pdf",
+        "contentType": "application/pdf",
+        "size": size,
+        "isInline": False,
+    }]
+
+
+# Handlers return JSONResponse directly, FastAPI's response validation would make the stub the bottleneck.
+def create_stub_app(config, message_count=100):
+    app = FastAPI()
+    gmail_messages = _gmail_messages(message_count)
+    graph_messages = _graph_messages(message_count)
+    gmail_ids = list(gmail_messages)
+    graph_ids = list(graph_messages)
+    lock = threading.Lock()
+    app.state.stats = stats = {"requests": 0, "rate_limited": 0, "uploaded_bytes": 0, "attachment_downloads": 0}
+    upload_sessions = {}
+    attachment = app.state.attachment = _attachment_content(config.attachment_size)
+    attachment_data = base64.urlsafe_b64encode(attachment).decode()
+    # Gmail issues a new attachment ID every time a message is fetched, the stub only accepts the latest one.
+    attachment_ids = {}
+    # Gmail history records, oldest first. Each one also keeps the labels of its message (_labels) for labelId filters.
+    history = []
+    history_state = {"id": 1000}
+    # Messages answered with a 500 error, see StubServer.fail_gmail_messages.
+    app.state.failing_gmail_ids = failing_gmail_ids = set()
+    # Graph $batch items answered with an error status, see StubServer.fail_graph_messages.
+    app.state.failing_graph_ids = failing_graph_ids = {}
+
+    # True when this request (or batch item) has to be answered with a 429.
+    def rate_limited():
+        with lock:
+            stats["requests"] += 1
+            limited = config.rate_limit_every > 0 and stats["requests"] % config.rate_limit_every == 0
+            stats["rate_limited"] += limited
+            return limited
+
+    @app.middleware("http")
+    async def add_latency(request, call_next):
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        return await call_next(request)
+
+    # ---- Gmail ----
+
+    def gmail_message_response(message_id, query):
+        if rate_limited():
+            return 429, GMAIL_RATE_LIMIT_ERROR
+        message = gmail_messages.get(message_id)
+        if message is None:
+            return 404, {"error": {"code": 404, "message": "Requested entity was not found.", "status": "NOT_FOUND"}}
+        if message_id in failing_gmail_ids:
+            return 500, {"error": {"code": 500, "message": "Backend Error", "status": "INTERNAL"}}
+        if query.get("format", ["full"])[0] == "metadata":
+            return 200, _gmail_metadata(message, query.get("metadataHeaders", []))
+        with lock:
+            attachment_ids[message_id] = f"ANGjdJ8{message_id}{uuid.uuid4().hex[:8]}"
+            for part in message["payload"]["parts"]:
+                if "attachmentId" in part["body"]:
+                    part["body"].update(attachmentId=attachment_ids[message_id], size=len(attachment))
+        return 200, message
+
+    # Mailbox changes made by the tests, each one is recorded in the history like Gmail does.
+    def add_history(record, labels):
+        history_state["id"] += 1
+        history.append({"id": str(history_state["id"]), **record, "_labels": set(labels)})
+
+    def add_gmail_message(label_ids):
+        with lock:
+            message = copy.deepcopy(gmail_messages[gmail_ids[0]] if gmail_ids else next(iter(_gmail_messages(1).values())))
+            message["id"] = message["threadId"] = f"18c2f0a2{history_state['id']:08x}"
+            message["labelIds"] = list(label_ids)
+            gmail_messages[message["id"]] = message
+            gmail_ids.append(message["id"])
+            summary = {"id": message["id"], "threadId": message["threadId"], "labelIds": list(label_ids)}
+            add_history({"messages": [summary], "messagesAdded": [{"message": summary}]}, label_ids)
+            return message["id"]
+
+    def change_gmail_labels(message_id, added=(), removed=()):
+        with lock:
+            message = gmail_messages[message_id]
+            before = set(message["labelIds"])
+            message["labelIds"] = [label for label in message["labelIds"] if label not in removed]
+            message["labelIds"] += [label for label in added if label not in message["labelIds"]]
+            summary = {"id": message_id, "threadId": message["threadId"], "labelIds": list(message["labelIds"])}
+            record = {"messages": [summary]}
+            if added:
+                record["labelsAdded"] = [{"message": summary, "labelIds": list(added)}]
+            if removed:
+                record["labelsRemoved"] = [{"message": summary, "labelIds": list(removed)}]
+            add_history(record, before | set(message["labelIds"]))
+
+    def delete_gmail_message(message_id):
+        with lock:
+            message = gmail_messages.pop(message_id)
+            gmail_ids.remove(message_id)
+            summary = {"id": message_id, "threadId": message["threadId"]}
+            add_history({"messages": [summary], "messagesDeleted": [{"message": summary}]}, message["labelIds"])
+
+    app.state.add_gmail_message = add_gmail_message
+    app.state.change_gmail_labels = change_gmail_labels
+    app.state.delete_gmail_message = delete_gmail_message
+
+    @app.get("/gmail/v1/users/{user_id}/profile")
+    def gmail_profile(user_id: str):
+        return {
+            "emailAddress": "bench@example.com",
+            "messagesTotal": len(gmail_ids),
+            "threadsTotal": len(gmail_ids),
+            "historyId": str(history_state["id"]),
+        }
+
+    @app.get("/gmail/v1/users/{user_id}/history")
+    def gmail_history(
+        user_id: str, startHistoryId: int, labelId: str | None = None, maxResults: int = 100, pageToken: str | None = None
+    ):
+        if rate_limited():
+            return JSONResponse(GMAIL_RATE_LIMIT_ERROR, status_code=429)
+        records = [
+            {key: value for key, value in record.items() if key != "_labels"}
+            for record in history
+            if int(record["id"]) > startHistoryId and (labelId is None or labelId in record["_labels"])
+        ]
+        start = int(pageToken or 0)
+        result = {"history": records[start:start + maxResults], "historyId": str(history_state["id"])}
+        if start + maxResults < len(records):
+            result["nextPageToken"] = str(start + maxResults)
+        return JSONResponse(result)
+
+    @app.get("/gmail/v1/users/{user_id}/labels")
+    def gmail_labels(user_id: str):
+        return {"labels": [{"id": label, "name": label, "type": "system"} for label in ("INBOX", "SENT", "STARRED", "UNREAD")]}
+
+    @app.get("/gmail/v1/users/{user_id}/messages")
+    def gmail_list(user_id: str, maxResults: int = 100, pageToken: str | None = None, labelIds: list[str] = Query([])):
+        if rate_limited():
+            return JSONResponse(GMAIL_RATE_LIMIT_ERROR, status_code=429)
+        matching = [
+            message_id for message_id in gmail_ids if all(label in gmail_messages[message_id]["labelIds"] for label in labelIds)
+        ]
+        start = int(pageToken or 0)
+        end = min(start + maxResults, len(matching))
+        result = {
+            "messages": [{"id": message_id, "threadId": message_id} for message_id in matching[start:end]],
+            "resultSizeEstimate": len(matching),
+        }
+        if end < len(matching):
+            result["nextPageToken"] = str(end)
+        return JSONResponse(result)
+
+    @app.get("/gmail/v1/users/{user_id}/messages/{message_id}")
+    def gmail_get(user_id: str, message_id: str, request: Request):
+        status, body = gmail_message_response(message_id, parse_qs(request.url.query))
+        return JSONResponse(body, status_code=status)
+
+    @app.get("/gmail/v1/users/{user_id}/messages/{message_id}/attachments/{attachment_id}")
+    def gmail_attachment(user_id: str, message_id: str, attachment_id: str):
+        if rate_limited():
+            return JSONResponse(GMAIL_RATE_LIMIT_ERROR, status_code=429)
+        if attachment_ids.get(message_id) != attachment_id:
+            return JSONResponse({"error": {"code": 400, "message": "Invalid attachment token", "status": "INVALID_ARGUMENT"}}, status_code=400)
+        with lock:
+            stats["attachment_downloads"] += 1
+
+        # Streamed in chunks like Gmail does, so the client's memory is not hidden behind one big response body.
+        def body():
+            yield b'{\n  "data": "'
+            for start in range(0, len(attachment_data), 64 * 1024):
+                yield attachment_data[start:start + 64 * 1024].encode()
+            yield b'"\n}\n'
+
+        return StreamingResponse(body(), media_type="application/json")
+
+    # Batch requests are multipart/mixed bodies of embedded HTTP requests, answered the same way.
+    # The static discovery document has no batchPath, so googleapiclient uses /batch.
+    @app.post("/batch")
+    @app.post("/batch/gmail/v1")
+    async def gmail_batch(request: Request):
+        boundary = request.headers["content-type"].split("boundary=", 1)[1].strip('"')
+        body = (await request.body()).decode()
+        response_boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for part in body.split(f"--{boundary}")[1:-1]:
+            content_id = re.search(r"Content-ID: <(.+?)>", part).group(1)
+            url = urlsplit(re.search(r"GET (\S+) HTTP/1\.1", part).group(1))
+            status, response_body = gmail_message_response(url.path.rsplit("/", 1)[-1], parse_qs(url.query))
+            parts.append(
+                f"--{response_boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} X\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(response_body)}\r\n"
+            )
+        parts.append(f"--{response_boundary}--")
+        return Response("".join(parts), media_type=f"multipart/mixed; boundary={response_boundary}")
+
+    def sent_message():
+        return {"id": uuid.uuid4().hex[:16], "threadId": uuid.uuid4().hex[:16], "labelIds": ["SENT"]}
+
+    # Uploads are streamed and only counted, so a big upload does not use memory in the benchmark process.
+    async def count_upload(request):
+        received = 0
+        async for chunk in request.stream():
+            received += len(chunk)
+        with lock:
+            stats["uploaded_bytes"] += received
+        return received
+
+    @app.post("/upload/gmail/v1/users/{user_id}/messages/send")
+    async def gmail_send(user_id: str, request: Request, uploadType: str = "multipart"):
+        if uploadType == "resumable":
+            session_id = uuid.uuid4().hex
+            upload_sessions[session_id] = 0
+            return Response(status_code=200, headers={"Location": f"{request.base_url}upload/sessions/{session_id}"})
+        await count_upload(request)
+        return sent_message()
+
+    @app.put("/upload/sessions/{session_id}")
+    async def gmail_upload_chunk(session_id: str, request: Request):
+        upload_sessions[session_id] += await count_upload(request)
+        total = request.headers["content-range"].rsplit("/", 1)[-1]
+        if total != "*" and upload_sessions[session_id] < int(total):
+            return Response(status_code=308, headers={"Range": f"bytes=0-{upload_sessions[session_id] - 1}"})
+        del upload_sessions[session_id]
+        return sent_message()
+
+    # ---- Microsoft Graph ----
+
+    def graph_throttled():
+        return JSONResponse(GRAPH_THROTTLED_ERROR, status_code=429, headers={"Retry-After": str(config.retry_after)})
+
+    @app.get("/v1.0/me/mailFolders/{folder}/messages")
+    def graph_list(folder: str, request: Request):
+        if rate_limited():
+            return graph_throttled()
+        query = request.query_params
+        top, skip = int(query.get("$top", 10)), int(query.get("$skip", 0))
+        page = graph_ids[skip:skip + top]
+        result = {"value": [_graph_select(graph_messages[message_id], query.get("$select")) for message_id in page]}
+        if skip + top < len(graph_ids):
+            result["@odata.nextLink"] = f"{request.base_url}v1.0/me/mailFolders/{folder}/messages?$top={top}&$skip={skip + top}"
+        return JSONResponse(result)
+
+    # Delta query: the whole folder page by page, then a delta link that returns no further changes.
+    @app.get("/v1.0/me/mailFolders/{folder}/messages/delta")
+    def graph_delta(folder: str, request: Request):
+        if rate_limited():
+            return graph_throttled()
+        query = request.query_params
+        delta_link = f"{request.base_url}v1.0/me/mailFolders/{folder}/messages/delta?$deltatoken=latest"
+        if "$deltatoken" in query:
+            return {"value": [], "@odata.deltaLink": delta_link}
+
+        page_size = int(re.search(r"odata.maxpagesize=(\d+)", request.headers.get("prefer", "odata.maxpagesize=100")).group(1))
+        skip = int(query.get("$skiptoken", 0))
+        select = query.get("$select")
+        page = graph_ids[skip:skip + page_size]
+        result = {"value": [_graph_select(graph_messages[message_id], select) for message_id in page]}
+        if skip + page_size < len(graph_ids):
+            result["@odata.nextLink"] = (
+                f"{request.base_url}v1.0/me/mailFolders/{folder}/messages/delta?$skiptoken={skip + page_size}&$select={select}"
+            )
+        else:
+            result["@odata.deltaLink"] = delta_link
+        return JSONResponse(result)
+
+    # $select'ed message, with its attachments when they are expanded ($expand=attachments(...)).
+    def graph_message(message, select, expand):
+        message = _graph_select(message, select)
+        if expand and expand.startswith("attachments"):
+            message = {**message, "attachments": _graph_attachments(message["id"], len(attachment))}
+        return message
+
+    @app.get("/v1.0/me/messages/{message_id}")
+    def graph_get(message_id: str, request: Request):
+        if rate_limited():
+            return graph_throttled()
+        message = graph_messages.get(message_id)
+        if message is None:
+            return JSONResponse({"error": {"code": "ErrorItemNotFound"}}, status_code=404)
+        return JSONResponse(graph_message(message, request.query_params.get("$select"), request.query_params.get("$expand")))
+
+    @app.get("/v1.0/me/messages/{message_id}/attachments/{attachment_id}/$value")
+    def graph_attachment(message_id: str, attachment_id: str):
+        if rate_limited():
+            return graph_throttled()
+        if message_id not in graph_messages or attachment_id != _graph_attachments(message_id, 0)[0]["id"]:
+            return JSONResponse({"error": {"code": "ErrorItemNotFound"}}, status_code=404)
+        with lock:
+            stats["attachment_downloads"] += 1
+        return Response(attachment, media_type="application/pdf")
+
+    @app.post("/v1.0/$batch")
+    async def graph_batch(request: Request):
+        responses = []
+        for item in (await request.json())["requests"]:
+            url = urlsplit(item["url"])
+            message = graph_messages.get(url.path.rsplit("/", 1)[-1])
+            if rate_limited():
+                responses.append({"id": item["id"], "status": 429, "headers": {"Retry-After": str(config.retry_after)}, "body": GRAPH_THROTTLED_ERROR})
+            elif message is None:
+                responses.append({"id": item["id"], "status": 404, "body": {"error": {"code": "ErrorItemNotFound"}}})
+            elif message["id"] in failing_graph_ids:
+                responses.append({
+                    "id": item["id"],
+                    "status": failing_graph_ids[message["id"]],
+                    "headers": {"Retry-After": str(config.retry_after)},
+                    "body": {"error": {"code": "generalException"}},
+                })
+            else:
+                query = parse_qs(url.query)
+                body = graph_message(message, query.get("$select", [None])[0], query.get("$expand", [None])[0])
+                responses.append({"id": item["id"], "status": 200, "body": body})
+        return JSONResponse({"responses": responses})
+
+    # ---- Categorizer model (CATEGORIZER_URL) ----
+
+    # Size of every batch received, and the response given instead of the categories (see StubServer.fail_categorizer).
+    app.state.categorizer_batches = categorizer_batches = []
+    app.state.categorizer_failure = None
+
+    # Deterministic stand-in for the model: the first category named in the subject, "primary" otherwise.
+    @app.post("/categorize")
+    async def categorize(request: Request):
+        payload = await request.json()
+        with lock:
+            categorizer_batches.append(len(payload["emails"]))
+        if app.state.categorizer_failure is not None:
+            status, body = app.state.categorizer_failure
+            return JSONResponse(body, status_code=status)
+        categories = []
+        for email in payload["emails"]:
+            words = email["subject"].lower().split()
+            categories.append(next((category for category in payload["categories"] if category in words), "primary"))
+        return JSONResponse({"categories": categories})
+
+    return app
+
+
+# Runs the stub app with uvicorn in a background thread on a free local port.
+class StubServer:
+    def __init__(self, config=None, message_count=100):
+        self.config = config or StubConfig()
+        self.app = create_stub_app(self.config, message_count)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Without TCP_NODELAY every keep-alive response waits ~40 ms for the client's delayed ACK (Nagle).
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.bind(("127.0.0.1", 0))
+        self.url = f"http://127.0.0.1:{self._socket.getsockname()[1]}"
+        self._server = uvicorn.Server(uvicorn.Config(self.app, log_level="warning", access_log=False, ws="none"))
+        self._thread = threading.Thread(target=self._server.run, kwargs={"sockets": [self._socket]}, daemon=True)
+
+    @property
+    def stats(self):
+        return self.app.state.stats
+
+    # Gmail mailbox changes, recorded in the history returned by history.list.
+    def add_gmail_message(self, label_ids=("INBOX", "UNREAD")):
+        return self.app.state.add_gmail_message(label_ids)
+
+    def change_gmail_labels(self, message_id, added=(), removed=()):
+        self.app.state.change_gmail_labels(message_id, added, removed)
+
+    def delete_gmail_message(self, message_id):
+        self.app.state.delete_gmail_message(message_id)
+
+    # messages.get of these messages fails with a 500 until it is called again with other IDs.
+    def fail_gmail_messages(self, message_ids):
+        self.app.state.failing_gmail_ids.clear()
+        self.app.state.failing_gmail_ids.update(message_ids)
+
+    # Categorizer requests are answered with this status and JSON body until it is called again with None.
+    # $batch items of these messages fail with the given status ({message_id: status}) until it is called again.
+    def fail_graph_messages(self, statuses):
+        self.app.state.failing_graph_ids.clear()
+        self.app.state.failing_graph_ids.update(statuses)
+
+    def fail_categorizer(self, status=500, body=None):
+        self.app.state.categorizer_failure = None if status is None else (status, body or {"error": "model unavailable"})
+
+    # Gmail service built from the static discovery document with this server as root URL.
+    # Every service gets its own account key, so no scheduler state is shared between benchmarks.
+    def gmail_service(self):
+        document = json.loads(get_static_doc("gmail", "v1"))
+        document["rootUrl"] = document["mtlsRootUrl"] = f"{self.url}/"
+        document["baseUrl"] = f"{self.url}/gmail/v1/users/"
+        # build_http is the same http object the real services use (308 is not followed as a redirect during uploads).
+        service = build_from_document(document, http=build_http())
+        service.account_key = f"bench-{uuid.uuid4().hex[:8]}"
+        return service
+
+    # Same client as initialize_outlook_session in outlook_api.py, pointed at this server.
+    def graph_session(self):
+        return httpx.Client(
+            base_url=f"{self.url}/v1.0/",
+            headers={"Authorization": "Bearer stub", "Prefer": 'outlook.body-content-type="text"'},
+            timeout=30.0,
+        )
+
+    def start(self):
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("Stub server failed to start.")
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+        self._socket.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,98 @@
+# Live fetches of many accounts with the async fetcher (app/fetcher.py) against the stub server: throttled
+# requests are retried, Gmail calls take their units from the account's quota bucket, accounts are told apart by
+# provider and account id, and GET /live/messages reports a failing account without failing the others.
+import functools
+import itertools
+import time
+
+import anyio
+from fastapi.testclient import TestClient
+
+from app import main, sync
+from app.fetcher import AsyncMailFetcher, MailAccount
+from gmail_api import scheduler
+
+_account_ids = itertools.count()
+
+
+def _fetcher(server, **kwargs):
+    return functools.partial(
+        AsyncMailFetcher, gmail_base_url=f"{server.url}/gmail/v1/", graph_base_url=f"{server.url}/v1.0/", **kwargs
+    )
+
+
+def _account(provider):
+    return MailAccount(f"bench-live-{next(_account_ids)}", provider, lambda: "stub")
+
+
+async def _fetch_accounts(server, accounts, max_results):
+    async with _fetcher(server)() as fetcher:
+        return await fetcher.fetch_accounts(accounts, max_results=max_results)
+
+
+def test_throttled_requests_are_retried(start_stub, bench):
+    server = start_stub(message_count=50, rate_limit_every=7)
+    accounts = [_account(provider) for provider in ("gmail", "outlook") * 5]
+
+    results = bench(
+        "async fetch of 10 accounts x 50 emails (429 every 7th)",
+        lambda: anyio.run(_fetch_accounts, server, accounts, 50),
+        rounds=3,
+        items=500,
+    )
+
+    assert server.stats["rate_limited"] > 0
+    for account in accounts:
+        assert len(results[account.key]) == 50, results[account.key]
+
+
+def test_gmail_fetches_wait_for_the_account_quota(start_stub, monkeypatch):
+    server = start_stub(message_count=10)
+    monkeypatch.setattr(scheduler, "units_per_second", 50)
+    monkeypatch.setattr(scheduler, "burst", 50)
+    account = _account("gmail")
+
+    # messages.list and 10 messages.get cost 55 units: 5 more than the bucket holds, which take 0.1 s at 50 units/s.
+    started = time.monotonic()
+    results = anyio.run(_fetch_accounts, server, [account], 10)
+    assert time.monotonic() - started >= 0.09
+    assert len(results[account.key]) == 10
+
+
+def test_accounts_are_keyed_by_provider_and_id(start_stub):
+    server = start_stub(message_count=5)
+    account_id = f"bench-live-{next(_account_ids)}"
+    gmail, outlook = MailAccount(account_id, "gmail", lambda: "stub"), MailAccount(account_id, "outlook", lambda: "stub")
+
+    results = anyio.run(_fetch_accounts, server, [gmail, outlook, MailAccount(account_id, "gmail", lambda: "stub")], 5)
+
+    assert sorted(results) == [("gmail", account_id), ("outlook", account_id)]
+    assert [message.id for message in results[gmail.key]] != [message.id for message in results[outlook.key]]
+
+
+def test_live_messages_reports_failing_accounts(start_stub, monkeypatch):
+    server = start_stub(message_count=5)
+    monkeypatch.setattr(main, "AsyncMailFetcher", _fetcher(server))
+
+    def expired_token():
+        raise RuntimeError("Token expired")
+
+    def get_mail_account(account_id, provider):
+        return MailAccount(account_id, provider, expired_token if account_id == "expired" else lambda: "stub")
+
+    monkeypatch.setattr(sync, "get_mail_account", get_mail_account)
+    with TestClient(main.app) as client:
+        # alice has a Gmail and an Outlook account, and the Gmail one is listed twice.
+        response = client.get(
+            "/live/messages",
+            params={"account": ["gmail:alice", "outlook:alice", "outlook:bob", "outlook:expired", "gmail:alice"]},
+        )
+        assert client.get("/live/messages", params={"account": "imap:carol"}).status_code == 400
+
+    body = response.json()
+    assert body["errors"] == {"outlook:expired": "Token expired"}
+    accounts = [(message["provider"], message["account_id"]) for message in body["messages"]]
+    assert sorted(set(accounts)) == [("gmail", "alice"), ("outlook", "alice"), ("outlook", "bob")]
+    assert len(accounts) == 15
+    dates = [message["date"] for message in body["messages"]]
+    assert dates == sorted(dates, reverse=True)
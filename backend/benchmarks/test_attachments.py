@@ -0,0 +1,156 @@
+# Attachment downloads through the API against the stub server: first open (provider download) versus
+# repeated opens and Range reads served from the attachment cache, and the peak memory of a Gmail download.
+import base64
+import hashlib
+import io
+import tracemalloc
+
+import pytest
+from fastapi.testclient import TestClient
+
+import gmail_api
+import outlook_api
+from app import attachments, store, sync
+from app.main import app
+from gmail_api import download_attachment, get_email_message_details, get_email_message_summaries_bulk, get_email_messages
+
+ATTACHMENT_SIZE = 8 * 1024 * 1024
+RANGE_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def client():
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def test_gmail_attachment_is_downloaded_once(start_stub, bench, client, monkeypatch):
+    server = start_stub(message_count=1, attachment_size=ATTACHMENT_SIZE)
+    service = server.gmail_service()
+    monkeypatch.setattr(sync, "get_gmail_service", lambda account_id: service)
+
+    # Synced as list view metadata, the manifest is recorded when the attachments are first listed.
+    message_ids = [message["id"] for message in get_email_messages(service, max_results=1)]
+    summaries = get_email_message_summaries_bulk(service, message_ids)
+    with store.SessionLocal() as session:
+        store.upsert_messages(session, "bench-attachments", "gmail", summaries)
+        session.commit()
+    base_url = f"/accounts/bench-attachments/messages/gmail/{summaries[0].id}/attachments"
+
+    listed = client.get(base_url).json()["attachments"]
+    assert listed == [
+        {"part_id": "1", "filename": "invoice-october.pdf", "mime_type": "application/pdf", "size": ATTACHMENT_SIZE, "inline": False}
+    ]
+
+    response = bench("gmail attachment first open (8 MB)", lambda: client.get(f"{base_url}/1"), rounds=1, warmup=False)
+    assert response.status_code == 200 and len(response.content) == ATTACHMENT_SIZE
+    assert response.headers["content-type"] == "application/pdf"
+    assert server.stats["attachment_downloads"] == 1
+
+    ranged = bench(
+        "gmail attachment cached 1 MB range",
+        lambda: client.get(f"{base_url}/1", headers={"Range": f"bytes=0-{RANGE_SIZE - 1}"}),
+        rounds=20,
+    )
+    assert ranged.status_code == 206
+    assert ranged.content == response.content[:RANGE_SIZE]
+    assert ranged.headers["content-range"] == f"bytes 0-{RANGE_SIZE - 1}/{ATTACHMENT_SIZE}"
+    assert server.stats["attachment_downloads"] == 1
+
+    # Fetching the email again makes Gmail issue a new attachment ID. After the cached file is gone, the download
+    # with the stored (now rejected) ID falls back to the current ID of the part.
+    get_email_message_details(service, summaries[0].id)
+    with store.SessionLocal() as session:
+        attachment = store.get_attachment(session, "bench-attachments", "gmail", summaries[0].id, "1")
+        old_attachment_id = attachment.attachment_id
+        store.save_attachment_content(session, attachment, None)
+        session.commit()
+
+    assert client.get(f"{base_url}/1").content == response.content
+    assert server.stats["attachment_downloads"] == 2
+    with store.SessionLocal() as session:
+        assert store.get_attachment(session, "bench-attachments", "gmail", summaries[0].id, "1").attachment_id != old_attachment_id
+
+
+# Output file stand-in that only hashes what is written.
+class HashingSink:
+    def __init__(self):
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+
+
+def test_gmail_attachment_download_peak_memory(start_stub, record_measurement):
+    server = start_stub(message_count=1, attachment_size=ATTACHMENT_SIZE, rate_limit_every=2)
+    service = server.gmail_service()
+    message_id = get_email_messages(service, max_results=1)[0]["id"]
+    expected = get_email_message_details(service, message_id).attachments[0]
+
+    sink = HashingSink()
+    tracemalloc.start()
+    try:
+        attachment_id = download_attachment(service, message_id, expected.part_id, sink, expected.attachment_id)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    record_measurement("gmail 8 MB attachment download peak memory", peak_mb=round(peak / 1024 / 1024, 2))
+
+    assert attachment_id == expected.attachment_id
+    assert sink.size == ATTACHMENT_SIZE
+    assert sink.hash.hexdigest() == hashlib.sha256(server.app.state.attachment).hexdigest()
+    assert server.stats["rate_limited"] > 0
+    # The base64 response (~11 MB) is decoded as it streams in, neither it nor the attachment is held in memory.
+    assert peak < ATTACHMENT_SIZE // 4
+
+
+# The response can be split anywhere, also inside the "data" key or a group of 4 base64 characters.
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 4096])
+def test_gmail_attachment_data_is_decoded_across_chunks(chunk_size):
+    content = bytes(range(256)) * 3 + b"end"
+    response = b'{\n  "data": "' + base64.urlsafe_b64encode(content).rstrip(b"=") + b'"\n}\n'
+    output = io.BytesIO()
+
+    decoder = gmail_api._AttachmentDataDecoder(output)
+    for start in range(0, len(response), chunk_size):
+        decoder.write(response[start:start + chunk_size])
+    decoder.close()
+    assert output.getvalue() == content
+
+    with pytest.raises(ValueError):
+        truncated = gmail_api._AttachmentDataDecoder(io.BytesIO())
+        truncated.write(response[:40])
+        truncated.close()
+
+
+def test_outlook_attachment_forwarded_twice_is_stored_once(start_stub, client, monkeypatch):
+    server = start_stub(message_count=2)
+    monkeypatch.setattr(sync, "get_outlook_session", lambda account_id: server.graph_session())
+
+    with server.graph_session() as graph_session:
+        message_ids = [message["id"] for message in outlook_api.get_email_messages(graph_session, max_results=2)]
+        emails = outlook_api.get_email_message_details_bulk(graph_session, message_ids)
+    assert [len(email.attachments) for email in emails] == [1, 1]
+    with store.SessionLocal() as session:
+        store.upsert_messages(session, "bench-attachments", "outlook", emails)
+        session.commit()
+
+    contents = []
+    for email in emails:
+        part_id = email.attachments[0].part_id
+        response = client.get(f"/accounts/bench-attachments/messages/outlook/{email.id}/attachments/{part_id}")
+        assert response.status_code == 200
+        contents.append(response.content)
+
+    assert contents[0] == contents[1]
+    with store.SessionLocal() as session:
+        hashes = {
+            attachment.content_sha256
+            for email in emails
+            for attachment in store.get_attachments(session, "bench-attachments", "outlook", email.id)
+        }
+    assert len(hashes) == 1
+    assert attachments.get_attachment_cache().get(hashes.pop()) is not None
+
@@ -0,0 +1,123 @@
+# Categorization against the stub model endpoint (stub_server.py, POST /categorize): duplicates are classified once,
+# cached results are reused from memory and from the store, emails are sent in batches of batch_size, a failing
+# model leaves the emails uncategorized without failing the sync, and uncategorized emails are categorized later.
+import itertools
+
+import msgspec
+import pytest
+
+from app import store, sync
+from app.categorize import Categorizer, HttpClassifier, content_hash
+from gmail_api import get_email_message_summaries_bulk, get_email_messages
+from mailcore.models import Message
+
+_account_ids = itertools.count()
+
+
+def _email(message_id, subject, body="Hello"):
+    return Message(
+        id=message_id, thread_id=message_id, subject=subject, sender="alice@example.com", recipient="bob@example.com",
+        snippet=body[:20], body=body, has_attachments=False, date=0, starred=False, labels=("INBOX",),
+    )
+
+
+@pytest.fixture
+def model(start_stub):
+    server = start_stub(message_count=1)
+    server.batches = server.app.state.categorizer_batches
+    server.categorizer = lambda **kwargs: Categorizer(HttpClassifier(f"{server.url}/categorize"), **kwargs)
+    return server
+
+
+def test_duplicates_are_classified_once(model, bench):
+    categorizer = model.categorizer(batch_size=32)
+    emails = [_email(f"m{index}", f"Your finance report {index}") for index in range(70)]
+    # Replies quoting the same text hash like the email they answer.
+    replies = [_email(f"r{index}", f"Re: RE: your finance report {index}") for index in range(70)]
+
+    with store.SessionLocal() as session:
+        bench("categorize 140 emails (70 distinct)", lambda: categorizer.categorize(session, emails + replies), rounds=1, warmup=False)
+        assert model.batches == [32, 32, 6]
+        assert {email.category for email in emails + replies} == {"finance"}
+        assert emails[5].content_hash == replies[5].content_hash != emails[6].content_hash
+
+        # Classified again from the memory cache.
+        categorizer.categorize(session, [_email("m0-copy", "Your finance report 0")])
+    assert model.batches == [32, 32, 6]
+
+
+def test_stored_categories_are_reused(model):
+    account_id = f"bench-categorize-{next(_account_ids)}"
+    emails = [_email("m1", "Travel plans"), _email("m2", "Weekly updates")]
+    with store.SessionLocal() as session:
+        store.upsert_messages(session, account_id, "gmail", model.categorizer().categorize(session, emails))
+        session.commit()
+    assert model.batches == [2]
+
+    # A new worker has an empty memory cache, the categories are found in the store.
+    with store.SessionLocal() as session:
+        categorized = model.categorizer().categorize(session, [_email("m3", "Travel plans"), _email("m4", "Weekly updates")])
+    assert [email.category for email in categorized] == ["travel", "updates"]
+    assert model.batches == [2]
+
+
+@pytest.mark.parametrize("status, body", [(500, None), (200, {"categories": None}), (200, {"categories": ["social"]})])
+def test_failing_model_leaves_emails_uncategorized(model, status, body):
+    model.fail_categorizer(status, body)
+    emails = [_email("m1", "Social night"), _email("m2", "Social night", body="Other body")]
+
+    with store.SessionLocal() as session:
+        categorized = model.categorizer().categorize(session, emails)
+    assert [email.category for email in categorized] == [None, None]
+    assert all(email.content_hash for email in categorized)
+
+    model.fail_categorizer(None)
+    with store.SessionLocal() as session:
+        assert [email.category for email in model.categorizer().categorize(session, emails)] == ["social", "social"]
+
+
+def _stored_categories(account_id, provider="gmail"):
+    with store.SessionLocal() as session:
+        return {
+            message.message_id: message.category
+            for message in store.list_messages(session, account_id, provider=provider, limit=100)[0]
+        }
+
+
+def test_uncategorized_emails_are_categorized_after_the_next_sync(model, monkeypatch):
+    account_id = f"bench-categorize-{next(_account_ids)}"
+    monkeypatch.setattr(sync, "get_categorizer", model.categorizer)
+
+    model.fail_categorizer(500)
+    with store.SessionLocal() as session:
+        emails = model.categorizer().categorize(session, [_email("m1", "Travel plans"), _email("m2", "Finance report")])
+        store.upsert_messages(session, account_id, "gmail", emails)
+        session.commit()
+    assert _stored_categories(account_id) == {"m1": None, "m2": None}
+
+    model.fail_categorizer(None)
+    with store.SessionLocal() as session:
+        assert sync.recategorize_account(session, account_id, "gmail") == 2
+        assert sync.recategorize_account(session, account_id, "gmail") == 0
+    assert _stored_categories(account_id) == {"m1": "travel", "m2": "finance"}
+
+
+def test_opened_email_without_category_is_categorized_on_its_body(model, monkeypatch):
+    account_id = f"bench-categorize-{next(_account_ids)}"
+    monkeypatch.setattr(sync, "get_categorizer", model.categorizer)
+    service = model.gmail_service()
+    summary = get_email_message_summaries_bulk(service, [message["id"] for message in get_email_messages(service, max_results=1)])[0]
+
+    # Synced as list view metadata while the model was failing.
+    with store.SessionLocal() as session:
+        store.upsert_messages(session, account_id, "gmail", [summary])
+        session.commit()
+
+        message = sync.load_gmail_body(session, account_id, summary.id, service)
+        assert message.category is not None
+        assert message.content_hash == content_hash(store.stored_email(message))
+
+        # A category the email already has is kept when it is opened again.
+        store.save_categories(session, account_id, "gmail", [msgspec.structs.replace(store.stored_email(message), category="travel")])
+        session.commit()
+        assert sync.load_gmail_body(session, account_id, summary.id, service).category == "travel"
@@ -0,0 +1,131 @@
+# Decode time of extract_body on a recorded message and on messages with very large text parts, and which part it
+# picks and how it decodes it: charsets, nested multiparts, and the part manifest that decodes no data.
+import base64
+import json
+import os
+
+import pytest
+
+from gmail_api import MAX_BODY_BYTES, extract_body, get_part_manifest
+from stub_server import FIXTURES_DIR
+
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+def _alternative_payload(plain, html):
+    return {
+        "mimeType": "multipart/alternative",
+        "parts": [
+            {"partId": "0", "mimeType": "text/plain", "headers": [{"name": "Content-Type", "value": 'text/plain; charset="UTF-8"'}],
+             "body": {"size": len(plain), "data": _encode(plain)}},
+            {"partId": "1", "mimeType": "text/html", "headers": [{"name": "Content-Type", "value": 'text/html; charset="UTF-8"'}],
+             "body": {"size": len(html), "data": _encode(html)}},
+        ],
+    }
+
+
+def test_extract_body_recorded_message(bench):
+    with open(os.path.join(FIXTURES_DIR, "gmail_message.json")) as file:
+        payload = json.load(file)["payload"]
+
+    body = bench("extract_body recorded message x1000", lambda: [extract_body(payload) for _ in range(1000)], items=1000)
+    assert body[0].startswith("Hi team")
+
+
+def test_extract_body_large_parts(bench):
+    # 8 MB of text in each part, only the first MAX_BODY_BYTES should be decoded.
+    line = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. éèà\r\n"
+    plain = line * (8 * 1024 * 1024 // len(line))
+    payload = _alternative_payload(plain, f"<pre>{plain}</pre>")
+
+    body = bench("extract_body 8 MB text part", lambda: extract_body(payload), rounds=20, items=1)
+    assert len(body.encode()) <= MAX_BODY_BYTES
+    assert body.startswith("Lorem ipsum")
+
+
+def test_extract_body_many_parts(bench):
+    # Deeply nested multipart message with many inline parts before the text part.
+    payload = {"mimeType": "multipart/mixed", "parts": [
+        {"partId": str(index), "mimeType": "image/png", "filename": f"image{index}.png",
+         "headers": [{"name": "Content-Disposition", "value": "inline"}], "body": {"attachmentId": f"A{index}", "size": 1000}}
+        for index in range(500)
+    ]}
+    payload["parts"].append(_alternative_payload("text after 500 parts", "<p>html</p>"))
+
+    body = bench("extract_body 500 inline parts", lambda: extract_body(payload), rounds=50, items=1)
+    assert body == "text after 500 parts"
+
+
+def _text_part(part_id, mime_type, text, charset="UTF-8"):
+    data = base64.urlsafe_b64encode(text.encode(charset)).decode()
+    return {"partId": part_id, "mimeType": mime_type, "headers": [{"name": "Content-Type", "value": f'{mime_type}; charset="{charset}"'}],
+            "body": {"size": len(data) * 3 // 4, "data": data}}
+
+
+# Attachment body that fails the test when its data is read.
+class UndecodedBody(dict):
+    def __getitem__(self, key):
+        if key == "data":
+            raise AssertionError("The attachment data was read.")
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        if key == "data":
+            raise AssertionError("The attachment data was read.")
+        return super().get(key, default)
+
+
+def _attachment_part(part_id, filename, disposition="attachment"):
+    return {"partId": part_id, "mimeType": "application/octet-stream", "filename": filename,
+            "headers": [{"name": "Content-Disposition", "value": f'{disposition}; filename="{filename}"'}],
+            "body": UndecodedBody(attachmentId=f"ATT-{part_id}", size=2048, data="not base64")}
+
+
+# multipart/mixed -> multipart/related -> multipart/alternative, with an inline image in the related part and a
+# file attached to the mixed part.
+def _nested_payload(plain=True):
+    alternative = [_text_part("0.0.1", "text/html", "<p>Meeting moved to Friday</p>")]
+    if plain:
+        alternative.insert(0, _text_part("0.0.0", "text/plain", "Meeting moved to Friday"))
+    return {"mimeType": "multipart/mixed", "partId": "", "parts": [
+        {"mimeType": "multipart/related", "partId": "0", "parts": [
+            {"mimeType": "multipart/alternative", "partId": "0.0", "parts": alternative},
+            _attachment_part("0.1", "logo.png", disposition="inline"),
+        ]},
+        _attachment_part("1", "agenda.pdf"),
+    ]}
+
+
+@pytest.mark.parametrize("charset, text", [
+    ("iso-8859-1", "Café crème, à bientôt"),
+    ("windows-1252", "Café crème à 5 €, à bientôt"),
+    ("utf-8", "Café crème à 5 €, à bientôt"),
+])
+def test_extract_body_decodes_the_part_charset(charset, text):
+    assert extract_body({"mimeType": "multipart/alternative", "parts": [_text_part("0", "text/plain", text, charset)]}) == text
+
+
+def test_extract_body_unknown_charset_falls_back_to_utf8():
+    part = _text_part("0", "text/plain", "Grüße")
+    part["headers"][0]["value"] = 'text/plain; charset="x-unknown"'
+    assert extract_body(part) == "Grüße"
+
+
+def test_extract_body_three_level_nesting():
+    assert extract_body(_nested_payload()) == "Meeting moved to Friday"
+    # Without a plain text version the HTML part is used.
+    assert extract_body(_nested_payload(plain=False)) == "<p>Meeting moved to Friday</p>"
+
+
+def test_part_manifest_reports_nested_attachments_without_decoding_them():
+    manifest = get_part_manifest(_nested_payload())
+
+    assert [(part["part_id"], part["mime_type"]) for part in manifest] == [
+        ("0.0.0", "text/plain"), ("0.0.1", "text/html"), ("0.1", "application/octet-stream"), ("1", "application/octet-stream"),
+    ]
+    attachments = [part for part in manifest if part["is_attachment"]]
+    assert [(part["filename"], part["attachment_id"], part["size"], part["inline"]) for part in attachments] == [
+        ("logo.png", "ATT-0.1", 2048, True), ("agenda.pdf", "ATT-1", 2048, False),
+    ]
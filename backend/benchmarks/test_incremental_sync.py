@@ -0,0 +1,81 @@
+# Incremental Gmail sync (history API) against the stub server: the store must end up with the same emails as a
+# full sync of the folder, whatever changed in between.
+import itertools
+
+import pytest
+
+from app import store, sync
+from gmail_api import BulkFetchError, get_email_messages
+
+MESSAGE_COUNT = 200
+
+_account_ids = itertools.count()
+
+
+def _stored_ids(account_id):
+    with store.SessionLocal() as session:
+        messages, _ = store.list_messages(session, account_id, provider="gmail", limit=500)
+        return {message.message_id for message in messages}
+
+
+def _sync(account_id, service):
+    with store.SessionLocal() as session:
+        return sync.sync_gmail_account(session, account_id, service)
+
+
+def test_incremental_sync_only_keeps_the_folder(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT)
+    service = server.gmail_service()
+    account_id = f"bench-history-{next(_account_ids)}"
+    assert _sync(account_id, service)["full_resync"]
+
+    inbox_ids = [message["id"] for message in get_email_messages(service, max_results=3)]
+    server.add_gmail_message(("INBOX", "UNREAD"))
+    sent_id = server.add_gmail_message(("SENT",))
+    moved_in_id = server.add_gmail_message(("SPAM",))
+    server.change_gmail_labels(moved_in_id, added=("INBOX",), removed=("SPAM",))
+    server.change_gmail_labels(inbox_ids[0], removed=("INBOX",))
+    server.change_gmail_labels(inbox_ids[1], added=("STARRED",))
+    server.delete_gmail_message(inbox_ids[2])
+
+    result = bench("gmail incremental sync (7 changes)", lambda: _sync(account_id, service), rounds=1, warmup=False)
+    assert not result["full_resync"]
+
+    folder_ids = {message["id"] for message in get_email_messages(service, max_results=None)}
+    stored_ids = _stored_ids(account_id)
+    assert stored_ids == folder_ids
+    assert moved_in_id in stored_ids and sent_id not in stored_ids and inbox_ids[0] not in stored_ids
+    with store.SessionLocal() as session:
+        assert store.get_message(session, account_id, "gmail", inbox_ids[1]).starred
+
+    # A full resync gives the same store.
+    with store.SessionLocal() as session:
+        store.save_checkpoint(session, account_id, "gmail", None)
+        session.commit()
+    assert _sync(account_id, service)["full_resync"]
+    assert _stored_ids(account_id) == stored_ids
+
+
+def test_emails_that_fail_to_fetch_are_fetched_by_the_retry(start_stub):
+    server = start_stub(message_count=10)
+    service = server.gmail_service()
+    account_id = f"bench-history-{next(_account_ids)}"
+    _sync(account_id, service)
+    with store.SessionLocal() as session:
+        checkpoint = store.get_checkpoint(session, account_id, "gmail")
+
+    fetched_id = server.add_gmail_message()
+    failing_id = server.add_gmail_message()
+    server.fail_gmail_messages([failing_id])
+    with pytest.raises(BulkFetchError) as error:
+        _sync(account_id, service)
+
+    # The fetched email is kept, the checkpoint stays where it was.
+    assert error.value.failed_ids == [failing_id]
+    assert fetched_id in _stored_ids(account_id) and failing_id not in _stored_ids(account_id)
+    with store.SessionLocal() as session:
+        assert store.get_checkpoint(session, account_id, "gmail") == checkpoint
+
+    server.fail_gmail_messages([])
+    _sync(account_id, service)
+    assert failing_id in _stored_ids(account_id)
@@ -0,0 +1,125 @@
+# List / detail / sync throughput of the Gmail and Outlook adapters against the stub server.
+import itertools
+
+import pytest
+
+import outlook_api
+from app import store, sync
+from gmail_api import get_email_message_details_bulk, get_email_message_summaries_bulk, get_email_messages
+from mailcore.metrics import metrics
+
+MESSAGE_COUNT = 500
+
+_account_ids = itertools.count()
+
+
+def _new_account_id(provider):
+    return f"bench-{provider}-{next(_account_ids)}"
+
+
+def test_gmail_list_and_detail_throughput(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT, latency=0.001)
+    service = server.gmail_service()
+
+    def list_and_fetch():
+        messages = get_email_messages(service, max_results=None)
+        return get_email_message_details_bulk(service, [message["id"] for message in messages])
+
+    emails = bench("gmail list + full details (batch)", list_and_fetch, items=MESSAGE_COUNT)
+    assert len(emails) == MESSAGE_COUNT
+    assert emails[0].body.startswith("Hi team")
+
+    summaries = bench(
+        "gmail summaries (batch, metadata)",
+        lambda: get_email_message_summaries_bulk(service, [email.id for email in emails]),
+        items=MESSAGE_COUNT,
+    )
+    assert summaries[0].body is None and summaries[0].subject.startswith("October invoice")
+
+
+def test_gmail_details_with_rate_limiting(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT, latency=0.001, rate_limit_every=37)
+    service = server.gmail_service()
+    message_ids = [message["id"] for message in get_email_messages(service, max_results=None)]
+    metrics.reset()
+
+    emails = bench(
+        "gmail full details with 429s (1 in 37)",
+        lambda: get_email_message_details_bulk(service, message_ids),
+        items=MESSAGE_COUNT,
+        warmup=False,
+    )
+
+    # Every rate limited message is retried, none is lost.
+    assert [email.id for email in emails] == message_ids
+    assert server.stats["rate_limited"] > 0
+    assert metrics.snapshot()["gmail"]["quota_units"] >= 5 * MESSAGE_COUNT
+
+
+def test_gmail_full_sync_into_store(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT, latency=0.001)
+    service = server.gmail_service()
+
+    def full_sync():
+        with store.SessionLocal() as session:
+            return sync.sync_gmail_account(session, _new_account_id("gmail"), service)
+
+    result = bench("gmail full sync into store", full_sync, rounds=3, items=MESSAGE_COUNT)
+    assert result["upserted"] == MESSAGE_COUNT and result["full_resync"]
+
+
+def test_outlook_list_and_detail_throughput(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT, latency=0.001)
+
+    with server.graph_session() as session:
+        def list_and_fetch():
+            messages = outlook_api.get_email_messages(session, max_results=None)
+            return outlook_api.get_email_message_details_bulk(session, [message["id"] for message in messages])
+
+        emails = bench("outlook list + full details ($batch)", list_and_fetch, items=MESSAGE_COUNT)
+
+    assert len(emails) == MESSAGE_COUNT
+    assert emails[0].body.startswith("Hi team")
+
+
+def test_outlook_details_with_throttling(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT, latency=0.001, rate_limit_every=37)
+
+    with server.graph_session() as session:
+        message_ids = [message["id"] for message in outlook_api.get_email_messages(session, max_results=None)]
+        emails = bench(
+            "outlook full details with 429s (1 in 37)",
+            lambda: outlook_api.get_email_message_details_bulk(session, message_ids),
+            items=MESSAGE_COUNT,
+            warmup=False,
+        )
+
+    assert [email.id for email in emails] == message_ids
+    assert server.stats["rate_limited"] > 0
+
+
+def test_outlook_failed_details_are_reported(start_stub):
+    server = start_stub(message_count=5)
+
+    with server.graph_session() as session:
+        message_ids = [message["id"] for message in outlook_api.get_email_messages(session, max_results=None)]
+        # One email fails for good, one keeps failing with a server error, and one was deleted in the meantime.
+        server.fail_graph_messages({message_ids[1]: 403, message_ids[3]: 500})
+        with pytest.raises(outlook_api.BulkFetchError) as error:
+            outlook_api.get_email_message_details_bulk(session, message_ids + ["deleted"], max_retries=2)
+
+    assert error.value.failed_ids == [message_ids[1], message_ids[3]]
+    assert [email.id for email in error.value.emails] == [message_ids[0], message_ids[2], message_ids[4]]
+
+
+def test_outlook_delta_sync_into_store(start_stub, bench):
+    server = start_stub(message_count=MESSAGE_COUNT, latency=0.001)
+
+    with server.graph_session() as graph_session:
+        def full_sync():
+            with store.SessionLocal() as session:
+                return sync.sync_outlook_account(session, _new_account_id("outlook"), graph_session)
+
+        result = bench("outlook delta sync into store", full_sync, rounds=3, items=MESSAGE_COUNT)
+
+    assert result["upserted"] == MESSAGE_COUNT and result["full_resync"]
@@ -0,0 +1,2 @@
+# Types and metrics shared by the provider adapters (Gmail/, Outlook/) and the app. Nothing here imports the app
+# package, whose import loads the .env settings and changes the import path.
@@ -0,0 +1,114 @@
+# In-process metrics of the calls made to the provider APIs, served by GET /metrics.
+# The Gmail request scheduler, graph_request (Outlook) and the async fetcher record every upstream call here,
+# so call counts, latencies and Gmail quota usage can be compared between releases.
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+import psutil
+
+# Latencies kept per method for the percentiles, older ones are dropped.
+LATENCY_SAMPLES = 1024
+
+# Graph IDs in URL paths are replaced by {id}, so all calls of one endpoint are counted together.
+GRAPH_ID_SEGMENT = re.compile(r"/[A-Za-z0-9_=+-]{20,}(?=/|$)")
+
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    errors: int = 0
+    throttled: int = 0
+    quota_units: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=LATENCY_SAMPLES))
+
+    def to_dict(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 2) if latencies else None
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "quota_units": self.quota_units,
+            "avg_ms": round(self.total_seconds / self.calls * 1000, 2) if self.calls else None,
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "max_ms": round(self.max_seconds * 1000, 2),
+        }
+
+
+class CallMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.started = time.monotonic()
+
+    # Records one upstream call. throttled is a rate limited call (429), it also counts as an error.
+    def record(self, provider, method, seconds, quota_units=0, error=False, throttled=False):
+        with self._lock:
+            stats = self._stats.get((provider, method))
+            if stats is None:
+                stats = self._stats[(provider, method)] = CallStats()
+            stats.calls += 1
+            stats.errors += bool(error or throttled)
+            stats.throttled += bool(throttled)
+            stats.quota_units += quota_units
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.latencies.append(seconds)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.started = time.monotonic()
+
+    # {provider: {calls, errors, throttled, quota_units, methods: {method: stats}}}
+    def snapshot(self):
+        with self._lock:
+            stats = {key: value.to_dict() for key, value in self._stats.items()}
+
+        providers = {}
+        for (provider, method), method_stats in sorted(stats.items()):
+            totals = providers.setdefault(provider, {"calls": 0, "errors": 0, "throttled": 0, "quota_units": 0, "methods": {}})
+            for name in ("calls", "errors", "throttled", "quota_units"):
+                totals[name] += method_stats[name]
+            totals["methods"][method] = method_stats
+        return providers
+
+
+# Metrics shared by every provider call in this process.
+metrics = CallMetrics()
+
+
+def graph_method_name(method, url):
+    path = url.split("?", 1)[0].split("graph.microsoft.com/v1.0/", 1)[-1]
+    return f"{method.upper()} {GRAPH_ID_SEGMENT.sub('/{id}', '/' + path.lstrip('/'))}"
+
+
+def process_stats():
+    process = psutil.Process()
+    with process.oneshot():
+        memory = process.memory_info()
+        cpu = process.cpu_times()
+        return {
+            "rss_bytes": memory.rss,
+            "vms_bytes": memory.vms,
+            "cpu_user_seconds": cpu.user,
+            "cpu_system_seconds": cpu.system,
+            "threads": process.num_threads(),
+        }
+
+
+def snapshot():
+    return {
+        "uptime_seconds": round(time.monotonic() - metrics.started, 1),
+        "process": process_stats(),
+        "providers": metrics.snapshot(),
+    }
@@ -0,0 +1,57 @@
+# Message types shared by the Gmail and Outlook adapters, the sync pipeline and the API.
+# They are msgspec structs rather than dictionaries: an instance has no per-object __dict__, is not tracked by
+# the garbage collector, and encodes to JSON without going through pydantic.
+# This package does not import the app, so the adapters can use it without loading the app's settings.
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+import msgspec
+
+# Epoch used for emails whose date is missing or cannot be parsed.
+UNKNOWN_DATE = 0
+
+
+# Parses an RFC 2822 Date header (e.g. 'Mon, 1 Jan 2024 10:00:00 +0000') to epoch seconds.
+def epoch_from_date_header(date_header):
+    try:
+        date = parsedate_to_datetime(date_header)
+    except (TypeError, ValueError, IndexError):
+        return UNKNOWN_DATE
+    # Headers without a timezone are taken as UTC.
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp())
+
+
+# One attachment of a Message: a part with a file name or an attachment disposition (Gmail, at any nesting depth)
+# or a file attachment of the message (Graph). part_id identifies it within the message and does not change;
+# attachment_id is the provider handle to download it with, Gmail issues a new one every time the message is fetched.
+class Attachment(msgspec.Struct, array_like=True, gc=False):
+    part_id: str
+    filename: str
+    mime_type: str
+    size: int
+    attachment_id: str | None
+    inline: bool = False
+
+
+# One email as returned by get_email_message_details (Gmail) and parse_outlook_message (Outlook).
+# Encoded as a JSON array (array_like), which is what it is when queued or cached.
+# body and attachments are None when only the list view metadata was fetched.
+# category and content_hash are set by app.categorize.
+class Message(msgspec.Struct, array_like=True, gc=False):
+    id: str
+    thread_id: str
+    subject: str
+    sender: str
+    recipient: str
+    snippet: str
+    body: str | None
+    has_attachments: bool
+    # Epoch seconds (UTC).
+    date: int
+    starred: bool
+    labels: tuple[str, ...]
+    attachments: tuple[Attachment, ...] | None = None
+    category: str | None = None
+    content_hash: str | None = None